@@ -1,10 +1,14 @@
 import streamlit as st
 import datetime
 import os
-from gemini_client import generate_flashcards, help_chat
-from storage import load_cards, add_card, update_card_progress, delete_card, update_card_content, delete_cards_batch, add_source_card, get_source_cards_by_ids, load_source_cards, delete_source_card
+import time
+from streamlit.errors import StreamlitAPIException
+from gemini_client import generate_flashcards, help_chat_stream, discard_prefetched_suggestion, pool_api_key
+from jobs import get_job_registry, JobLimitExceeded
+from search_index import search_deck, warm_search_index
+from storage import load_cards, add_card, update_card_progress, delete_card, update_card_content, delete_cards_batch, add_source_card, get_source_cards_by_ids, load_deck, delete_source_card
 from utils import calculate_next_review, select_hybrid_quota
-from auth import register_user, authenticate_user, get_username, create_session, validate_session_token, delete_session, get_api_key, update_api_key, get_daily_quota_limit, update_daily_quota_limit
+from auth import register_user, authenticate_user, get_username, create_session, validate_session, delete_session, get_api_key, update_api_key, get_daily_quota_limit, update_daily_quota_limit, get_preference, update_preference, start_session_sweeper
 from streamlit_cookies_controller import CookieController
 
 # Page Config
@@ -17,6 +21,9 @@ st.set_page_config(
 # Cookie Controller
 cookie_controller = CookieController()
 
+# 期限切れセッションの定期削除（プロセスで1回だけ開始）
+start_session_sweeper()
+
 # Custom CSS
 st.markdown("""
 <style>
@@ -263,6 +270,92 @@ st.markdown("""
 </style>
 """, unsafe_allow_html=True)
 
+# ============ バックグラウンドジョブ ============
+
+JOB_POLL_INTERVAL = 1  # 実行中のジョブを確認する間隔（秒）
+
+def take_finished_job(state_key):
+    """
+    session_stateに記録したジョブが終わっていれば取り出す
+
+    Returns:
+        Job: 完了したジョブ（実行中・未登録ならNone）
+    """
+    job_id = st.session_state.get(state_key)
+    if not job_id:
+        return None
+    job = get_job_registry().get(job_id, st.session_state.get("user_id"))
+    if job is not None and not job.done:
+        return None
+    del st.session_state[state_key]
+    return job
+
+@st.fragment(run_every=JOB_POLL_INTERVAL)
+def show_job_progress(state_key, label):
+    """実行中のジョブの進捗を表示し、完了したら画面全体を再実行して結果を反映"""
+    job_id = st.session_state.get(state_key)
+    job = get_job_registry().get(job_id) if job_id else None
+    if job is None or job.done:
+        st.rerun()
+    if job.status == "queued":
+        st.info(f"⏳ {label}（順番待ち）")
+    elif job.progress is not None:
+        st.progress(job.progress, text=f"{label}（{job.message}）")
+    else:
+        st.info(f"⏳ {label}（{job.elapsed():.0f}秒）")
+
+@st.fragment(run_every=JOB_POLL_INTERVAL)
+def show_help_answer_progress():
+    """ヘルプAIの回答を届いた分から表示"""
+    job_id = st.session_state.get("help_chat_job")
+    job = get_job_registry().get(job_id) if job_id else None
+    if job is None or job.done:
+        st.rerun()
+    st.markdown(f"<div class='chat-message assistant'>🤖 {job.partial or '回答中...'}</div>", unsafe_allow_html=True)
+
+def discard_suggest_prefetch(api_key):
+    """使われなかった穴埋め提案の先読みを破棄"""
+    phrases = st.session_state.pop("suggest_prefetch_phrases", None)
+    st.session_state.pop("suggest_prefetch_job", None)
+    if phrases is not None:
+        discard_prefetched_suggestion(phrases, api_key)
+
+# ============ 描画時間の計測 ============
+
+# 環境変数 DEBUG_TIMING=1 のときだけ描画時間をサーバーのログに出力する（計測は benchmark_app.py）
+DEBUG_TIMING = os.environ.get("DEBUG_TIMING") == "1"
+
+def log_timing(label, started, detail):
+    """time.perf_counter() の開始時刻からの経過時間をログに出力"""
+    if DEBUG_TIMING:
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        print(f"⏱️ {label} {elapsed_ms:.0f} ms（{detail}）")
+
+# ============ ページ分割 ============
+
+MANAGE_PAGE_SIZE_OPTIONS = [10, 20, 50, 100]  # カード管理の1ページの表示件数の選択肢
+MANAGE_DEFAULT_PAGE_SIZE = 20
+
+def show_pagination(total, page_size, state_key):
+    """
+    ページ選択を表示し、表示する範囲を返す（1ページに収まる場合は何も表示しない）
+
+    Returns:
+        tuple: (開始位置, 終了位置)
+    """
+    total_pages = max(1, -(-total // page_size))
+    # 削除などでページ数が減った場合は最終ページに合わせる
+    if st.session_state.get(state_key, 1) > total_pages:
+        st.session_state[state_key] = total_pages
+    page = 1
+    if total_pages > 1:
+        page = st.number_input(
+            f"ページ（全 {total_pages} ページ / {total} 件）",
+            min_value=1, max_value=total_pages, step=1, key=state_key
+        )
+    page_start = (page - 1) * page_size
+    return page_start, min(page_start + page_size, total)
+
 # ============ 認証処理 ============
 
 def check_auth():
@@ -274,10 +367,11 @@ def check_auth():
     # Cookieからセッショントークンを取得
     session_token = cookie_controller.get("session_token")
     if session_token:
-        user_id = validate_session_token(session_token)
-        if user_id:
-            st.session_state.user_id = user_id
-            st.session_state.username = get_username(user_id)
+        # 検証済みトークンはプロセス内キャッシュで判定（再読み込み時にDBへ問い合わせない）
+        session = validate_session(session_token)
+        if session:
+            st.session_state.user_id = session["user_id"]
+            st.session_state.username = session["username"] or get_username(session["user_id"])
             return True
     
     return False
@@ -354,19 +448,258 @@ def logout():
         del st.session_state.user_id
     if "username" in st.session_state:
         del st.session_state.username
+    if "user_profiles" in st.session_state:
+        del st.session_state.user_profiles
     
     st.rerun()
 
+# ============ 本日のノルマ ============
+
+def rerun_fragment():
+    """
+    実行中のフラグメントだけを再実行
+    
+    フラグメントの操作がアプリ全体の再実行にまとめられた場合（直前の操作の再実行中に押されたなど）は
+    フラグメント単位で再実行できないため、アプリ全体を再実行する。
+    """
+    try:
+        st.rerun(scope="fragment")
+    except StreamlitAPIException:
+        st.rerun()
+
+@st.fragment
+def show_review_session(user_id):
+    """
+    本日のノルマの復習画面
+
+    答えの表示・評価・原文確認の操作はこのフラグメントだけを再実行する
+    （サイドバーや他のタブは再実行しない。ノルマの上限変更などはアプリ全体の再実行で反映される）。
+    """
+    render_started = time.perf_counter()
+    
+    cards = load_cards(user_id)
+    today = datetime.date.today().isoformat()
+    daily_limit = get_daily_quota_limit(user_id)
+    
+    # 日付が変わったらセッションをリセット
+    if st.session_state.get("quota_date") != today:
+        st.session_state.quota_date = today
+        st.session_state.reviewed_source_ids = []
+        st.session_state.reviewed_card_ids = []
+        st.session_state.reviewed_card_count = 0
+        st.session_state.quota_card_ids = None  # その日のノルマカードIDをリセット
+    
+    # 復習済みのcard_idを取得
+    reviewed_card_ids = set(st.session_state.get("reviewed_card_ids", []))
+    
+    # その日のノルマカードIDが未設定なら初回選択
+    if st.session_state.get("quota_card_ids") is None:
+        # Filter cards due for review
+        all_due_cards = [c for c in cards if c['next_review'] <= today]
+        # ハイブリッド選択でノルマカードを決定
+        selected_cards = select_hybrid_quota(all_due_cards, daily_limit, cards)
+        st.session_state.quota_card_ids = [c['id'] for c in selected_cards]
+    
+    # 保存されたノルマカードIDから、まだ復習していないカードを取得
+    quota_card_ids = set(st.session_state.get("quota_card_ids", []))
+    remaining_quota_ids = quota_card_ids - reviewed_card_ids
+    
+    # 復習対象カードのリストを構築（IDベースで）
+    cards_by_id = {c['id']: c for c in cards}
+    due_cards = [cards_by_id[cid] for cid in remaining_quota_ids if cid in cards_by_id]
+    
+    # 期限日が古い順にソート
+    due_cards.sort(key=lambda c: c.get('next_review', '9999-99-99'))
+    
+    # all_due_cardsは表示用に計算
+    all_due_cards = [c for c in cards if c['next_review'] <= today]
+    
+    if not due_cards:
+        st.markdown("""
+        <div style="text-align: center; padding: 50px;">
+            <h2>🎉 本日のノルマ完了！</h2>
+            <p style="color: #6b7280;">今日のノルマは終了しました。お疲れ様でした！</p>
+        </div>
+        """, unsafe_allow_html=True)
+        st.metric("デッキのカード総数", len(cards))
+        if len(all_due_cards) > daily_limit:
+            st.info(f"💡 残り {len(all_due_cards) - daily_limit} 枚のカードが復習待ちです（明日以降）")
+        
+        # ノルマ復習モード（原文カードレビュー）
+        reviewed_source_ids = st.session_state.get("reviewed_source_ids", [])
+        if reviewed_source_ids:
+            st.markdown("---")
+            st.subheader("📖 ノルマ復習（原文確認）")
+            st.markdown("今日復習したカードの原文を確認できます。")
+            
+            # 原文カードを取得
+            source_cards = get_source_cards_by_ids(list(set(reviewed_source_ids)))
+            
+            if source_cards:
+                # 復習モードのセッション状態
+                if "source_review_index" not in st.session_state:
+                    st.session_state.source_review_index = 0
+                
+                if st.session_state.source_review_index >= len(source_cards):
+                    st.session_state.source_review_index = 0
+                
+                current_source = source_cards[st.session_state.source_review_index]
+                
+                st.progress(
+                    (st.session_state.source_review_index + 1) / len(source_cards),
+                    text=f"原文 {st.session_state.source_review_index + 1} / {len(source_cards)}"
+                )
+                
+                # 原文表示
+                st.markdown(f"""
+                <div class="flashcard">
+                    {f'<div class="flashcard-title">{current_source.get("title", "")}</div>' if current_source.get("title") else ''}
+                    {f'<div class="flashcard-category">{current_source.get("category", "その他")}</div>'}
+                    <div class="flashcard-question" style="font-size: 18px; text-align: left;">{current_source.get("source_text", "")}</div>
+                </div>
+                """, unsafe_allow_html=True)
+                
+                # ナビゲーション
+                nav_col1, nav_col2, nav_col3 = st.columns([1, 2, 1])
+                with nav_col1:
+                    if st.session_state.source_review_index > 0:
+                        if st.button("◀ 前へ", use_container_width=True):
+                            st.session_state.source_review_index -= 1
+                            rerun_fragment()
+                with nav_col2:
+                    if st.button("✓ 復習を終了", type="primary", use_container_width=True):
+                        st.session_state.reviewed_source_ids = []
+                        st.session_state.source_review_index = 0
+                        rerun_fragment()
+                with nav_col3:
+                    if st.session_state.source_review_index < len(source_cards) - 1:
+                        if st.button("次へ ▶", use_container_width=True):
+                            st.session_state.source_review_index += 1
+                            rerun_fragment()
+            else:
+                st.info("原文カードが見つかりませんでした。")
+                if st.button("クリア"):
+                    st.session_state.reviewed_source_ids = []
+                    rerun_fragment()
+    else:
+        # 固定されたノルマ数と残り枚数を計算
+        total_quota = len(st.session_state.get("quota_card_ids", []))
+        reviewed_count = st.session_state.get("reviewed_card_count", 0)
+        remaining = len(due_cards)
+        progress = reviewed_count / total_quota if total_quota > 0 else 0
+        st.progress(progress, text=f"本日の進捗: {reviewed_count} / {total_quota} 枚完了（残り {remaining} 枚）")
+        
+        # Current card session state
+        if "current_card_index" not in st.session_state:
+            st.session_state.current_card_index = 0
+            
+        # Ensure index is valid
+        if st.session_state.current_card_index >= len(due_cards):
+             st.session_state.current_card_index = 0
+             
+        current_card = due_cards[st.session_state.current_card_index]
+        
+        # Card Display
+        st.markdown(f"""
+        <div class="flashcard">
+            {f'<div class="flashcard-title">{current_card.get("title", "")}</div>' if current_card.get("title") else ''}
+            {f'<div class="flashcard-category">{current_card.get("category", "その他")}</div>'}
+            <div class="flashcard-question">{current_card['question']}</div>
+            {f'<div class="flashcard-answer">{current_card["answer"]}</div>' if st.session_state.get("show_answer", False) else ''}
+        </div>
+        """, unsafe_allow_html=True)
+        
+        # Controls
+        if not st.session_state.get("show_answer", False):
+            col1, col2, col3 = st.columns([1, 2, 1])
+            with col2:
+                if st.button("答えを見る", type="primary", use_container_width=True):
+                    st.session_state.show_answer = True
+                    st.session_state.review_action_started = render_started
+                    rerun_fragment()
+        else:
+            st.markdown("<div style='text-align: center; margin-bottom: 10px; color: #6b7280;'>どれくらい覚えていましたか？</div>", unsafe_allow_html=True)
+            
+            col1, col2, col3, col4 = st.columns(4)
+            
+            def process_review(quality):
+                # 復習したカードIDを追跡
+                card_id = current_card['id']
+                if "reviewed_card_ids" not in st.session_state:
+                    st.session_state.reviewed_card_ids = []
+                if card_id not in st.session_state.reviewed_card_ids:
+                    st.session_state.reviewed_card_ids.append(card_id)
+                    # 復習済みカード数をインクリメント
+                    st.session_state.reviewed_card_count = st.session_state.get("reviewed_card_count", 0) + 1
+                
+                # 復習したカードのsource_idも追跡（原文復習用）
+                source_id = current_card.get('source_id')
+                if source_id:
+                    if "reviewed_source_ids" not in st.session_state:
+                        st.session_state.reviewed_source_ids = []
+                    if source_id not in st.session_state.reviewed_source_ids:
+                        st.session_state.reviewed_source_ids.append(source_id)
+                
+                new_stats = calculate_next_review(quality, current_card)
+                update_card_progress(user_id, current_card['id'], new_stats)
+                st.session_state.show_answer = False
+                st.session_state.review_action_started = render_started
+                rerun_fragment()
+
+            with col1:
+                if st.button("忘れた (0)", use_container_width=True):
+                    process_review(0)
+            with col2:
+                if st.button("難しい (3)", use_container_width=True):
+                    process_review(3)
+            with col3:
+                if st.button("普通 (4)", use_container_width=True):
+                    process_review(4)
+            with col4:
+                if st.button("簡単 (5)", type="primary", use_container_width=True):
+                    process_review(5)
+    
+    # 答えの表示・評価にかかった時間（ボタンを押した再実行の開始から、結果を表示し終えるまで）
+    action_started = st.session_state.pop("review_action_started", None)
+    if action_started is not None:
+        log_timing("復習の操作", action_started, f"暗記カード {len(cards)} 枚")
+
+# ============ 画面の切り替え ============
+
+MAIN_SECTIONS = ["📚 本日のノルマ", "📝 カードを追加", "🗂️ カード管理"]
+
+# 表示していない間も入力内容を保持するウィジェットのキー（先頭一致）
+SECTION_WIDGET_KEYS = {
+    "📝 カードを追加": ("q_", "a_"),
+    "🗂️ カード管理": ("unified_search", "manage_", "edit_source_")
+}
+
+def keep_hidden_widget_state(active_section):
+    """
+    表示していないセクションのウィジェットの値を保持する
+
+    ウィジェットの値は描画されなかった再実行で破棄されるため、
+    session_stateに値を代入し直して、切り替えて戻ったときに復元されるようにする。
+    """
+    for section, prefixes in SECTION_WIDGET_KEYS.items():
+        if section == active_section:
+            continue
+        for key in list(st.session_state.keys()):
+            if key.startswith(prefixes):
+                st.session_state[key] = st.session_state[key]
+
 # ============ メインアプリ ============
 
 def show_main_app():
     """メインアプリケーションを表示"""
+    rerun_started = time.perf_counter()
     user_id = st.session_state.user_id
     username = st.session_state.get("username", "ユーザー")
     
     # API Key - ユーザーアカウントから読み込み
     user_api_key = get_api_key(user_id)
-    api_key = user_api_key
+    # 未設定の場合は組織のキープールを使う（設定されている場合のみ）
+    api_key = user_api_key or pool_api_key()
     
     # ============ サイドバー（常時展開） ============
     
@@ -481,7 +814,10 @@ def show_main_app():
                         st.success("更新しました！")
                         st.rerun()
         else:
-            st.warning("⚠️ 未設定")
+            if api_key:
+                st.info("🏢 組織のAPIキーを使用中（自分のキーも設定できます）")
+            else:
+                st.warning("⚠️ 未設定")
             new_api_key = st.text_input("Gemini APIキー", type="password", placeholder="AIza...", key="sidebar_set_api_key")
             col1, col2 = st.columns([1, 1])
             with col1:
@@ -523,6 +859,15 @@ def show_main_app():
         if "help_chat_history" not in st.session_state:
             st.session_state.help_chat_history = []
         
+        # バックグラウンドで回答が完了していれば履歴に追加
+        help_job = take_finished_job("help_chat_job")
+        if help_job:
+            if help_job.status == "done":
+                answer = help_job.result
+            else:
+                answer = "⚠️ 回答の取得に失敗しました。しばらく待ってから再度お試しください。"
+            st.session_state.help_chat_history.append({"role": "assistant", "content": answer})
+        
         # チャット履歴表示（大きなコンテナ）
         chat_container = st.container(height=450)
         with chat_container:
@@ -534,6 +879,8 @@ def show_main_app():
                         st.markdown(f"<div class='chat-message user'>🧑 {msg['content']}</div>", unsafe_allow_html=True)
                     else:
                         st.markdown(f"<div class='chat-message assistant'>🤖 {msg['content']}</div>", unsafe_allow_html=True)
+            if "help_chat_job" in st.session_state:
+                show_help_answer_progress()
         
         # 質問入力（フォームで送信）
         with st.form(key="help_chat_form", clear_on_submit=True):
@@ -547,22 +894,31 @@ def show_main_app():
             submitted = st.form_submit_button("送信", use_container_width=True)
             
             if submitted and user_question and user_question.strip():
-                if not api_key:
-                    st.error("APIキーを設定してください")
+                # APIキーがなくてもFAQ・キャッシュで回答できるため、キーの確認はhelp_chat_streamに任せる
+                if "help_chat_job" in st.session_state:
+                    st.warning("回答中です。完了してから送信してください。")
                 else:
-                    st.session_state.help_chat_history.append({"role": "user", "content": user_question})
-                    with st.spinner("回答中..."):
-                        result = help_chat(user_question, api_key, st.session_state.help_chat_history[:-1])
-                    if result["success"]:
-                        st.session_state.help_chat_history.append({"role": "assistant", "content": result["response"]})
-                    else:
-                        st.session_state.help_chat_history.append({"role": "assistant", "content": f"⚠️ {result['error']}"})
-                    st.rerun()
+                    chat_history = list(st.session_state.help_chat_history)
+                    
+                    # 回答はバックグラウンドで受信し、届いた分をjob.partialに追記
+                    def run_help_chat(job):
+                        for text in help_chat_stream(user_question, api_key, chat_history):
+                            job.partial += text
+                        return job.partial
+                    
+                    try:
+                        job = get_job_registry().submit(user_id, "help_chat", run_help_chat)
+                        st.session_state.help_chat_history.append({"role": "user", "content": user_question})
+                        st.session_state.help_chat_job = job.id
+                        st.rerun()
+                    except JobLimitExceeded as e:
+                        st.warning(str(e))
         
         # 履歴クリアボタン（コンパクト）
         if st.session_state.help_chat_history:
             if st.button("🗑️ 履歴クリア", key="clear_chat"):
                 st.session_state.help_chat_history = []
+                st.session_state.pop("help_chat_job", None)
                 st.rerun()
         
         # ログアウトボタン（下部）
@@ -575,195 +931,17 @@ def show_main_app():
     # タイトル
     st.title("🧠 AI 暗記カード")
     
-    # Tab Navigation
-    tab1, tab2, tab3 = st.tabs(["📚 本日のノルマ", "📝 カードを追加", "🗂️ カード管理"])
+    # Navigation（st.tabsは全タブの中身を毎回実行するため、選択中のセクションだけを実行する）
+    section = st.radio("画面", MAIN_SECTIONS, horizontal=True, key="main_section", label_visibility="collapsed")
+    keep_hidden_widget_state(section)
 
     # Review Page
-    with tab1:
+    if section == "📚 本日のノルマ":
         st.title("本日のノルマ")
-        
-        cards = load_cards(user_id)
-        today = datetime.date.today().isoformat()
-        daily_limit = get_daily_quota_limit(user_id)
-        
-        # 日付が変わったらセッションをリセット
-        if st.session_state.get("quota_date") != today:
-            st.session_state.quota_date = today
-            st.session_state.reviewed_source_ids = []
-            st.session_state.reviewed_card_ids = []
-            st.session_state.reviewed_card_count = 0
-            st.session_state.quota_card_ids = None  # その日のノルマカードIDをリセット
-        
-        # 復習済みのcard_idを取得
-        reviewed_card_ids = set(st.session_state.get("reviewed_card_ids", []))
-        
-        # その日のノルマカードIDが未設定なら初回選択
-        if st.session_state.get("quota_card_ids") is None:
-            # Filter cards due for review
-            all_due_cards = [c for c in cards if c['next_review'] <= today]
-            # ハイブリッド選択でノルマカードを決定
-            selected_cards = select_hybrid_quota(all_due_cards, daily_limit, cards)
-            st.session_state.quota_card_ids = [c['id'] for c in selected_cards]
-        
-        # 保存されたノルマカードIDから、まだ復習していないカードを取得
-        quota_card_ids = set(st.session_state.get("quota_card_ids", []))
-        remaining_quota_ids = quota_card_ids - reviewed_card_ids
-        
-        # 復習対象カードのリストを構築（IDベースで）
-        cards_by_id = {c['id']: c for c in cards}
-        due_cards = [cards_by_id[cid] for cid in remaining_quota_ids if cid in cards_by_id]
-        
-        # 期限日が古い順にソート
-        due_cards.sort(key=lambda c: c.get('next_review', '9999-99-99'))
-        
-        # all_due_cardsは表示用に計算
-        all_due_cards = [c for c in cards if c['next_review'] <= today]
-        
-        if not due_cards:
-            st.markdown("""
-            <div style="text-align: center; padding: 50px;">
-                <h2>🎉 本日のノルマ完了！</h2>
-                <p style="color: #6b7280;">今日のノルマは終了しました。お疲れ様でした！</p>
-            </div>
-            """, unsafe_allow_html=True)
-            st.metric("デッキのカード総数", len(cards))
-            if len(all_due_cards) > daily_limit:
-                st.info(f"💡 残り {len(all_due_cards) - daily_limit} 枚のカードが復習待ちです（明日以降）")
-            
-            # ノルマ復習モード（原文カードレビュー）
-            reviewed_source_ids = st.session_state.get("reviewed_source_ids", [])
-            if reviewed_source_ids:
-                st.markdown("---")
-                st.subheader("📖 ノルマ復習（原文確認）")
-                st.markdown("今日復習したカードの原文を確認できます。")
-                
-                # 原文カードを取得
-                source_cards = get_source_cards_by_ids(list(set(reviewed_source_ids)))
-                
-                if source_cards:
-                    # 復習モードのセッション状態
-                    if "source_review_index" not in st.session_state:
-                        st.session_state.source_review_index = 0
-                    
-                    if st.session_state.source_review_index >= len(source_cards):
-                        st.session_state.source_review_index = 0
-                    
-                    current_source = source_cards[st.session_state.source_review_index]
-                    
-                    st.progress(
-                        (st.session_state.source_review_index + 1) / len(source_cards),
-                        text=f"原文 {st.session_state.source_review_index + 1} / {len(source_cards)}"
-                    )
-                    
-                    # 原文表示
-                    st.markdown(f"""
-                    <div class="flashcard">
-                        {f'<div class="flashcard-title">{current_source.get("title", "")}</div>' if current_source.get("title") else ''}
-                        {f'<div class="flashcard-category">{current_source.get("category", "その他")}</div>'}
-                        <div class="flashcard-question" style="font-size: 18px; text-align: left;">{current_source.get("source_text", "")}</div>
-                    </div>
-                    """, unsafe_allow_html=True)
-                    
-                    # ナビゲーション
-                    nav_col1, nav_col2, nav_col3 = st.columns([1, 2, 1])
-                    with nav_col1:
-                        if st.session_state.source_review_index > 0:
-                            if st.button("◀ 前へ", use_container_width=True):
-                                st.session_state.source_review_index -= 1
-                                st.rerun()
-                    with nav_col2:
-                        if st.button("✓ 復習を終了", type="primary", use_container_width=True):
-                            st.session_state.reviewed_source_ids = []
-                            st.session_state.source_review_index = 0
-                            st.rerun()
-                    with nav_col3:
-                        if st.session_state.source_review_index < len(source_cards) - 1:
-                            if st.button("次へ ▶", use_container_width=True):
-                                st.session_state.source_review_index += 1
-                                st.rerun()
-                else:
-                    st.info("原文カードが見つかりませんでした。")
-                    if st.button("クリア"):
-                        st.session_state.reviewed_source_ids = []
-                        st.rerun()
-        else:
-            # 固定されたノルマ数と残り枚数を計算
-            total_quota = len(st.session_state.get("quota_card_ids", []))
-            reviewed_count = st.session_state.get("reviewed_card_count", 0)
-            remaining = len(due_cards)
-            progress = reviewed_count / total_quota if total_quota > 0 else 0
-            st.progress(progress, text=f"本日の進捗: {reviewed_count} / {total_quota} 枚完了（残り {remaining} 枚）")
-            
-            # Current card session state
-            if "current_card_index" not in st.session_state:
-                st.session_state.current_card_index = 0
-                
-            # Ensure index is valid
-            if st.session_state.current_card_index >= len(due_cards):
-                 st.session_state.current_card_index = 0
-                 
-            current_card = due_cards[st.session_state.current_card_index]
-            
-            # Card Display
-            st.markdown(f"""
-            <div class="flashcard">
-                {f'<div class="flashcard-title">{current_card.get("title", "")}</div>' if current_card.get("title") else ''}
-                {f'<div class="flashcard-category">{current_card.get("category", "その他")}</div>'}
-                <div class="flashcard-question">{current_card['question']}</div>
-                {f'<div class="flashcard-answer">{current_card["answer"]}</div>' if st.session_state.get("show_answer", False) else ''}
-            </div>
-            """, unsafe_allow_html=True)
-            
-            # Controls
-            if not st.session_state.get("show_answer", False):
-                col1, col2, col3 = st.columns([1, 2, 1])
-                with col2:
-                    if st.button("答えを見る", type="primary", use_container_width=True):
-                        st.session_state.show_answer = True
-                        st.rerun()
-            else:
-                st.markdown("<div style='text-align: center; margin-bottom: 10px; color: #6b7280;'>どれくらい覚えていましたか？</div>", unsafe_allow_html=True)
-                
-                col1, col2, col3, col4 = st.columns(4)
-                
-                def process_review(quality):
-                    # 復習したカードIDを追跡
-                    card_id = current_card['id']
-                    if "reviewed_card_ids" not in st.session_state:
-                        st.session_state.reviewed_card_ids = []
-                    if card_id not in st.session_state.reviewed_card_ids:
-                        st.session_state.reviewed_card_ids.append(card_id)
-                        # 復習済みカード数をインクリメント
-                        st.session_state.reviewed_card_count = st.session_state.get("reviewed_card_count", 0) + 1
-                    
-                    # 復習したカードのsource_idも追跡（原文復習用）
-                    source_id = current_card.get('source_id')
-                    if source_id:
-                        if "reviewed_source_ids" not in st.session_state:
-                            st.session_state.reviewed_source_ids = []
-                        if source_id not in st.session_state.reviewed_source_ids:
-                            st.session_state.reviewed_source_ids.append(source_id)
-                    
-                    new_stats = calculate_next_review(quality, current_card)
-                    update_card_progress(user_id, current_card['id'], new_stats)
-                    st.session_state.show_answer = False
-                    st.rerun()
-
-                with col1:
-                    if st.button("忘れた (0)", use_container_width=True):
-                        process_review(0)
-                with col2:
-                    if st.button("難しい (3)", use_container_width=True):
-                        process_review(3)
-                with col3:
-                    if st.button("普通 (4)", use_container_width=True):
-                        process_review(4)
-                with col4:
-                    if st.button("簡単 (5)", type="primary", use_container_width=True):
-                        process_review(5)
+        show_review_session(user_id)
 
     # Add Cards Page
-    with tab2:
+    elif section == "📝 カードを追加":
         # 入力フィールドのセッションステート初期化
         if "add_card_category" not in st.session_state:
             st.session_state.add_card_category = ""
@@ -785,8 +963,11 @@ def show_main_app():
             if has_progress:
                 if st.button("🔄 クリア", type="secondary", use_container_width=True):
                     # 全ての関連セッション状態をクリア
+                    discard_suggest_prefetch(api_key)
                     if "phrases" in st.session_state:
                         del st.session_state.phrases
+                    if "phrase_doc" in st.session_state:
+                        del st.session_state.phrase_doc
                     if "selected_indices" in st.session_state:
                         del st.session_state.selected_indices
                     if "generated_cards" in st.session_state:
@@ -843,7 +1024,7 @@ def show_main_app():
         st.session_state.add_card_text = source_text
         
         # インポート
-        from gemini_client import split_into_phrases, suggest_blanks, generate_cards_from_selection, parse_blanks_from_text
+        from gemini_client import split_into_phrases, suggest_blanks, prefetch_suggest_blanks, take_prefetched_suggestion, generate_cards_from_selection, scan_marked_text, PhraseDoc
         
         if manual_mode:
             # 手動モード: 【】マーカーで直接カード生成
@@ -853,7 +1034,12 @@ def show_main_app():
                 elif "【" not in source_text or "】" not in source_text:
                     st.warning("【】で穴埋め箇所を指定してください。例: 民法【709条】は...")
                 else:
-                    cards = parse_blanks_from_text(source_text)
+                    passage = scan_marked_text(source_text)
+                    for error in passage["errors"]:
+                        st.warning(f"【】の指定を確認してください（{error}）")
+                    cards = []
+                    if passage["selected_indices"]:
+                        cards = generate_cards_from_selection(passage["phrases"], passage["selected_indices"])
                     if cards:
                         st.session_state.generated_cards = cards
                         st.success(f"{len(cards)} 枚のカードを生成しました！")
@@ -861,23 +1047,78 @@ def show_main_app():
                         st.error("カードの生成に失敗しました。【】で穴埋め箇所を正しく指定してください。")
         else:
             # AIモード: 文節分割ボタン
-            if st.button("📝 テキストを解析", type="primary"):
+            if "speculative_suggest" not in st.session_state:
+                st.session_state.speculative_suggest = get_preference(user_id, "speculative_suggest", False)
+            speculative_suggest = st.checkbox(
+                "⚡ 解析後すぐにAIの穴埋め提案を先読みする",
+                value=st.session_state.speculative_suggest,
+                key="speculative_suggest_checkbox",
+                help="「AIに提案させる」を押したときにすぐ表示されます（使わなかった場合もAPIの利用回数を消費します）"
+            )
+            if speculative_suggest != st.session_state.speculative_suggest:
+                st.session_state.speculative_suggest = speculative_suggest
+                update_preference(user_id, "speculative_suggest", speculative_suggest)
+            
+            def start_suggest_prefetch(phrase_doc):
+                """分割直後に穴埋め提案をバックグラウンドで先読み"""
+                def run_prefetch(job, doc=phrase_doc):
+                    return doc, prefetch_suggest_blanks(doc, api_key)
+                
+                try:
+                    job = get_job_registry().submit(user_id, "suggest_prefetch", run_prefetch)
+                except JobLimitExceeded:
+                    return
+                st.session_state.suggest_prefetch_job = job.id
+                st.session_state.suggest_prefetch_phrases = phrase_doc.phrases
+            
+            def apply_split_result(phrases):
+                """分割結果を反映"""
+                discard_suggest_prefetch(api_key)
+                # エラーチェック
+                if isinstance(phrases, dict) and phrases.get("error") == "API_QUOTA_EXCEEDED":
+                    st.error(f"⚠️ {phrases.get('message', 'APIの利用制限に達しました。')}")
+                    # オフライン分割の結果があればそれで続行
+                    if phrases.get("fallback_phrases"):
+                        st.session_state.phrases = phrases["fallback_phrases"]
+                        st.session_state.phrase_doc = PhraseDoc(phrases["fallback_phrases"])
+                        st.session_state.selected_indices = []
+                        st.info("オフラインの簡易解析で分割しました。穴埋め箇所を選択してください。")
+                elif phrases:
+                    st.session_state.phrases = phrases
+                    st.session_state.phrase_doc = PhraseDoc(phrases)
+                    st.session_state.selected_indices = []
+                    st.success(f"{len(phrases)}個の文節に分割しました。穴埋め箇所を選択してください。")
+                    if api_key and st.session_state.speculative_suggest:
+                        start_suggest_prefetch(st.session_state.phrase_doc)
+                else:
+                    st.error("テキストの解析に失敗しました。")
+            
+            # バックグラウンドの分割が完了していれば反映
+            split_job = take_finished_job("split_job")
+            if split_job:
+                apply_split_result(split_job.result if split_job.status == "done" else None)
+            
+            if st.button("📝 テキストを解析", type="primary", disabled="split_job" in st.session_state):
                 if not source_text:
                     st.warning("テキストを入力してください。")
                 elif not api_key:
-                    st.warning("APIキーを設定してください。")
+                    # オフライン分割はすぐ終わるのでその場で実行
+                    st.info("APIキーが未設定のため、オフラインの簡易解析で分割します。")
+                    apply_split_result(split_into_phrases(source_text, api_key))
                 else:
-                    with st.spinner("AIがテキストを解析中..."):
-                        phrases = split_into_phrases(source_text, api_key)
-                        # エラーチェック
-                        if isinstance(phrases, dict) and phrases.get("error") == "API_QUOTA_EXCEEDED":
-                            st.error(f"⚠️ {phrases.get('message', 'APIの利用制限に達しました。')}")
-                        elif phrases:
-                            st.session_state.phrases = phrases
-                            st.session_state.selected_indices = []
-                            st.success(f"{len(phrases)}個の文節に分割しました。穴埋め箇所を選択してください。")
-                        else:
-                            st.error("テキストの解析に失敗しました。")
+                    def run_split(job, text=source_text):
+                        return split_into_phrases(
+                            text, api_key,
+                            progress=lambda completed, total: job.set_progress(completed, total, f"{completed}/{total}")
+                        )
+                    
+                    try:
+                        st.session_state.split_job = get_job_registry().submit(user_id, "split", run_split).id
+                    except JobLimitExceeded as e:
+                        st.warning(str(e))
+            
+            if "split_job" in st.session_state:
+                show_job_progress("split_job", "AIがテキストを解析中...")
         
         # ステップ2: 穴埋め箇所を選択
         if "phrases" in st.session_state and st.session_state.phrases:
@@ -885,30 +1126,64 @@ def show_main_app():
             st.markdown("チェックを入れた箇所が穴埋め（______）になります。")
             
             phrases = st.session_state.phrases
+            # 文節の前処理（句読点マスク等）は分割ごとに1回だけ作成して使い回す
+            if "phrase_doc" not in st.session_state:
+                st.session_state.phrase_doc = PhraseDoc(phrases)
+            phrase_doc = st.session_state.phrase_doc
+            
+            # バックグラウンドの提案が完了していれば反映（提案中に分割し直した場合は破棄）
+            suggest_job = take_finished_job("suggest_job")
+            if suggest_job and suggest_job.status == "done" and suggest_job.result[0] is phrase_doc:
+                suggested = suggest_job.result[1]
+                if suggest_job.kind == "suggest_prefetch":
+                    # 実行中の先読みを引き継いだ場合は保存された結果を取り出しておく
+                    take_prefetched_suggestion(phrase_doc, api_key)
+                # エラーチェック
+                if isinstance(suggested, dict) and suggested.get("error") == "API_QUOTA_EXCEEDED":
+                    st.error(f"⚠️ {suggested.get('message', 'APIの利用制限に達しました。')}")
+                else:
+                    st.session_state.selected_indices = suggested
+            elif suggest_job and suggest_job.status == "error":
+                st.error("AIの提案に失敗しました。")
             
             # AIに提案させるボタン
             col1, col2 = st.columns([1, 3])
             with col1:
-                if st.button("🤖 AIに提案させる"):
-                    if api_key:
-                        with st.spinner("AIが提案中..."):
-                            suggested = suggest_blanks(phrases, api_key)
-                            # エラーチェック
-                            if isinstance(suggested, dict) and suggested.get("error") == "API_QUOTA_EXCEEDED":
-                                st.error(f"⚠️ {suggested.get('message', 'APIの利用制限に達しました。')}")
-                            else:
-                                st.session_state.selected_indices = suggested
-                                st.rerun()
+                if st.button("🤖 AIに提案させる", disabled="suggest_job" in st.session_state):
+                    # 先読みがあれば使う（実行中なら完了を待ち、終わっていればすぐ反映）
+                    prefetched = None
+                    prefetch_job = None
+                    if api_key and st.session_state.get("suggest_prefetch_phrases") == phrase_doc.phrases:
+                        prefetch_job = get_job_registry().get(st.session_state.suggest_prefetch_job, user_id)
+                        if prefetch_job is None or prefetch_job.done:
+                            prefetch_job = None
+                            prefetched = take_prefetched_suggestion(phrase_doc, api_key)
+                        st.session_state.pop("suggest_prefetch_phrases", None)
+                        st.session_state.pop("suggest_prefetch_job", None)
+                    
+                    if prefetched is not None:
+                        st.session_state.selected_indices = prefetched
+                        st.rerun()
+                    elif prefetch_job is not None:
+                        st.session_state.suggest_job = prefetch_job.id
+                    elif api_key:
+                        def run_suggest(job, doc=phrase_doc):
+                            return doc, suggest_blanks(doc, api_key)
+                        
+                        try:
+                            st.session_state.suggest_job = get_job_registry().submit(user_id, "suggest", run_suggest).id
+                        except JobLimitExceeded as e:
+                            st.warning(str(e))
                     else:
                         st.warning("APIキーを設定してください。")
+            if "suggest_job" in st.session_state:
+                show_job_progress("suggest_job", "AIが提案中...")
             
             # クリック式ブロックで文節を選択
-            import re
-            punctuation_pattern = r'^[。、，．,.！？!?：:；;\s①②③④⑤⑥⑦⑧⑨⑩⑪⑫⑬⑭⑮⑯⑰⑱⑲⑳]+$'
-            
             # 初期化
             if "selected_indices" not in st.session_state:
                 st.session_state.selected_indices = []
+            selected_set = set(st.session_state.selected_indices)
             
             # クリックでトグルする関数
             def toggle_phrase(idx):
@@ -925,10 +1200,9 @@ def show_main_app():
             phrase_buttons_html = []
             
             for i, phrase in enumerate(phrases):
-                is_punctuation = re.match(punctuation_pattern, phrase)
-                is_selected = i in st.session_state.selected_indices
+                is_selected = i in selected_set
                 
-                if is_punctuation:
+                if phrase_doc.punct_mask[i]:
                     phrase_buttons_html.append(f"<span class='phrase-toggle punct'>{phrase}</span>")
                 elif is_selected:
                     phrase_buttons_html.append(f"<span class='phrase-toggle selected' data-idx='{i}'>{phrase}</span>")
@@ -943,7 +1217,7 @@ def show_main_app():
             
             # 選択可能な文節のみボタン化（句読点以外）
             selectable_phrases = [(i, phrase) for i, phrase in enumerate(phrases) 
-                                  if not re.match(punctuation_pattern, phrase)]
+                                  if not phrase_doc.punct_mask[i]]
             
             # ボタン行を複数作成
             if selectable_phrases:
@@ -954,7 +1228,7 @@ def show_main_app():
                     cols = st.columns(len(row))
                     for col_idx, (phrase_idx, phrase_text) in enumerate(row):
                         with cols[col_idx]:
-                            is_selected = phrase_idx in st.session_state.selected_indices
+                            is_selected = phrase_idx in selected_set
                             btn_label = f"✓ {phrase_text}" if is_selected else phrase_text
                             btn_type = "primary" if is_selected else "secondary"
                             if st.button(btn_label, key=f"toggle_{phrase_idx}", type=btn_type, use_container_width=True):
@@ -968,31 +1242,10 @@ def show_main_app():
             # プレビュー表示（隣接する選択ブロックは1つの穴埋めとして結合）
             if selected:
                 # 隣接する選択を結合してプレビュー生成
-                preview_parts = []
-                answer_groups = []  # 結合された答えのグループ
-                current_answer_group = []
-                
-                for i, phrase in enumerate(phrases):
-                    if i in selected:
-                        # 選択されたブロック
-                        if not current_answer_group:
-                            # 新しい穴埋めグループ開始
-                            preview_parts.append("______")
-                        current_answer_group.append(phrase)
-                    else:
-                        # 選択されていないブロック
-                        if current_answer_group:
-                            # 穴埋めグループ終了
-                            answer_groups.append("".join(current_answer_group))
-                            current_answer_group = []
-                        preview_parts.append(phrase)
-                
-                # 最後のグループを処理
-                if current_answer_group:
-                    answer_groups.append("".join(current_answer_group))
+                preview_question, answer_groups = phrase_doc.render(phrase_doc.merge(selected))
                 
                 st.markdown("**プレビュー:**")
-                st.info(''.join(preview_parts))
+                st.info(preview_question)
                 st.markdown(f"**穴埋め箇所: {len(answer_groups)}個** (隣接ブロックは自動結合)")
                 for idx, ans in enumerate(answer_groups, 1):
                     st.markdown(f"  {idx}. {ans}")
@@ -1002,7 +1255,7 @@ def show_main_app():
                 if not selected:
                     st.warning("穴埋め箇所を1つ以上選択してください。")
                 else:
-                    cards = generate_cards_from_selection(phrases, selected)
+                    cards = generate_cards_from_selection(phrase_doc, selected)
                     if cards:
                         st.session_state.generated_cards = cards
                         st.success(f"{len(cards)} 枚のカードを生成しました！")
@@ -1045,8 +1298,11 @@ def show_main_app():
                         
                         st.success(f"{count} 枚のカードを保存しました！（原文カードも保存済み）")
                         # 全ての工程をクリア
+                        discard_suggest_prefetch(api_key)
                         if "phrases" in st.session_state:
                             del st.session_state.phrases
+                        if "phrase_doc" in st.session_state:
+                            del st.session_state.phrase_doc
                         if "selected_indices" in st.session_state:
                             del st.session_state.selected_indices
                         if "generated_cards" in st.session_state:
@@ -1061,11 +1317,15 @@ def show_main_app():
 
 
     # Manage Cards Page
-    with tab3:
+    elif section == "🗂️ カード管理":
         st.title("🗂️ カード管理")
+        render_started = time.perf_counter()
+        shown_count = 0
         
-        cards = load_cards(user_id)
-        source_cards = load_source_cards(user_id)
+        # カードの読み込み時に作成済みのインデックスを使い、表示する分だけを処理する
+        deck = load_deck(user_id)
+        cards = deck["cards"]
+        source_cards = deck["sources"]
         CATEGORIES = ["民法", "商法", "刑法", "憲法", "行政法", "民事訴訟法", "刑事訴訟法", "その他"]
         
         if not source_cards and not cards:
@@ -1074,150 +1334,181 @@ def show_main_app():
             # 統計表示
             st.markdown(f"**原文カード: {len(source_cards)} 件 / 暗記カード: {len(cards)} 枚**")
             
-            # 検索ボックス
+            # 検索ボックス（入力前に検索インデックスの作成を始めておく）
+            warm_search_index(user_id, deck)
             search_query = st.text_input("🔍 検索", placeholder="原文、問題、答えで検索...", key="unified_search")
             
-            # カテゴリタブ
-            tabs = st.tabs(CATEGORIES)
+            # ページの表示件数（ユーザー設定として保存）
+            if "manage_page_size" not in st.session_state:
+                saved_page_size = get_preference(user_id, "manage_page_size", MANAGE_DEFAULT_PAGE_SIZE)
+                if saved_page_size not in MANAGE_PAGE_SIZE_OPTIONS:
+                    saved_page_size = MANAGE_DEFAULT_PAGE_SIZE
+                st.session_state.manage_page_size = saved_page_size
+            page_size = st.selectbox(
+                "1ページの表示件数", MANAGE_PAGE_SIZE_OPTIONS,
+                index=MANAGE_PAGE_SIZE_OPTIONS.index(st.session_state.manage_page_size),
+                key="manage_page_size_select"
+            )
+            if page_size != st.session_state.manage_page_size:
+                st.session_state.manage_page_size = page_size
+                update_preference(user_id, "manage_page_size", page_size)
             
-            for i, category in enumerate(CATEGORIES):
-                with tabs[i]:
-                    # このカテゴリの原文カードをフィルタ
-                    category_sources = [s for s in source_cards if s.get("category", "その他") == category]
-                    
-                    # 検索フィルタ
-                    if search_query:
-                        category_sources = [s for s in category_sources 
-                                           if search_query.lower() in s.get('source_text', '').lower() 
-                                           or search_query.lower() in s.get('title', '').lower()]
+            # 検索（転置インデックスで一致した原文カード・暗記カードのID、一致回数の多い順）
+            search_results = search_deck(user_id, deck, search_query) if search_query.strip() else None
+            
+            # 検索条件が変わったら先頭ページに戻す
+            if st.session_state.get("manage_last_search") != search_query:
+                st.session_state.manage_last_search = search_query
+                for c in CATEGORIES:
+                    st.session_state.pop(f"manage_page_{c}", None)
+            
+            # カテゴリ選択（st.tabsは全タブの中身を毎回描画するため、選択中のカテゴリだけを描画する）
+            category = st.radio("カテゴリ", CATEGORIES, horizontal=True, key="manage_category", label_visibility="collapsed")
+            
+            if search_results is None:
+                # このカテゴリの原文カードと、原文を持たない孤立した暗記カード
+                category_sources = deck["sources_by_category"].get(category, [])
+                orphan_cards = deck["orphans_by_category"].get(category, [])
+            else:
+                # 検索結果のうちこのカテゴリのもの（一致回数の多い順）
+                category_sources = [deck["sources_by_id"][source_id] for source_id in search_results["sources"]
+                                    if source_id in deck["sources_by_id"]
+                                    and deck["sources_by_id"][source_id].get("category", "その他") == category]
+                orphan_cards = [deck["cards_by_id"][card_id] for card_id in search_results["cards"]
+                                if card_id in deck["cards_by_id"]
+                                and not deck["cards_by_id"][card_id].get("source_id")
+                                and deck["cards_by_id"][card_id].get("category", "その他") == category]
+            
+            if not category_sources and not orphan_cards:
+                st.info(f"{category} のカードはありません。")
+            else:
+                # 表示するページの分だけウィジェットを作成（原文カード → 原文なしの暗記カードの順）
+                page_start, page_end = show_pagination(len(category_sources) + len(orphan_cards), page_size, f"manage_page_{category}")
+                visible_sources = category_sources[page_start:page_end]
+                visible_orphans = orphan_cards[max(0, page_start - len(category_sources)):max(0, page_end - len(category_sources))]
+                shown_count = len(visible_sources) + len(visible_orphans)
+                
+                # 原文カードごとに表示
+                for sc in visible_sources:
+                    source_id = sc['id']
+                    source_title = sc.get('title', '無題')
+                    source_text = sc.get('source_text', '')
                     
-                    # 原文を持たない孤立した暗記カード
-                    orphan_cards = [c for c in cards 
-                                   if c.get("category", "その他") == category 
-                                   and not c.get("source_id")]
-                    if search_query:
-                        orphan_cards = [c for c in orphan_cards
-                                       if search_query.lower() in c['question'].lower()
-                                       or search_query.lower() in c['answer'].lower()]
+                    # この原文に紐づく暗記カード
+                    linked_cards = deck["cards_by_source"].get(source_id, [])
                     
-                    if not category_sources and not orphan_cards:
-                        st.info(f"{category} のカードはありません。")
-                    else:
-                        # 原文カードごとに表示
-                        for sc in category_sources:
-                            source_id = sc['id']
-                            source_title = sc.get('title', '無題')
-                            source_text = sc.get('source_text', '')
-                            
-                            # この原文に紐づく暗記カード
-                            linked_cards = [c for c in cards if c.get('source_id') == source_id]
+                    # Expander: 原文カード（紐づきカード数も表示）
+                    with st.expander(f"📄 {source_title}（暗記カード {len(linked_cards)} 枚）", expanded=False):
+                        
+                        # 原文表示・編集
+                        st.markdown("**📝 原文**")
+                        edited_source = st.text_area(
+                            "", value=source_text, height=120, 
+                            key=f"edit_source_{source_id}"
+                        )
+                        
+                        # 原文が変更されたか検出
+                        source_modified = edited_source != source_text
+                        
+                        # 紐づき暗記カード
+                        if linked_cards:
+                            st.markdown("---")
+                            st.markdown("**🎴 紐づき暗記カード**")
                             
-                            # Expander: 原文カード（紐づきカード数も表示）
-                            with st.expander(f"📄 {source_title}（暗記カード {len(linked_cards)} 枚）", expanded=False):
-                                
-                                # 原文表示・編集
-                                st.markdown("**📝 原文**")
-                                edited_source = st.text_area(
-                                    "", value=source_text, height=120, 
-                                    key=f"edit_source_{source_id}"
-                                )
-                                
-                                # 原文が変更されたか検出
-                                source_modified = edited_source != source_text
-                                
-                                # 紐づき暗記カード
-                                if linked_cards:
-                                    st.markdown("---")
-                                    st.markdown("**🎴 紐づき暗記カード**")
-                                    
-                                    cards_modified = False
-                                    for j, card in enumerate(linked_cards):
-                                        col1, col2, col3 = st.columns([5, 5, 1])
-                                        with col1:
-                                            new_q = st.text_input(f"問題 {j+1}", value=card['question'], key=f"q_{card['id']}")
-                                        with col2:
-                                            new_a = st.text_input(f"答え {j+1}", value=card['answer'], key=f"a_{card['id']}")
-                                        with col3:
-                                            st.markdown("")  # スペーサー
-                                            if st.button("🗑️", key=f"del_single_{card['id']}", help="このカードのみ削除"):
-                                                delete_card(user_id, card['id'])
-                                                st.success("カードを削除しました")
-                                                st.rerun()
-                                        
-                                        if new_q != card['question'] or new_a != card['answer']:
-                                            cards_modified = True
-                                    
-                                    # 警告: 原文が変更されているのに暗記カードが変更されていない
-                                    if source_modified and not cards_modified:
-                                        st.warning("⚠️ 原文が変更されていますが、暗記カードが更新されていません。")
-                                
-                                # 操作ボタン
-                                st.markdown("---")
-                                btn_col1, btn_col2, btn_col3 = st.columns([1, 1, 2])
-                                
-                                with btn_col1:
-                                    if st.button("💾 保存", key=f"save_source_{source_id}", type="primary"):
-                                        # 原文更新（簡易実装：削除→再作成はせず、今回はそのまま）
-                                        # TODO: update_source_card関数が必要な場合は追加
-                                        
-                                        # 暗記カード更新
-                                        updated_count = 0
-                                        for card in linked_cards:
-                                            new_q = st.session_state.get(f"q_{card['id']}", card['question'])
-                                            new_a = st.session_state.get(f"a_{card['id']}", card['answer'])
-                                            if new_q != card['question'] or new_a != card['answer']:
-                                                update_card_content(user_id, card['id'], new_q, new_a, card.get('title', ''), card.get('category', 'その他'))
-                                                updated_count += 1
-                                        
-                                        if updated_count > 0:
-                                            st.success(f"✅ {updated_count}枚のカードを更新しました")
-                                        else:
-                                            st.info("変更はありませんでした")
+                            cards_modified = False
+                            for j, card in enumerate(linked_cards):
+                                col1, col2, col3 = st.columns([5, 5, 1])
+                                with col1:
+                                    new_q = st.text_input(f"問題 {j+1}", value=card['question'], key=f"manage_q_{card['id']}")
+                                with col2:
+                                    new_a = st.text_input(f"答え {j+1}", value=card['answer'], key=f"manage_a_{card['id']}")
+                                with col3:
+                                    st.markdown("")  # スペーサー
+                                    if st.button("🗑️", key=f"del_single_{card['id']}", help="このカードのみ削除"):
+                                        delete_card(user_id, card['id'])
+                                        st.success("カードを削除しました")
                                         st.rerun()
                                 
-                                with btn_col2:
-                                    if st.button("🗑️ 全削除", key=f"del_all_{source_id}"):
-                                        st.session_state[f"confirm_del_all_{source_id}"] = True
+                                if new_q != card['question'] or new_a != card['answer']:
+                                    cards_modified = True
+                            
+                            # 警告: 原文が変更されているのに暗記カードが変更されていない
+                            if source_modified and not cards_modified:
+                                st.warning("⚠️ 原文が変更されていますが、暗記カードが更新されていません。")
+                        
+                        # 操作ボタン
+                        st.markdown("---")
+                        btn_col1, btn_col2, btn_col3 = st.columns([1, 1, 2])
+                        
+                        with btn_col1:
+                            if st.button("💾 保存", key=f"save_source_{source_id}", type="primary"):
+                                # 原文更新（簡易実装：削除→再作成はせず、今回はそのまま）
+                                # TODO: update_source_card関数が必要な場合は追加
+                                
+                                # 暗記カード更新
+                                updated_count = 0
+                                for card in linked_cards:
+                                    new_q = st.session_state.get(f"manage_q_{card['id']}", card['question'])
+                                    new_a = st.session_state.get(f"manage_a_{card['id']}", card['answer'])
+                                    if new_q != card['question'] or new_a != card['answer']:
+                                        update_card_content(user_id, card['id'], new_q, new_a, card.get('title', ''), card.get('category', 'その他'))
+                                        updated_count += 1
                                 
-                                if st.session_state.get(f"confirm_del_all_{source_id}", False):
-                                    st.warning("⚠️ この原文カードと紐づく暗記カードを全て削除しますか？")
-                                    c1, c2, c3 = st.columns([1, 1, 3])
-                                    with c1:
-                                        if st.button("✓ 削除", key=f"yes_del_all_{source_id}", type="primary"):
-                                            # 暗記カード削除
-                                            for card in linked_cards:
-                                                delete_card(user_id, card['id'])
-                                            # 原文カード削除
-                                            delete_source_card(user_id, source_id)
-                                            del st.session_state[f"confirm_del_all_{source_id}"]
-                                            st.success("削除しました")
-                                            st.rerun()
-                                    with c2:
-                                        if st.button("✗ 戻る", key=f"no_del_all_{source_id}"):
-                                            del st.session_state[f"confirm_del_all_{source_id}"]
-                                            st.rerun()
+                                if updated_count > 0:
+                                    st.success(f"✅ {updated_count}枚のカードを更新しました")
+                                else:
+                                    st.info("変更はありませんでした")
+                                st.rerun()
                         
-                        # 孤立した暗記カード（原文なし）
-                        if orphan_cards:
-                            st.markdown("---")
-                            st.markdown("**� 原文なしの暗記カード**")
-                            
-                            for card in orphan_cards:
-                                with st.expander(f"🎴 {card.get('title', '無題')}: {card['question'][:30]}..."):
-                                    with st.form(key=f"orphan_form_{card['id']}"):
-                                        new_q = st.text_input("問題", value=card['question'])
-                                        new_a = st.text_input("答え", value=card['answer'])
-                                        new_cat = st.selectbox("カテゴリ", CATEGORIES, index=CATEGORIES.index(card.get("category", "その他")))
-                                        
-                                        if st.form_submit_button("✓ 更新"):
-                                            update_card_content(user_id, card['id'], new_q, new_a, card.get('title', ''), new_cat)
-                                            st.success("更新しました")
-                                            st.rerun()
-                                    
-                                    if st.button("🗑️ 削除", key=f"del_orphan_{card['id']}"):
+                        with btn_col2:
+                            if st.button("🗑️ 全削除", key=f"del_all_{source_id}"):
+                                st.session_state[f"confirm_del_all_{source_id}"] = True
+                        
+                        if st.session_state.get(f"confirm_del_all_{source_id}", False):
+                            st.warning("⚠️ この原文カードと紐づく暗記カードを全て削除しますか？")
+                            c1, c2, c3 = st.columns([1, 1, 3])
+                            with c1:
+                                if st.button("✓ 削除", key=f"yes_del_all_{source_id}", type="primary"):
+                                    # 暗記カード削除
+                                    for card in linked_cards:
                                         delete_card(user_id, card['id'])
-                                        st.success("削除しました")
-                                        st.rerun()
+                                    # 原文カード削除
+                                    delete_source_card(user_id, source_id)
+                                    del st.session_state[f"confirm_del_all_{source_id}"]
+                                    st.success("削除しました")
+                                    st.rerun()
+                            with c2:
+                                if st.button("✗ 戻る", key=f"no_del_all_{source_id}"):
+                                    del st.session_state[f"confirm_del_all_{source_id}"]
+                                    st.rerun()
+                
+                # 孤立した暗記カード（原文なし）
+                if visible_orphans:
+                    st.markdown("---")
+                    st.markdown("**� 原文なしの暗記カード**")
+                    
+                    for card in visible_orphans:
+                        with st.expander(f"🎴 {card.get('title', '無題')}: {card['question'][:30]}..."):
+                            with st.form(key=f"orphan_form_{card['id']}"):
+                                new_q = st.text_input("問題", value=card['question'])
+                                new_a = st.text_input("答え", value=card['answer'])
+                                new_cat = st.selectbox("カテゴリ", CATEGORIES, index=CATEGORIES.index(card.get("category", "その他")))
+                                
+                                if st.form_submit_button("✓ 更新"):
+                                    update_card_content(user_id, card['id'], new_q, new_a, card.get('title', ''), new_cat)
+                                    st.success("更新しました")
+                                    st.rerun()
+                            
+                            if st.button("🗑️ 削除", key=f"del_orphan_{card['id']}"):
+                                delete_card(user_id, card['id'])
+                                st.success("削除しました")
+                                st.rerun()
+        
+        # 描画時間（カード数に対する再実行の重さの目安）
+        log_timing("カード管理の描画", render_started, f"原文カード {len(source_cards)} 件 / 暗記カード {len(cards)} 枚のうち {shown_count} 件を表示")
+    
+    # 再実行の時間（表示中のセクションの分だけ処理しているかの目安）
+    log_timing("再実行", rerun_started, section)
 
 # ============ アプリケーション実行 ============
 
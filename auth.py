@@ -2,16 +2,38 @@
 認証モジュール - Supabase版
 ユーザー登録、ログイン、セッション管理
 """
-import hashlib
+import threading
+import time
 import uuid
+from collections import OrderedDict
 from datetime import datetime, timedelta, timezone
 from database import get_supabase
+from password_hasher import hash_password, verify_password, PasswordHasherBusy
 
 SESSION_EXPIRY_DAYS = 30
+PASSWORD_BUSY_MESSAGE = "ログインが集中しています。しばらくしてから再度お試しください"
 
-def hash_password(password):
-    """パスワードをSHA-256でハッシュ化"""
-    return hashlib.sha256(password.encode()).hexdigest()
+# 期限切れセッションの掃除
+SESSION_SWEEP_INTERVAL = 3600  # バックグラウンドで掃除する間隔（秒）
+SESSION_SWEEP_BATCH_SIZE = 100  # 1回のdeleteで消す件数（トークンをURLに並べるため、100件で約4KBに抑える）
+SESSION_SWEEP_MAX_BATCHES = 100  # 1回の掃除で実行するdeleteの上限
+
+# スライディング有効期限（アクセスがあるたびに有効期限を延長する）
+SESSION_SLIDING_EXPIRY = False
+SESSION_TOUCH_INTERVAL = 24 * 3600  # 有効期限の延長を書き込む最短間隔（秒）
+
+# セッショントークン検証キャッシュ
+SESSION_CACHE_TTL = 300  # 検証済みトークンを再確認せずに使う秒数
+SESSION_CACHE_NEGATIVE_TTL = 60  # 存在しない・期限切れのトークンを覚えておく秒数
+SESSION_CACHE_MAX_ENTRIES = 10000
+
+def normalize_username(username):
+    """ユーザー名の照合用キー（username_lowerカラムの値、大文字小文字を区別しない）"""
+    return username.lower()
+
+def _is_unique_violation(e):
+    """一意制約違反（PostgreSQLのエラーコード23505）かどうか"""
+    return getattr(e, "code", None) == "23505" or "duplicate key" in str(e).lower()
 
 def generate_session_token():
     """ランダムなセッショントークンを生成"""
@@ -37,20 +59,27 @@ def register_user(username, password, api_key=""):
     
     supabase = get_supabase()
     
-    # ユーザー名の重複チェック
-    existing = supabase.table("users").select("id").ilike("username", username).execute()
-    if existing.data:
-        return False, "このユーザー名は既に使用されています", None
+    try:
+        password_hash = hash_password(password)
+    except PasswordHasherBusy:
+        return False, PASSWORD_BUSY_MESSAGE, None
     
-    # 新規ユーザー作成
-    result = supabase.table("users").insert({
-        "username": username,
-        "password_hash": hash_password(password),
-        "api_key": api_key
-    }).execute()
+    # 新規ユーザー作成（重複はusername_lowerの一意制約で検出）
+    try:
+        result = supabase.table("users").insert({
+            "username": username,
+            "username_lower": normalize_username(username),
+            "password_hash": password_hash,
+            "api_key": api_key
+        }).execute()
+    except Exception as e:
+        if _is_unique_violation(e):
+            return False, "このユーザー名は既に使用されています", None
+        raise
     
     if result.data:
         user_id = result.data[0]["id"]
+        _cache_profile(UserProfile.from_row(result.data[0]))
         return True, "ユーザー登録が完了しました", user_id
     
     return False, "登録に失敗しました", None
@@ -66,77 +95,260 @@ def authenticate_user(username, password):
         return False, "ユーザー名とパスワードを入力してください", None
     
     supabase = get_supabase()
-    password_hash = hash_password(password)
     
-    result = supabase.table("users").select("id, password_hash").ilike("username", username).execute()
+    # プロファイルも同じクエリで読み込んでおく
+    result = _select_profile("username_lower", normalize_username(username), ", password_hash")
     
     if not result.data:
         return False, "ユーザーが見つかりません", None
     
     user = result.data[0]
-    if user["password_hash"] == password_hash:
+    try:
+        ok, needs_rehash = verify_password(password, user["password_hash"])
+    except PasswordHasherBusy:
+        return False, PASSWORD_BUSY_MESSAGE, None
+    if ok:
+        if needs_rehash:
+            # 旧形式（SHA-256）・コスト変更前のハッシュを現在の設定で置き換える
+            try:
+                supabase.table("users").update({"password_hash": hash_password(password)}).eq("id", user["id"]).execute()
+            except Exception as e:
+                print(f"パスワード再ハッシュエラー: {e}")
+        _cache_profile(UserProfile.from_row(user))
         return True, "ログイン成功", user["id"]
     else:
         return False, "パスワードが正しくありません", None
 
-def get_username(user_id):
-    """ユーザーIDからユーザー名を取得（セッションキャッシュ付き）"""
-    import streamlit as st
-    cache_key = f"username_{user_id}"
-    if cache_key in st.session_state:
-        return st.session_state[cache_key]
+# ============ ユーザープロファイル ============
+
+DEFAULT_DAILY_QUOTA = 15
+USER_PROFILE_CACHE_TTL = 300  # プロセス内キャッシュの有効期間（秒）
+PROFILE_COLUMNS_RECHECK_INTERVAL = 300  # daily_quota_limit / preferences がないと判定してから再確認するまでの秒数
+_BASE_PROFILE_COLUMNS = "id, username, api_key"
+_OPTIONAL_PROFILE_FIELDS = ("daily_quota_limit", "preferences")  # マイグレーション前のデータベースにはないカラム
+_PROFILE_COLUMNS = f"{_BASE_PROFILE_COLUMNS}, {', '.join(_OPTIONAL_PROFILE_FIELDS)}"
+
+class UserProfile:
+    """ログイン中のユーザーの設定（ユーザー名・APIキー・ノルマ・表示設定）"""
+    
+    def __init__(self, user_id, username, api_key="", daily_quota_limit=DEFAULT_DAILY_QUOTA, preferences=None):
+        self.user_id = user_id
+        self.username = username
+        self.api_key = api_key or ""
+        self.daily_quota_limit = daily_quota_limit or DEFAULT_DAILY_QUOTA
+        self.preferences = preferences or {}
+    
+    @classmethod
+    def from_row(cls, row):
+        """usersテーブルの行から作成（カラムがない場合はプロセス内に保存した値を使う）"""
+        local = _local_profile_fields.get(row["id"], {})
+        return cls(
+            row["id"],
+            row.get("username"),
+            row.get("api_key", ""),
+            row.get("daily_quota_limit", local.get("daily_quota_limit")),
+            row.get("preferences", local.get("preferences"))
+        )
+
+_profile_cache = {}  # ユーザーID → (UserProfile, 保存時刻)
+_profile_cache_lock = threading.Lock()
+_profile_columns_missing_at = None  # usersテーブルに daily_quota_limit / preferences がないと判定した時刻
+_local_profile_fields = {}  # ユーザーID → {カラム名: 値}（カラムがない場合の保存先、再起動で初期値に戻る）
+
+def _is_missing_profile_column(e):
+    """
+    daily_quota_limit / preferences が存在しないエラー（PostgreSQLのエラーコード42703）かどうか
     
+    username_lower など他のカラムがない場合は対象外（プロファイルのカラムを外しても解決しない）。
+    """
+    message = str(e)
+    if getattr(e, "code", None) != "42703" and "does not exist" not in message:
+        return False
+    return any(name in message for name in _OPTIONAL_PROFILE_FIELDS)
+
+def _profile_columns_missing():
+    """daily_quota_limit / preferences がないと判定済みか（マイグレーション後は再確認の時点で元に戻る）"""
+    return (_profile_columns_missing_at is not None
+            and time.time() - _profile_columns_missing_at < PROFILE_COLUMNS_RECHECK_INTERVAL)
+
+def _mark_profile_columns_missing():
+    global _profile_columns_missing_at
+    if _profile_columns_missing_at is None:
+        print("usersテーブルに daily_quota_limit / preferences カラムがありません（README.md のマイグレーションを実行してください）")
+    _profile_columns_missing_at = time.time()
+
+def _select_profile(column, value, extra_columns=""):
+    """
+    プロファイルのカラムでusersテーブルを検索
+    
+    マイグレーション前のデータベースでは daily_quota_limit / preferences を除いて読み込む。
+    """
     supabase = get_supabase()
-    result = supabase.table("users").select("username").eq("id", user_id).execute()
-    if result.data:
-        username = result.data[0]["username"]
-        st.session_state[cache_key] = username
-        return username
-    return None
+    if not _profile_columns_missing():
+        try:
+            return supabase.table("users").select(_PROFILE_COLUMNS + extra_columns).eq(column, value).execute()
+        except Exception as e:
+            if not _is_missing_profile_column(e):
+                raise
+            _mark_profile_columns_missing()
+    return supabase.table("users").select(_BASE_PROFILE_COLUMNS + extra_columns).eq(column, value).execute()
 
-def get_api_key(user_id):
-    """ユーザーIDからAPIキーを取得（セッションキャッシュ付き）"""
-    import streamlit as st
-    cache_key = f"api_key_{user_id}"
-    if cache_key in st.session_state:
-        return st.session_state[cache_key]
+def _session_profiles():
+    """セッションごとのプロファイルキャッシュ（Streamlit外ではNone）"""
+    try:
+        import streamlit as st
+        return st.session_state.setdefault("user_profiles", {})
+    except Exception:
+        return None
+
+def _cache_profile(profile):
+    """プロセス内・セッションのキャッシュに保存"""
+    with _profile_cache_lock:
+        _profile_cache[profile.user_id] = (profile, time.time())
+    profiles = _session_profiles()
+    if profiles is not None:
+        profiles[profile.user_id] = profile
+
+def load_user_profile(user_id):
+    """
+    ユーザープロファイルを取得
+    
+    セッション → プロセス内キャッシュ → データベース（1回のクエリ）の順に探す。
+    認証時（ログイン・登録・セッション検証）に読み込んだ行でキャッシュ済みのため、
+    通常はログイン後の最初の描画でもデータベースに問い合わせない。
+    
+    Returns:
+        UserProfile or None
+    """
+    profiles = _session_profiles()
+    if profiles is not None and user_id in profiles:
+        return profiles[user_id]
+    
+    with _profile_cache_lock:
+        profile, cached_at = _profile_cache.get(user_id, (None, 0))
+    if profile is None or time.time() - cached_at >= USER_PROFILE_CACHE_TTL:
+        result = _select_profile("id", user_id)
+        if not result.data:
+            return None
+        profile = UserProfile.from_row(result.data[0])
+    
+    _cache_profile(profile)
+    return profile
+
+def update_user_profile(user_id, **fields):
+    """
+    ユーザープロファイルを更新（api_key / daily_quota_limit / preferences の唯一の書き込み経路）
+    
+    Returns:
+        bool: 更新できたか
+    """
+    if _profile_columns_missing():
+        # カラムがないデータベースではプロセス内にだけ保存する
+        local = {name: fields.pop(name) for name in _OPTIONAL_PROFILE_FIELDS if name in fields}
+        if local:
+            _local_profile_fields.setdefault(user_id, {}).update(local)
+        if not fields:
+            profile = load_user_profile(user_id)
+            if profile is None:
+                return False
+            row = {"id": user_id, "username": profile.username, "api_key": profile.api_key}
+            _cache_profile(UserProfile.from_row(row))
+            return True
     
     supabase = get_supabase()
-    result = supabase.table("users").select("api_key").eq("id", user_id).execute()
-    if result.data:
-        api_key = result.data[0].get("api_key", "")
-        st.session_state[cache_key] = api_key
-        return api_key
-    return ""
+    try:
+        result = supabase.table("users").update(fields).eq("id", user_id).execute()
+    except Exception as e:
+        if _profile_columns_missing() or not _is_missing_profile_column(e):
+            raise
+        _mark_profile_columns_missing()
+        return update_user_profile(user_id, **fields)
+    if not result.data:
+        return False
+    
+    # 更新後の行でキャッシュを置き換える
+    _cache_profile(UserProfile.from_row(result.data[0]))
+    return True
+
+def get_username(user_id):
+    """ユーザーIDからユーザー名を取得"""
+    profile = load_user_profile(user_id)
+    return profile.username if profile else None
+
+def get_api_key(user_id):
+    """ユーザーIDからAPIキーを取得"""
+    profile = load_user_profile(user_id)
+    return profile.api_key if profile else ""
 
 def update_api_key(user_id, api_key):
     """ユーザーのAPIキーを更新"""
-    import streamlit as st
-    supabase = get_supabase()
-    result = supabase.table("users").update({"api_key": api_key}).eq("id", user_id).execute()
-    # キャッシュを更新
-    st.session_state[f"api_key_{user_id}"] = api_key
-    return bool(result.data)
+    return update_user_profile(user_id, api_key=api_key)
 
-# ============ ノルマ設定 ============
+def get_preference(user_id, name, default=None):
+    """ユーザーの表示設定を取得"""
+    profile = load_user_profile(user_id)
+    return profile.preferences.get(name, default) if profile else default
 
-DEFAULT_DAILY_QUOTA = 15
+def update_preference(user_id, name, value):
+    """ユーザーの表示設定を更新"""
+    profile = load_user_profile(user_id)
+    preferences = dict(profile.preferences) if profile else {}
+    preferences[name] = value
+    return update_user_profile(user_id, preferences=preferences)
+
+# ============ ノルマ設定 ============
 
 def get_daily_quota_limit(user_id):
-    """ユーザーの1日のノルマ上限を取得（セッションキャッシュ）"""
-    import streamlit as st
-    cache_key = f"daily_quota_{user_id}"
-    if cache_key in st.session_state:
-        return st.session_state[cache_key]
-    # デフォルト値を返す（DBにカラムがない場合のフォールバック）
-    st.session_state[cache_key] = DEFAULT_DAILY_QUOTA
-    return DEFAULT_DAILY_QUOTA
+    """ユーザーの1日のノルマ上限を取得"""
+    profile = load_user_profile(user_id)
+    return profile.daily_quota_limit if profile else DEFAULT_DAILY_QUOTA
 
 def update_daily_quota_limit(user_id, limit):
-    """ユーザーの1日のノルマ上限を更新（セッションキャッシュのみ）"""
-    import streamlit as st
-    st.session_state[f"daily_quota_{user_id}"] = limit
-    return True
+    """ユーザーの1日のノルマ上限を更新（データベースに保存）"""
+    return update_user_profile(user_id, daily_quota_limit=limit)
+
+# ============ セッショントークン検証キャッシュ ============
+
+_session_cache = OrderedDict()  # トークン → (セッション情報 or None, キャッシュの有効期限)
+_session_cache_lock = threading.Lock()
+_session_cache_metrics = {"hits": 0, "negative_hits": 0, "misses": 0}
+
+def _session_cache_get(token):
+    """
+    キャッシュされた検証結果を返す
+
+    Returns:
+        tuple: (キャッシュにあるか, セッション情報 or None)
+    """
+    now = time.monotonic()
+    with _session_cache_lock:
+        entry = _session_cache.get(token)
+        if entry is None or now >= entry[1]:
+            _session_cache.pop(token, None)
+            _session_cache_metrics["misses"] += 1
+            return False, None
+        _session_cache.move_to_end(token)
+        _session_cache_metrics["hits" if entry[0] else "negative_hits"] += 1
+        return True, entry[0]
+
+def _session_cache_put(token, session, ttl):
+    """検証結果を保存（上限を超えたら古いものから削除）"""
+    with _session_cache_lock:
+        _session_cache[token] = (session, time.monotonic() + ttl)
+        _session_cache.move_to_end(token)
+        while len(_session_cache) > SESSION_CACHE_MAX_ENTRIES:
+            _session_cache.popitem(last=False)
+
+def _session_cache_evict(token):
+    with _session_cache_lock:
+        _session_cache.pop(token, None)
+
+def get_session_cache_metrics():
+    """セッション検証キャッシュのメトリクス"""
+    with _session_cache_lock:
+        metrics = dict(_session_cache_metrics)
+        metrics["entries"] = len(_session_cache)
+    return metrics
 
 # ============ セッション管理 ============
 
@@ -149,6 +361,7 @@ def create_session(user_id):
     """
     supabase = get_supabase()
     token = generate_session_token()
+    _session_cache_evict(token)
     
     # 有効期限を設定（現在時刻 + 30日）
     expires_at = datetime.now(timezone.utc) + timedelta(days=SESSION_EXPIRY_DAYS)
@@ -161,44 +374,130 @@ def create_session(user_id):
     
     return token
 
-def validate_session_token(token):
+def validate_session(token):
     """
-    セッショントークンを検証
+    セッショントークンを検証（プロセス内キャッシュ付き）
+    
+    検証済みのトークンはSESSION_CACHE_TTL秒、存在しない・期限切れのトークンは
+    SESSION_CACHE_NEGATIVE_TTL秒のあいだデータベースに問い合わせずに判定する。
     
     Returns:
-        str or None: 有効な場合はuser_id、無効な場合はNone
+        dict or None: 有効な場合は {"user_id", "username", "expires_at"}、無効な場合はNone
     """
     if not token:
         return None
     
+    found, session = _session_cache_get(token)
+    if found and (session is None or datetime.now(timezone.utc) <= session["expires_at"]):
+        if session is not None and SESSION_SLIDING_EXPIRY:
+            _touch_session(token, session)
+        return session
+    
     supabase = get_supabase()
     
     result = supabase.table("sessions").select("user_id, expires_at").eq("token", token).execute()
     
     if not result.data:
+        _session_cache_put(token, None, SESSION_CACHE_NEGATIVE_TTL)
         return None
     
-    session = result.data[0]
-    expires_at = datetime.fromisoformat(session["expires_at"].replace("Z", "+00:00"))
+    row = result.data[0]
+    expires_at = datetime.fromisoformat(row["expires_at"].replace("Z", "+00:00"))
     
-    # 有効期限チェック
+    # 有効期限チェック（期限切れの行はバックグラウンドの掃除でまとめて削除）
     if datetime.now(timezone.utc) > expires_at:
-        # 期限切れセッションを削除
-        supabase.table("sessions").delete().eq("token", token).execute()
+        _session_cache_put(token, None, SESSION_CACHE_NEGATIVE_TTL)
         return None
     
-    return session["user_id"]
+    profile = load_user_profile(row["user_id"])
+    session = {
+        "user_id": row["user_id"],
+        "username": profile.username if profile else None,
+        "expires_at": expires_at
+    }
+    if SESSION_SLIDING_EXPIRY:
+        _touch_session(token, session)
+    _session_cache_put(token, session, SESSION_CACHE_TTL)
+    return session
+
+def _touch_session(token, session):
+    """
+    スライディング有効期限: 有効期限を現在時刻 + SESSION_EXPIRY_DAYS に延長
+    
+    最後の延長（= 有効期限 - SESSION_EXPIRY_DAYS）からSESSION_TOUCH_INTERVAL以上たった場合のみ
+    書き込むため、ページを読み込むたびに書き込みが発生することはない。
+    """
+    now = datetime.now(timezone.utc)
+    last_touched = session["expires_at"] - timedelta(days=SESSION_EXPIRY_DAYS)
+    if (now - last_touched).total_seconds() < SESSION_TOUCH_INTERVAL:
+        return
+    
+    expires_at = now + timedelta(days=SESSION_EXPIRY_DAYS)
+    try:
+        get_supabase().table("sessions").update({"expires_at": expires_at.isoformat()}).eq("token", token).execute()
+        session["expires_at"] = expires_at
+    except Exception as e:
+        print(f"セッション延長エラー: {e}")
+
+def validate_session_token(token):
+    """
+    セッショントークンを検証
+    
+    Returns:
+        str or None: 有効な場合はuser_id、無効な場合はNone
+    """
+    session = validate_session(token)
+    return session["user_id"] if session else None
 
 def delete_session(token):
-    """セッションを削除（ログアウト用）"""
+    """セッションを削除（ログアウト用、キャッシュからも即座に削除）"""
     if not token:
         return
     
+    _session_cache_evict(token)
     supabase = get_supabase()
     supabase.table("sessions").delete().eq("token", token).execute()
 
-def cleanup_expired_sessions():
-    """期限切れのセッションを削除"""
+def cleanup_expired_sessions(batch_size=SESSION_SWEEP_BATCH_SIZE, max_batches=SESSION_SWEEP_MAX_BATCHES):
+    """
+    期限切れのセッションを削除（batch_size件ずつ、最大max_batches回）
+    
+    Returns:
+        int: 削除した件数
+    """
     supabase = get_supabase()
     now = datetime.now(timezone.utc).isoformat()
-    supabase.table("sessions").delete().lt("expires_at", now).execute()
+    deleted = 0
+    for _ in range(max_batches):
+        result = supabase.table("sessions").select("token").lt("expires_at", now).limit(batch_size).execute()
+        tokens = [row["token"] for row in result.data or []]
+        if not tokens:
+            break
+        supabase.table("sessions").delete().in_("token", tokens).execute()
+        deleted += len(tokens)
+        if len(tokens) < batch_size:
+            break
+    return deleted
+
+_session_sweeper = None
+_session_sweeper_lock = threading.Lock()
+
+def _sweep_sessions_forever(interval):
+    while True:
+        try:
+            deleted = cleanup_expired_sessions()
+            if deleted:
+                print(f"期限切れセッションを削除: {deleted}件")
+        except Exception as e:
+            print(f"セッション掃除エラー: {e}")
+        time.sleep(interval)
+
+def start_session_sweeper(interval=SESSION_SWEEP_INTERVAL):
+    """期限切れセッションを定期的に削除するバックグラウンドスレッドを開始（プロセスで1回のみ）"""
+    global _session_sweeper
+    with _session_sweeper_lock:
+        if _session_sweeper is None:
+            _session_sweeper = threading.Thread(
+                target=_sweep_sessions_forever, args=(interval,), name="session-sweeper", daemon=True
+            )
+            _session_sweeper.start()
@@ -0,0 +1,200 @@
+"""
+描画時間の計測スクリプト
+合成したデッキ（原文カード・暗記カード）をメモリ上のデータベースに用意し、
+streamlit.testing.v1.AppTest で app.py を実行して、操作ごとの再実行の時間を計る。
+
+Supabaseには接続しない（database のクライアントをメモリ上の実装に置き換える）。
+
+使い方:
+    python benchmark_app.py
+    python benchmark_app.py --cards 1000 10000 --repeat 10
+"""
+import argparse
+import itertools
+import os
+import statistics
+import time
+from datetime import date
+from types import SimpleNamespace
+
+import database
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "app.py")
+CATEGORIES = ["民法", "商法", "刑法", "憲法", "行政法", "民事訴訟法", "刑事訴訟法", "その他"]
+CARDS_PER_SOURCE = 4
+
+# ============ メモリ上のデータベース ============
+
+class MemoryQuery:
+    """supabase-py のクエリのうちアプリが使う分（select / insert / update / delete と eq / in_ / lt / limit）"""
+
+    def __init__(self, rows, ids):
+        self._rows = rows
+        self._ids = ids
+        self._action = "select"
+        self._payload = None
+        self._filters = []
+        self._limit = None
+
+    def select(self, columns="*"):
+        self._action = "select"
+        return self
+
+    def insert(self, payload):
+        self._action, self._payload = "insert", payload
+        return self
+
+    def update(self, payload):
+        self._action, self._payload = "update", payload
+        return self
+
+    def delete(self):
+        self._action = "delete"
+        return self
+
+    def eq(self, column, value):
+        self._filters.append(lambda row: row.get(column) == value)
+        return self
+
+    def in_(self, column, values):
+        values = set(values)
+        self._filters.append(lambda row: row.get(column) in values)
+        return self
+
+    def lt(self, column, value):
+        self._filters.append(lambda row: row.get(column) is not None and row.get(column) < value)
+        return self
+
+    def limit(self, count):
+        self._limit = count
+        return self
+
+    def execute(self):
+        if self._action == "insert":
+            payload = self._payload if isinstance(self._payload, list) else [self._payload]
+            inserted = [dict(row, id=row.get("id") or next(self._ids)) for row in payload]
+            self._rows.extend(inserted)
+            return SimpleNamespace(data=[dict(row) for row in inserted])
+
+        matched = [row for row in self._rows if all(match(row) for match in self._filters)]
+        if self._limit is not None:
+            matched = matched[:self._limit]
+        if self._action == "update":
+            for row in matched:
+                row.update(self._payload)
+        elif self._action == "delete":
+            removed = set(map(id, matched))
+            self._rows[:] = [row for row in self._rows if id(row) not in removed]
+        return SimpleNamespace(data=[dict(row) for row in matched])
+
+class MemorySupabase:
+    """テーブル名 → 行のリスト"""
+
+    def __init__(self):
+        self._tables = {}
+        self._ids = itertools.count(1)
+
+    def table(self, name):
+        return MemoryQuery(self._tables.setdefault(name, []), self._ids)
+
+def make_deck(client, user_id, card_count):
+    """合成デッキを登録（原文カード1件につき暗記カード CARDS_PER_SOURCE 枚、全カードが本日の復習対象）"""
+    client.table("users").insert({
+        "id": user_id, "username": user_id, "username_lower": user_id,
+        "password_hash": "", "api_key": "", "daily_quota_limit": 15, "preferences": {}
+    }).execute()
+
+    today = date.today().isoformat()
+    sources = []
+    for i in range(card_count // CARDS_PER_SOURCE):
+        text = f"第{i}条 契約の当事者は、信義に従い誠実に権利を行使し、義務を履行しなければならない。事例{i}の検討。"
+        sources.append({
+            "user_id": user_id, "title": f"原文 {i}", "source_text": text,
+            "category": CATEGORIES[i % len(CATEGORIES)]
+        })
+    source_rows = client.table("source_cards").insert(sources).execute().data
+
+    cards = []
+    for i in range(card_count):
+        source = source_rows[i // CARDS_PER_SOURCE] if i // CARDS_PER_SOURCE < len(source_rows) else None
+        cards.append({
+            "user_id": user_id,
+            "question": f"契約の当事者は、【　】に従い誠実に権利を行使する（問{i}）",
+            "answer": "信義",
+            "title": source["title"] if source else f"カード {i}",
+            "category": source["category"] if source else CATEGORIES[i % len(CATEGORIES)],
+            "ease_factor": 2.5, "interval": 1, "repetitions": i % 3,
+            "next_review": today, "source_id": source["id"] if source else None, "blank_count": 1
+        })
+    client.table("cards").insert(cards).execute()
+
+# ============ 計測 ============
+
+def timed_run(at, action=None):
+    """操作してから再実行が終わるまでの時間（ミリ秒）"""
+    started = time.perf_counter()
+    (action or at).run()
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    if at.exception:
+        raise RuntimeError(at.exception[0].message)
+    return elapsed_ms
+
+def benchmark_deck(card_count, repeat):
+    """1つのデッキの大きさで各操作を計測（結果は操作名 → 時間のリスト）"""
+    from streamlit.logger import set_log_level
+    from streamlit.testing.v1 import AppTest
+
+    set_log_level("error")
+    # プロセス内のキャッシュ（st.cache_data・検索インデックスなど）はユーザーごとのため、デッキごとに別のユーザーにする
+    user_id = f"benchmark-{card_count}"
+    database._supabase_client = MemorySupabase()
+    make_deck(database._supabase_client, user_id, card_count)
+
+    at = AppTest.from_file(APP_PATH, default_timeout=600)
+    at.session_state["user_id"] = user_id
+    at.session_state["username"] = user_id
+    timings = {}
+
+    def record(name, elapsed_ms):
+        timings.setdefault(name, []).append(elapsed_ms)
+
+    record("初回の描画", timed_run(at))
+
+    for _ in range(repeat):
+        # 本日のノルマ: 答えを表示 → 評価
+        at.radio(key="main_section").set_value("📚 本日のノルマ")
+        timed_run(at)
+        record("答えを見る", timed_run(at, next(b for b in at.button if b.label == "答えを見る").click()))
+        record("評価（普通）", timed_run(at, next(b for b in at.button if b.label == "普通 (4)").click()))
+
+        # 画面の切り替え
+        record("カード管理に切り替え", timed_run(at, at.radio(key="main_section").set_value("🗂️ カード管理")))
+        record("カードを追加に切り替え", timed_run(at, at.radio(key="main_section").set_value("📝 カードを追加")))
+        at.radio(key="main_section").set_value("🗂️ カード管理")
+        timed_run(at)
+
+        # カード管理: カテゴリ・ページの切り替えと検索
+        record("カテゴリの切り替え", timed_run(at, at.radio(key="manage_category").set_value("商法")))
+        page_input = next((n for n in at.number_input if n.key == "manage_page_商法"), None)
+        if page_input is not None:
+            record("次のページ", timed_run(at, page_input.increment()))
+        record("検索", timed_run(at, at.text_input(key="unified_search").input("信義 問1")))
+        at.text_input(key="unified_search").input("")
+        at.radio(key="manage_category").set_value("民法")
+        timed_run(at)
+    return timings
+
+def main():
+    parser = argparse.ArgumentParser(description="合成デッキでapp.pyの再実行時間を計測")
+    parser.add_argument("--cards", type=int, nargs="+", default=[200, 2000, 10000], help="暗記カードの枚数（複数指定可）")
+    parser.add_argument("--repeat", type=int, default=5, help="各操作の繰り返し回数")
+    args = parser.parse_args()
+
+    for card_count in args.cards:
+        timings = benchmark_deck(card_count, args.repeat)
+        print(f"\n暗記カード {card_count} 枚 / 原文カード {card_count // CARDS_PER_SOURCE} 件（中央値 / 最大、ミリ秒）")
+        for name, values in timings.items():
+            print(f"  {name:<16} {statistics.median(values):8.1f} {max(values):8.1f}")
+
+if __name__ == "__main__":
+    main()
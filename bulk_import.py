@@ -0,0 +1,358 @@
+"""
+一括インポートモジュール
+ディレクトリ・大きなテキストファイルから原文カードと暗記カードをまとめて作成
+
+使い方:
+    python bulk_import.py --user-id <ユーザーID> [--category 民法] [--title タイトル] <ファイルまたはディレクトリ>
+
+空行で区切られた段落を1つの原文として扱い、【】を含む段落は手動モード、
+それ以外はAI（文節分割 → 穴埋め提案）でカードを生成する。
+処理済みの段落はチェックポイントに記録され、中断しても続きから再開できる。
+原文カードのIDは暗記カードの保存前に記録するため、途中で失敗しても再開時に原文カードを作り直さない。
+段落はファイルから順に読み、処理中の段落数に上限を設けるため、大きな文書でもメモリ使用量は一定になる。
+"""
+import argparse
+import hashlib
+import json
+import os
+import signal
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from contextlib import contextmanager
+
+from database import get_supabase
+from gemini_client import split_into_phrases, suggest_blanks, generate_cards_from_selection, iter_marked_passages, PhraseDoc, pool_api_key
+from storage import add_source_cards_batch, add_cards_batch
+
+IMPORT_FILE_EXTENSIONS = (".txt", ".md")
+IMPORT_MAX_WORKERS = 4  # 同時に処理する段落数
+IMPORT_BATCH_SIZE = 20  # 1回のinsertにまとめる段落数
+
+# ============ 入力 ============
+
+def _iter_files(path):
+    """
+    入力パスのファイルを順に返す
+
+    Yields:
+        tuple: (ファイルのパス, 相対パス)
+    """
+    if os.path.isdir(path):
+        base_dir = path
+        files = sorted(
+            os.path.join(root, name)
+            for root, _, names in os.walk(path)
+            for name in names
+            if name.endswith(IMPORT_FILE_EXTENSIONS)
+        )
+    else:
+        base_dir = os.path.dirname(path)
+        files = [path]
+
+    for file_path in files:
+        yield file_path, os.path.relpath(file_path, base_dir)
+
+def count_passages(path):
+    """段落数を数える（進捗表示用）"""
+    total = 0
+    for file_path, _ in _iter_files(path):
+        with open(file_path, "r", encoding="utf-8") as f:
+            total += sum(1 for _ in iter_marked_passages(f))
+    return total
+
+def iter_passages(path):
+    """
+    ファイルまたはディレクトリから段落を順に返す（空行区切り、gemini_client.iter_marked_passagesで1行ずつ読む）
+
+    Yields:
+        tuple: (段落キー, ファイルの相対パス, 走査結果（MarkerScanner.resultの形式、本文は"text"）)
+    """
+    for file_path, relative_path in _iter_files(path):
+        with open(file_path, "r", encoding="utf-8") as f:
+            for index, passage in enumerate(iter_marked_passages(f)):
+                digest = hashlib.sha1(passage["text"].encode("utf-8")).hexdigest()[:12]
+                yield f"{relative_path}#{index}:{digest}", relative_path, passage
+
+# ============ チェックポイント ============
+
+def default_checkpoint_path(path):
+    """入力パスの横に置くチェックポイントファイル"""
+    return os.path.abspath(path).rstrip(os.sep) + ".import-checkpoint.jsonl"
+
+def _load_checkpoint(checkpoint_path):
+    """
+    チェックポイントを読み込む
+
+    Returns:
+        tuple: (処理済みの段落キーの集合, {原文カードだけ保存済みの段落キー: 原文カードID})
+    """
+    done = set()
+    saved_sources = {}
+    if not os.path.exists(checkpoint_path):
+        return done, saved_sources
+    with open(checkpoint_path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+                key = entry["key"]
+            except (ValueError, KeyError):
+                # 書き込み途中で中断した行は無視（その段落は再処理）
+                continue
+            if entry.get("stage") == "source":
+                saved_sources[key] = entry["source_id"]
+            else:
+                done.add(key)
+    for key in done:
+        saved_sources.pop(key, None)
+    return done, saved_sources
+
+def _append_checkpoint(checkpoint_path, entries):
+    """処理済みの段落を追記してディスクに書き出す"""
+    with open(checkpoint_path, "a", encoding="utf-8") as f:
+        for entry in entries:
+            f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+@contextmanager
+def _defer_interrupt():
+    """
+    保存とチェックポイントへの記録の間はCtrl-Cを遅らせる
+    （保存したのに記録されず、再開時にもう一度保存される状態を防ぐ。メインスレッド以外では何もしない）
+    """
+    if threading.current_thread() is not threading.main_thread():
+        yield
+        return
+    received = []
+    previous = signal.signal(signal.SIGINT, lambda signum, frame: received.append(signum))
+    try:
+        yield
+    finally:
+        signal.signal(signal.SIGINT, previous)
+    if received:
+        raise KeyboardInterrupt
+
+# ============ カード生成 ============
+
+def is_marked(text):
+    """【】を含む段落（手動モード）か"""
+    return "【" in text or "】" in text
+
+def process_passage(passage, api_key):
+    """
+    1段落からカードを生成
+
+    Args:
+        passage (dict): iter_passagesの走査結果
+        api_key (str): Gemini APIキー
+
+    Returns:
+        list: カードのリスト [{"question": str, "answer": str}, ...]
+
+    Raises:
+        RuntimeError: APIキー未設定・利用制限などで生成できなかった場合（再開時に再処理）
+        Exception: AI提案のエラー（通信エラーなど、再開時に再処理）
+    """
+    text = passage["text"]
+    if is_marked(text):
+        for error in passage["errors"]:
+            print(f"【】の指定エラー: {error}")
+        if not passage["selected_indices"]:
+            return []
+        return generate_cards_from_selection(passage["phrases"], passage["selected_indices"])
+
+    phrases = split_into_phrases(text, api_key)
+    if isinstance(phrases, dict):
+        raise RuntimeError(phrases.get("message", phrases.get("error")))
+
+    phrase_doc = PhraseDoc(phrases)
+    selected = suggest_blanks(phrase_doc, api_key, raise_errors=True)
+    if isinstance(selected, dict):
+        raise RuntimeError(selected.get("message", selected.get("error")))
+
+    return generate_cards_from_selection(phrase_doc, selected)
+
+def import_documents(path, user_id, api_key="", title=None, category="その他",
+                     max_workers=IMPORT_MAX_WORKERS, batch_size=IMPORT_BATCH_SIZE,
+                     checkpoint_path=None, progress=None):
+    """
+    ファイル/ディレクトリの段落から原文カードと暗記カードを一括作成
+
+    Args:
+        path (str): テキストファイルまたはディレクトリ
+        user_id (str): カードを追加するユーザーID
+        api_key (str): Gemini APIキー（空の場合は【】を含む段落のみカード化される）
+        title (str): カードのタイトル（Noneならファイル名）
+        category (str): カテゴリ
+        max_workers (int): 同時に処理する段落数
+        batch_size (int): 1回のinsertにまとめる段落数
+        checkpoint_path (str): チェックポイントファイル（Noneなら入力パスの横）
+        progress (callable): progress(処理済み段落数, 全段落数, 集計) を段落ごとに呼ぶ
+
+    Returns:
+        dict: {"total", "resumed", "imported", "skipped", "failed", "cards"}
+        （AIで生成したカードが0枚の段落は失敗として数え、チェックポイントに記録しない）
+    """
+    checkpoint_path = checkpoint_path or default_checkpoint_path(path)
+    done_keys, saved_sources = _load_checkpoint(checkpoint_path)
+
+    summary = {
+        "total": count_passages(path),
+        "resumed": 0,
+        "imported": 0,
+        "skipped": 0,
+        "failed": 0,
+        "cards": 0
+    }
+    pending = []  # [(段落キー, 相対パス, 本文, カード), ...]
+
+    def card_title(relative_path):
+        """指定がなければファイル名（拡張子なし）をタイトルにする"""
+        return title if title is not None else os.path.splitext(os.path.basename(relative_path))[0]
+
+    def flush():
+        """溜まった段落をまとめて保存し、チェックポイントに記録"""
+        if not pending:
+            return
+        # 保存中に中断されても同じ段落をもう一度保存しないよう、先に保存待ちから外す
+        batch = list(pending)
+        pending.clear()
+        with_cards = [p for p in batch if p[3]]
+
+        # 原文カード（前回の実行で保存済みのものは再利用し、新しく保存したIDはすぐに記録する）
+        new_sources = [p for p in with_cards if p[0] not in saved_sources]
+        with _defer_interrupt():
+            source_ids = add_source_cards_batch(user_id, [{
+                "source_text": text,
+                "title": card_title(relative_path),
+                "category": category
+            } for _, relative_path, text, _ in new_sources])
+            if len(source_ids) != len(new_sources):
+                raise RuntimeError("原文カードを保存できませんでした")
+            _append_checkpoint(checkpoint_path, [
+                {"key": key, "source_id": source_id, "stage": "source"}
+                for (key, _, _, _), source_id in zip(new_sources, source_ids)
+            ])
+        saved_sources.update((p[0], source_id) for p, source_id in zip(new_sources, source_ids))
+
+        card_rows = []
+        entries = []
+        for key, relative_path, _, cards in with_cards:
+            source_id = saved_sources[key]
+            for card in cards:
+                card_rows.append({
+                    "question": card["question"],
+                    "answer": card["answer"],
+                    "title": card_title(relative_path),
+                    "category": category,
+                    "source_id": source_id,
+                    "blank_count": len(cards)
+                })
+            entries.append({"key": key, "source_id": source_id, "cards": len(cards)})
+        entries.extend({"key": key, "source_id": None, "cards": 0} for key, _, _, cards in batch if not cards)
+        with _defer_interrupt():
+            add_cards_batch(user_id, card_rows)
+            _append_checkpoint(checkpoint_path, entries)
+        for key, _, _, _ in with_cards:
+            del saved_sources[key]
+
+        summary["imported"] += len(with_cards)
+        summary["skipped"] += len(batch) - len(with_cards)
+        summary["cards"] += len(card_rows)
+
+    def collect(future, passage):
+        """完了した段落の結果を保存待ちに追加"""
+        key, relative_path, text = passage
+        try:
+            cards = future.result()
+        except Exception as e:
+            summary["failed"] += 1
+            print(f"インポートエラー（{key}）: {e}")
+            return
+        if not cards and not is_marked(text):
+            # AIの提案が0件だった段落は一時的な失敗の可能性があるため、記録せず再開時に再処理
+            summary["failed"] += 1
+            print(f"インポートエラー（{key}）: カードが生成されませんでした")
+            return
+        pending.append((key, relative_path, text, cards))
+
+    # 段落を読みながら投入し、読み込んで処理待ち・処理中の段落数はmax_in_flightまでにする
+    max_in_flight = max(max_workers * 2, 1)
+    in_flight = {}  # future → (段落キー, 相対パス, 本文)
+    finished = 0
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    try:
+        passages = iter_passages(path)
+        exhausted = False
+        while not exhausted or in_flight:
+            while not exhausted and len(in_flight) < max_in_flight:
+                passage = next(passages, None)
+                if passage is None:
+                    exhausted = True
+                elif passage[0] in done_keys:
+                    summary["resumed"] += 1
+                else:
+                    key, relative_path, scanned = passage
+                    in_flight[executor.submit(process_passage, scanned, api_key)] = (key, relative_path, scanned["text"])
+            if not in_flight:
+                break
+
+            completed, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in completed:
+                collect(future, in_flight.pop(future))
+                finished += 1
+                if len(pending) >= batch_size:
+                    flush()
+                if progress:
+                    progress(summary["resumed"] + finished, summary["total"], summary)
+        flush()
+    except KeyboardInterrupt:
+        # 保存待ちの段落だけ保存して中断（保存中だった段落は保存待ちから外してあるため二重に保存しない）
+        executor.shutdown(wait=False, cancel_futures=True)
+        flush()
+        raise
+    finally:
+        executor.shutdown(wait=False)
+
+    return summary
+
+# ============ コマンドライン ============
+
+def _load_user_api_key(user_id):
+    """ユーザーに登録されたAPIキーを取得（未設定なら組織のキープール）"""
+    result = get_supabase().table("users").select("api_key").eq("id", user_id).execute()
+    if result.data and result.data[0].get("api_key"):
+        return result.data[0]["api_key"]
+    return pool_api_key()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="テキストファイル/ディレクトリから暗記カードを一括作成")
+    parser.add_argument("path", help="テキストファイルまたはディレクトリ（.txt / .md）")
+    parser.add_argument("--user-id", required=True, help="カードを追加するユーザーID")
+    parser.add_argument("--api-key", default=None, help="Gemini APIキー（省略時はユーザーに登録されたキー、なければ組織のキープール）")
+    parser.add_argument("--title", default=None, help="カードのタイトル（省略時はファイル名）")
+    parser.add_argument("--category", default="その他", help="カテゴリ")
+    parser.add_argument("--workers", type=int, default=IMPORT_MAX_WORKERS, help="同時に処理する段落数")
+    parser.add_argument("--batch-size", type=int, default=IMPORT_BATCH_SIZE, help="1回のinsertにまとめる段落数")
+    parser.add_argument("--checkpoint", default=None, help="チェックポイントファイル")
+    args = parser.parse_args(argv)
+
+    api_key = args.api_key if args.api_key is not None else _load_user_api_key(args.user_id)
+
+    def report(done, total, summary):
+        print(f"\r[{done}/{total}] 原文 {summary['imported']} 件 / カード {summary['cards']} 枚"
+              f"（スキップ {summary['skipped']} / 失敗 {summary['failed']}）", end="", flush=True)
+
+    summary = import_documents(
+        args.path, args.user_id, api_key=api_key, title=args.title, category=args.category,
+        max_workers=args.workers, batch_size=args.batch_size,
+        checkpoint_path=args.checkpoint, progress=report
+    )
+    print()
+    print(f"完了: 原文 {summary['imported']} 件 / カード {summary['cards']} 枚を追加"
+          f"（再開時スキップ {summary['resumed']} / カードなし {summary['skipped']} / 失敗 {summary['failed']}）")
+    if summary["failed"]:
+        print("失敗した段落は同じコマンドを再実行すると再処理されます。")
+
+if __name__ == "__main__":
+    main()
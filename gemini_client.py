@@ -1,32 +1,457 @@
 import re
 import random
 import json
-from itertools import combinations
+import os
+import time
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from phrase_splitter import rule_based_split
+from singleflight import coalesce
+from help_index import build_help_index, format_section, help_documents_version, HelpAnswerCache
 
-# ============ AI文節分割 ============
+# ============ レート制限 ============
+
+# Gemini無料枠の上限（gemini-2.5-flash）
+GEMINI_RPM_LIMIT = 10  # 1分あたりのリクエスト数
+GEMINI_TPM_LIMIT = 250000  # 1分あたりのトークン数
+RATE_LIMIT_MAX_WAIT = 60  # 待ち行列で待つ最大秒数（超える場合は即エラー）
+RATE_LIMIT_MAX_RETRIES = 3  # 429エラー時の再試行回数
+BACKOFF_BASE_SECONDS = 2.0
+BACKOFF_MAX_SECONDS = 30.0
 
-def split_into_phrases(text, api_key):
+class RateLimitTimeout(Exception):
+    """待ち時間がRATE_LIMIT_MAX_WAITを超えるため実行しない（quota扱いのエラー）"""
+
+class _TokenBucket:
+    """1分あたりの上限をcapacityとし、毎秒capacity/60ずつ補充するトークンバケット"""
+    
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.rate = capacity / 60.0
+        self.tokens = float(capacity)
+        self.updated_at = time.monotonic()
+    
+    def reserve(self, amount, now):
+        """amountを予約し、使えるようになるまでの待ち秒数を返す（残量はマイナスになりうる）"""
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+        self.tokens -= min(amount, self.capacity)
+        return max(0.0, -self.tokens / self.rate)
+    
+    def cancel(self, amount):
+        """予約を取り消す"""
+        self.tokens += min(amount, self.capacity)
+    
+    def peek(self, now):
+        """予約せずに現在の残量を返す"""
+        return min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+
+class RateLimiter:
     """
-    AIを使ってテキストを文節（意味のある単位）に分割
+    APIキー単位のレート制限（RPM/TPMのトークンバケット + 待ち行列）
     
-    Args:
-        text (str): 分割するテキスト
-        api_key (str): Gemini APIキー
+    上限を超えたリクエストは失敗させずに予約順で待たせる。
+    """
+    
+    def __init__(self, rpm=GEMINI_RPM_LIMIT, tpm=GEMINI_TPM_LIMIT):
+        self._lock = threading.Lock()
+        self._requests = _TokenBucket(rpm)
+        self._tokens = _TokenBucket(tpm)
+        self.metrics = {"requests": 0, "queued": 0, "total_wait": 0.0, "max_wait": 0.0, "retries": 0, "rejected": 0}
+    
+    def acquire(self, estimated_tokens=0, max_wait=RATE_LIMIT_MAX_WAIT):
+        """枠が空くまで待つ（待った秒数を返す）"""
+        with self._lock:
+            now = time.monotonic()
+            wait = max(self._requests.reserve(1, now), self._tokens.reserve(estimated_tokens, now))
+            if wait > max_wait:
+                self._requests.cancel(1)
+                self._tokens.cancel(estimated_tokens)
+                self.metrics["rejected"] += 1
+                raise RateLimitTimeout(f"rate limit: queue wait {wait:.1f}s exceeds {max_wait}s")
+            self.metrics["requests"] += 1
+            if wait > 0:
+                self.metrics["queued"] += 1
+                self.metrics["total_wait"] += wait
+                self.metrics["max_wait"] = max(self.metrics["max_wait"], wait)
         
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+    
+    def record_retry(self):
+        with self._lock:
+            self.metrics["retries"] += 1
+    
+    def headroom(self, estimated_tokens=0):
+        """今すぐ使える枠の割合（RPM/TPMの小さい方、1.0で満タン・マイナスは待ち行列あり）"""
+        with self._lock:
+            now = time.monotonic()
+            return min(self._requests.peek(now) / self._requests.capacity,
+                       (self._tokens.peek(now) - estimated_tokens) / self._tokens.capacity)
+
+_rate_limiters = {}
+_rate_limiters_lock = threading.Lock()
+
+def get_rate_limiter(api_key):
+    """APIキーごとのRateLimiterを取得（プロセス内で共有）"""
+    with _rate_limiters_lock:
+        if api_key not in _rate_limiters:
+            _rate_limiters[api_key] = RateLimiter()
+        return _rate_limiters[api_key]
+
+def get_rate_limit_metrics():
+    """
+    レート制限のメトリクスを取得
+    
     Returns:
-        list: 文節のリスト
+        dict: {APIキー末尾4文字: {"requests", "queued", "avg_wait", "max_wait", "retries", "rejected"}}
     """
-    if not api_key:
-        # APIキーがない場合は句読点で簡易分割
-        return simple_split(text)
+    with _rate_limiters_lock:
+        limiters = list(_rate_limiters.items())
     
+    metrics = {}
+    for api_key, limiter in limiters:
+        m = dict(limiter.metrics)
+        m["avg_wait"] = m["total_wait"] / m["queued"] if m["queued"] else 0.0
+        metrics[f"...{api_key[-4:]}"] = m
+    return metrics
+
+def _is_quota_error(e):
+    """
+    APIの利用制限エラー（HTTP 429 / RESOURCE_EXHAUSTED）かどうかを判定
+    
+    "rate" や "limit" の部分一致は "generateContent" や "exceeds the limit" など
+    待っても解消しないエラーにも一致するため、例外の型・ステータスコードで判定する。
+    """
+    if isinstance(e, RateLimitTimeout):
+        return True
     try:
-        import google.generativeai as genai
-        genai.configure(api_key=api_key)
+        from google.api_core import exceptions as api_exceptions
+        if isinstance(e, (api_exceptions.ResourceExhausted, api_exceptions.TooManyRequests)):
+            return True
+    except ImportError:
+        pass
+    if getattr(e, "code", None) == 429 or getattr(e, "status_code", None) == 429:
+        return True
+    error_str = str(e)
+    return "RESOURCE_EXHAUSTED" in error_str or "quota" in error_str.lower()
+
+def _retry_delay_from_error(e):
+    """エラーメッセージ中の再試行ヒント（retry in 23s / retry_delay { seconds: 23 }）を秒数で返す"""
+    error_str = str(e)
+    match = re.search(r"retry in ([\d.]+)\s*s", error_str, re.IGNORECASE)
+    if not match:
+        match = re.search(r"retry_delay\s*\{\s*seconds:\s*(\d+)", error_str)
+    return float(match.group(1)) if match else None
+
+def _estimate_tokens(text):
+    """トークン数の概算（日本語は概ね1文字1トークン以下なので文字数を上限として使う）"""
+    return len(text)
+
+def _call_with_rate_limit(api_key, func, estimated_tokens=0):
+    """
+    レート制限付きでAPIを呼び出す
+    
+    func(key) には実際に使うAPIキーが渡される（api_keyがPOOL_API_KEYならプールから選んだキー）。
+    429エラーは再試行ヒントを優先し、なければ指数バックオフ（ジッター付き）で再試行する。
+    待ち時間がRATE_LIMIT_MAX_WAITを超える場合は元の例外を送出する。
+    """
+    if api_key == POOL_API_KEY:
+        return _call_with_key_pool(func, estimated_tokens)
+    
+    limiter = get_rate_limiter(api_key)
+    
+    for attempt in range(RATE_LIMIT_MAX_RETRIES + 1):
+        limiter.acquire(estimated_tokens)
+        try:
+            return func(api_key)
+        except Exception as e:
+            if not _is_quota_error(e) or attempt >= RATE_LIMIT_MAX_RETRIES:
+                raise
+            delay = _retry_delay_from_error(e)
+            if delay is None:
+                delay = min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * (2 ** attempt))
+            if delay > RATE_LIMIT_MAX_WAIT:
+                # 日次上限など、待っても解消しない制限
+                raise
+            limiter.record_retry()
+            time.sleep(delay + random.uniform(0, delay * 0.5))
+
+# ============ 組織APIキープール ============
+
+# 共有デプロイ向け: 環境変数 または Streamlit secrets の GEMINI_API_KEYS（カンマ区切り）に
+# 組織のキーを設定すると、APIキー未設定のユーザーはプールのキーを共有して使う
+POOL_API_KEY = "__org_key_pool__"  # api_keyにこの値を渡すとプールから選んだキーで呼び出す
+GEMINI_RPD_LIMIT = 250  # 1キーあたり1日のリクエスト数
+KEY_POOL_COOLDOWN_SECONDS = 60  # 429を受けたキーを使わない秒数（再試行ヒントがない場合）
+
+def _load_pool_keys():
+    """組織のAPIキーを読み込む"""
+    keys = os.environ.get("GEMINI_API_KEYS", "")
+    try:
+        import streamlit as st
+        if hasattr(st, 'secrets') and "GEMINI_API_KEYS" in st.secrets:
+            keys = st.secrets["GEMINI_API_KEYS"]
+    except Exception:
+        pass
+    if isinstance(keys, str):
+        keys = keys.split(",")
+    return [key.strip() for key in keys if key and key.strip()]
+
+class ApiKeyPool:
+    """
+    組織のAPIキーを残り枠に応じて使い分けるプール
+    
+    キーごとに1分あたり（RateLimiterのバケット）と1日あたりの使用量をローカルで記録し、
+    最も余裕のあるキーを選ぶ。429を受けたキーはしばらく使わず、別のキーで再試行する。
+    """
+    
+    def __init__(self, keys, rpd=GEMINI_RPD_LIMIT):
+        self.keys = list(keys)
+        self.rpd = rpd
+        self.failovers = 0
+        self._lock = threading.Lock()
+        self._daily = {key: ["", 0] for key in self.keys}  # キー → [日付, リクエスト数]
+        self._cooldown_until = {key: 0.0 for key in self.keys}
+        self._quota_errors = {key: 0 for key in self.keys}
+    
+    def _daily_used(self, key, today):
+        """当日のリクエスト数（日付が変わっていればリセット、ロック内で呼ぶ）"""
+        if self._daily[key][0] != today:
+            self._daily[key] = [today, 0]
+        return self._daily[key][1]
+    
+    def select(self, estimated_tokens=0, exclude=()):
+        """
+        最も余裕のあるキーを選ぶ
         
-        model = genai.GenerativeModel("gemini-2.5-flash")
+        Returns:
+            str: APIキー（429の待機中・日次上限到達・excludeを除いて使えるキーがなければNone）
+        """
+        now = time.time()
+        today = time.strftime("%Y-%m-%d")
+        best, best_score = None, None
+        with self._lock:
+            for key in self.keys:
+                if key in exclude or self._cooldown_until[key] > now:
+                    continue
+                daily_left = 1 - self._daily_used(key, today) / self.rpd
+                if daily_left <= 0:
+                    continue
+                score = min(daily_left, get_rate_limiter(key).headroom(estimated_tokens))
+                if best_score is None or score > best_score:
+                    best, best_score = key, score
+        return best
+    
+    def record_request(self, key):
+        with self._lock:
+            self._daily_used(key, time.strftime("%Y-%m-%d"))
+            self._daily[key][1] += 1
+    
+    def record_quota_error(self, key, retry_delay=None, daily=False):
+        """429を受けたキーを一定時間（日次上限ならその日の残り）使わないようにする"""
+        with self._lock:
+            self._quota_errors[key] += 1
+            self._cooldown_until[key] = time.time() + (retry_delay or KEY_POOL_COOLDOWN_SECONDS)
+            if daily:
+                self._daily_used(key, time.strftime("%Y-%m-%d"))
+                self._daily[key][1] = self.rpd
+    
+    def record_failover(self):
+        with self._lock:
+            self.failovers += 1
+    
+    def next_available_in(self):
+        """429の待機が明けて使えるキーが出るまでの秒数（日次上限で使えるキーがなければinf）"""
+        now = time.time()
+        today = time.strftime("%Y-%m-%d")
+        with self._lock:
+            waits = [max(0.0, self._cooldown_until[key] - now) for key in self.keys
+                     if self._daily_used(key, today) < self.rpd]
+        return min(waits) if waits else float("inf")
+    
+    def utilization(self):
+        """
+        キーごとの使用状況
+        
+        Returns:
+            dict: {APIキー末尾4文字: {"requests_today", "daily_utilization", "minute_utilization",
+                                    "cooling_down", "quota_errors"}}
+        """
+        now = time.time()
+        today = time.strftime("%Y-%m-%d")
+        result = {}
+        with self._lock:
+            for key in self.keys:
+                used = self._daily_used(key, today)
+                result[f"...{key[-4:]}"] = {
+                    "requests_today": used,
+                    "daily_utilization": used / self.rpd,
+                    "minute_utilization": 1 - max(0.0, get_rate_limiter(key).headroom()),
+                    "cooling_down": self._cooldown_until[key] > now,
+                    "quota_errors": self._quota_errors[key]
+                }
+        return result
+
+_key_pool = None
+_key_pool_loaded = False
+_key_pool_lock = threading.Lock()
+
+def get_key_pool():
+    """組織のキープール（GEMINI_API_KEYSが未設定ならNone）"""
+    global _key_pool, _key_pool_loaded
+    with _key_pool_lock:
+        if not _key_pool_loaded:
+            keys = _load_pool_keys()
+            _key_pool = ApiKeyPool(keys) if keys else None
+            _key_pool_loaded = True
+        return _key_pool
+
+def pool_api_key():
+    """キープールが設定されていればPOOL_API_KEY、なければ空文字"""
+    return POOL_API_KEY if get_key_pool() else ""
+
+def get_key_pool_metrics():
+    """
+    キープールの使用状況（未設定なら空）
+    
+    Returns:
+        dict: {"keys": ApiKeyPool.utilizationの結果, "failovers": int}
+    """
+    pool = get_key_pool()
+    if pool is None:
+        return {}
+    return {"keys": pool.utilization(), "failovers": pool.failovers}
+
+def _call_with_key_pool(func, estimated_tokens=0):
+    """
+    組織のキープールから選んだキーで呼び出す
+    
+    429を受けたキーは待機させ、すぐに別のキーで再試行する（フェイルオーバー）。
+    全てのキーが待機中の場合は、最短の待機がRATE_LIMIT_MAX_WAIT以内なら待って再開する。
+    """
+    pool = get_key_pool()
+    if pool is None:
+        raise RateLimitTimeout("key pool is not configured")
+    
+    tried = set()
+    for attempt in range(len(pool.keys) + RATE_LIMIT_MAX_RETRIES):
+        key = pool.select(estimated_tokens, exclude=tried)
+        if key is None:
+            wait = pool.next_available_in()
+            if wait > RATE_LIMIT_MAX_WAIT:
+                raise RateLimitTimeout(f"key pool: all keys are rate limited (next in {wait:.0f}s)")
+            time.sleep(wait)
+            tried.clear()
+            continue
         
-        prompt = f"""以下のテキストを、暗記カード用の意味のまとまりに分割してください。
+        try:
+            get_rate_limiter(key).acquire(estimated_tokens)
+        except RateLimitTimeout:
+            tried.add(key)
+            continue
+        pool.record_request(key)
+        try:
+            return func(key)
+        except Exception as e:
+            if not _is_quota_error(e):
+                raise
+            error_str = str(e).lower()
+            pool.record_quota_error(key, _retry_delay_from_error(e), daily="per day" in error_str or "perday" in error_str)
+            pool.record_failover()
+            tried.add(key)
+    raise RateLimitTimeout("key pool: retries exhausted")
+
+# ============ AI文節分割 ============
+
+# 長文分割の設定
+SPLIT_CHUNK_MAX_CHARS = 400  # 1チャンクあたりの目安文字数（「。」の文境界で区切る）
+SPLIT_MAX_WORKERS = 4  # 同時に処理するチャンク数の上限
+SPLIT_MAX_RETRIES = 2  # チャンクごとの再試行回数
+
+GEMINI_MODEL = "models/gemini-2.5-flash"
+API_CLIENT_MAX_ENTRIES = 256  # 保持するAPIキーごとのクライアント数（超えたら古いものから破棄）
+
+_api_clients = OrderedDict()  # APIキー → GenerativeServiceClient
+_api_clients_lock = threading.Lock()
+
+def _api_client(api_key):
+    """
+    APIキーごとのクライアント
+
+    genai.configureはプロセス全体の設定を書き換えるため、別スレッドのconfigureが割り込むと
+    別のキーで送信されてしまう。google.ai.generativelanguage のクライアントはキーを指定して作成できる。
+    """
+    from google.ai import generativelanguage as glm
+    
+    with _api_clients_lock:
+        client = _api_clients.get(api_key)
+        if client is None:
+            client = glm.GenerativeServiceClient(client_options={"api_key": api_key})
+            _api_clients[api_key] = client
+            while len(_api_clients) > API_CLIENT_MAX_ENTRIES:
+                _api_clients.popitem(last=False)
+        else:
+            _api_clients.move_to_end(api_key)
+        return client
+
+def _generate_content(genai, api_key, contents, generation_config=None, system_instruction=None, stream=False):
+    """
+    指定したAPIキーでテキストを生成
+    
+    リクエストはgenai.protosで組み立て、応答はgenai.types.GenerateContentResponseで包むため、
+    .text・usage_metadata・ストリームの反復はGenerativeModel.generate_contentと同じように使える。
+    
+    Args:
+        contents: 送信する文字列、または会話 [{"role": "user"/"model", "parts": [文字列, ...]}, ...]
+        generation_config (genai.protos.GenerationConfig): 生成の設定
+        system_instruction (str): システムプロンプト
+        stream (bool): 生成された分から順に受け取るか
+    """
+    if isinstance(contents, str):
+        contents = [{"role": "user", "parts": [contents]}]
+    request = genai.protos.GenerateContentRequest(
+        model=GEMINI_MODEL,
+        contents=[genai.protos.Content(role=message["role"], parts=[genai.protos.Part(text=text) for text in message["parts"]])
+                  for message in contents],
+        generation_config=generation_config
+    )
+    if system_instruction:
+        request.system_instruction = genai.protos.Content(parts=[genai.protos.Part(text=system_instruction)])
+    
+    client = _api_client(api_key)
+    if stream:
+        return genai.types.GenerateContentResponse.from_iterator(client.stream_generate_content(request))
+    return genai.types.GenerateContentResponse.from_response(client.generate_content(request))
+
+def _split_text_into_chunks(text, max_chars=SPLIT_CHUNK_MAX_CHARS):
+    """
+    テキストを「。」の文境界でチャンクにまとめる
+    
+    1文がmax_charsを超える場合はその文だけで1チャンクとする
+    
+    Returns:
+        list: チャンク（文字列）のリスト（元の順序）
+    """
+    sentences = [s for s in re.split(r'(?<=。)', text) if s.strip()]
+    chunks = []
+    current = ""
+    
+    for sentence in sentences:
+        if current and len(current) + len(sentence) > max_chars:
+            chunks.append(current)
+            current = ""
+        current += sentence
+    
+    if current:
+        chunks.append(current)
+    return chunks
+
+def _split_chunk_with_ai(genai, chunk, api_key):
+    """1チャンクをAIで文節分割（失敗時は例外を送出）"""
+    prompt = f"""以下のテキストを、暗記カード用の意味のまとまりに分割してください。
 
 【文法的ルール】
 1. 助詞（は、が、を、に、で、の、と、から、まで、より、へ等）は全て独立したブロックとして分割する
@@ -52,34 +477,103 @@ def split_into_phrases(text, api_key):
 出力: ["そこで", "、", "作為", "との", "構成要件的同価値性", "が", "認められる", "場合", "、", "すなわち", "、", "法的作為義務", "が", "あった", "のに", "それ", "に", "違背し", "、", "作為", "が", "可能", "かつ", "容易", "であった", "のに", "作為", "を", "しなかった", "場合", "に", "限り", "、", "不作為", "にも", "実行行為性", "が", "認められる", "と", "解する", "。"]
 
 【テキスト】
-{text}
+{chunk}
 
 【出力形式】
 {{"phrases": ["ブロック1", "ブロック2", "。", ...]}}"""
-        
-        response = model.generate_content(
-            prompt,
-            generation_config=genai.GenerationConfig(
-                temperature=0.0,
-                top_p=0.95,
-                response_mime_type="application/json"
-            )
+    
+    # 同じキーで同じチャンクの分割が同時に要求された場合（同じ文章を2つのタブで解析した等）は1回の呼び出しを共有
+    # （キーを含めないと、他のユーザーの呼び出しが自分のキーで実行され、そのキーのエラーも共有してしまう）
+    response = coalesce(("split_chunk", api_key, chunk), lambda: _call_with_rate_limit(api_key, lambda key: _generate_content(
+        genai, key, prompt,
+        generation_config=genai.protos.GenerationConfig(
+            temperature=0.0,
+            top_p=0.95,
+            response_mime_type="application/json"
         )
+    ), _estimate_tokens(prompt) * 2))
+    
+    result = json.loads(response.text)
+    phrases = result.get("phrases", [])
+    if not phrases:
+        raise ValueError("文節が返されませんでした")
+    return phrases
+
+def _split_chunk(genai, chunk, api_key):
+    """
+    1チャンクを再試行付きで分割（失敗したチャンクのみルールベース分割にフォールバック）
+    
+    Returns:
+        tuple: (文節のリスト, エラー種別 None/"quota"/"error")
+    """
+    for attempt in range(SPLIT_MAX_RETRIES + 1):
+        try:
+            return _split_chunk_with_ai(genai, chunk, api_key), None
+        except Exception as e:
+            if _is_quota_error(e):
+                return rule_based_split(chunk), "quota"
+            print(f"AI分割エラー（{attempt + 1}回目）: {e}")
+            if attempt < SPLIT_MAX_RETRIES:
+                time.sleep(0.5 * (attempt + 1))
+    return rule_based_split(chunk), "error"
+
+def split_into_phrases(text, api_key, progress=None):
+    """
+    AIを使ってテキストを文節（意味のある単位）に分割
+    
+    長文は「。」の文境界でチャンクに分け、並列に処理して元の順序で結合する。
+    失敗したチャンクだけがルールベース分割になり、他のチャンクの結果は維持される。
+    
+    Args:
+        text (str): 分割するテキスト
+        api_key (str): Gemini APIキー
+        progress (callable): progress(処理済みチャンク数, 全チャンク数) をチャンクごとに呼ぶ
         
-        result = json.loads(response.text)
-        phrases = result.get("phrases", [])
-        
-        if phrases:
-            return phrases
-        else:
-            return simple_split(text)
-            
+    Returns:
+        list: 文節のリスト
+    """
+    if not api_key:
+        # APIキーがない場合はオフラインのルールベース分割
+        return rule_based_split(text) or simple_split(text)
+    
+    chunks = _split_text_into_chunks(text)
+    if not chunks:
+        return simple_split(text)
+    
+    try:
+        import google.generativeai as genai
     except Exception as e:
-        error_str = str(e).lower()
-        if "quota" in error_str or "rate" in error_str or "limit" in error_str or "429" in error_str:
-            return {"error": "API_QUOTA_EXCEEDED", "message": "APIの無料枠利用制限に達しました。しばらく待ってから再試行するか、別のAPIキーを使用してください。"}
         print(f"AI分割エラー: {e}")
-        return simple_split(text)
+        return rule_based_split(text) or simple_split(text)
+    
+    completed = [0]
+    completed_lock = threading.Lock()
+    
+    def split_chunk(chunk):
+        result = _split_chunk(genai, chunk, api_key)
+        if progress:
+            with completed_lock:
+                completed[0] += 1
+                progress(completed[0], len(chunks))
+        return result
+    
+    if len(chunks) == 1:
+        results = [split_chunk(chunks[0])]
+    else:
+        with ThreadPoolExecutor(max_workers=min(SPLIT_MAX_WORKERS, len(chunks))) as executor:
+            results = list(executor.map(split_chunk, chunks))
+    
+    # 全チャンクが利用制限に当たった場合のみエラーとして返す（オフライン分割の結果を添える）
+    if all(status == "quota" for _, status in results):
+        fallback_phrases = []
+        for chunk_phrases, _ in results:
+            fallback_phrases.extend(chunk_phrases)
+        return {"error": "API_QUOTA_EXCEEDED", "message": "APIの無料枠利用制限に達しました。しばらく待ってから再試行するか、別のAPIキーを使用してください。", "fallback_phrases": fallback_phrases}
+    
+    phrases = []
+    for chunk_phrases, _ in results:
+        phrases.extend(chunk_phrases)
+    return phrases
 
 def simple_split(text):
     """句読点とスペースで簡易分割"""
@@ -94,36 +588,35 @@ def simple_split(text):
 
 # ============ AI穴埋め提案 ============
 
-def suggest_blanks(phrases, api_key):
+def suggest_blanks(phrases, api_key, raise_errors=False):
     """
     AIが穴埋めにすべき文節を提案
     
     Args:
-        phrases (list): 文節のリスト
+        phrases (list or PhraseDoc): 文節のリスト
         api_key (str): Gemini APIキー
+        raise_errors (bool): Trueなら利用制限以外のエラー（APIキー未設定を含む）で空リストを返さず例外を送出
         
     Returns:
         list: 穴埋めにすべき文節のインデックスリスト
     """
     if not api_key:
+        if raise_errors:
+            raise RuntimeError("APIキーが設定されていません")
         return []
     
     try:
         import google.generativeai as genai
-        genai.configure(api_key=api_key)
-        
-        model = genai.GenerativeModel("gemini-2.5-flash")
         
-        # 句読点のセット（穴埋め対象外）
-        punctuation_set = {'。', '、', '，', '．', ',', '.', '！', '？', '!', '?', '：', ':', '；', ';'}
+        doc = PhraseDoc.of(phrases)
         
         # 文節にインデックスを付ける（句読点は除外して表示）
         indexed_phrases = []
-        valid_indices = []
-        for i, p in enumerate(phrases):
-            if p.strip() not in punctuation_set:
+        valid_indices = set()
+        for i, p in enumerate(doc.phrases):
+            if not doc.punct_mask[i]:
                 indexed_phrases.append(f"{i}: {p}")
-                valid_indices.append(i)
+                valid_indices.add(i)
         
         prompt = f"""以下の文節リストから、暗記カードの穴埋めにすべき重要な文節を選んでください。
 
@@ -139,14 +632,14 @@ def suggest_blanks(phrases, api_key):
 【出力形式】
 {{"selected_indices": [0, 2, 5]}}  // 選んだ文節のインデックス番号"""
         
-        response = model.generate_content(
-            prompt,
-            generation_config=genai.GenerationConfig(
+        response = coalesce(("suggest_blanks", api_key, prompt), lambda: _call_with_rate_limit(api_key, lambda key: _generate_content(
+            genai, key, prompt,
+            generation_config=genai.protos.GenerationConfig(
                 temperature=0.2,
                 top_p=0.95,
                 response_mime_type="application/json"
             )
-        )
+        ), _estimate_tokens(prompt) + 200))
         
         result = json.loads(response.text)
         selected = result.get("selected_indices", [])
@@ -156,14 +649,169 @@ def suggest_blanks(phrases, api_key):
         return selected
         
     except Exception as e:
-        error_str = str(e).lower()
-        if "quota" in error_str or "rate" in error_str or "limit" in error_str or "429" in error_str:
+        if _is_quota_error(e):
             return {"error": "API_QUOTA_EXCEEDED", "message": "APIの無料枠利用制限に達しました。"}
+        if raise_errors:
+            raise
         print(f"AI提案エラー: {e}")
         return []
 
+# ============ 穴埋め提案の先読み ============
+
+SUGGEST_PREFETCH_MAX_ENTRIES = 200  # 先読み結果を保持する件数（超えたら古いものから破棄）
+
+_suggest_prefetch_cache = OrderedDict()  # (APIキー, 文節のタプル) → 提案結果
+_suggest_prefetch_lock = threading.Lock()
+_suggest_prefetch_metrics = {"prefetched": 0, "hits": 0, "misses": 0, "wasted": 0}
+
+def prefetch_suggest_blanks(phrases, api_key):
+    """
+    文節分割の直後にsuggest_blanksを先に実行し、結果を文節リストに紐づけて保存
+    （バックグラウンドジョブから呼ぶ。利用制限などのエラーは保存しない）
+
+    Returns:
+        list or dict: suggest_blanksの戻り値
+    """
+    doc = PhraseDoc.of(phrases)
+    result = suggest_blanks(doc, api_key)
+    with _suggest_prefetch_lock:
+        _suggest_prefetch_metrics["prefetched"] += 1
+        if isinstance(result, list):
+            key = (api_key, tuple(doc.phrases))
+            _suggest_prefetch_cache[key] = result
+            _suggest_prefetch_cache.move_to_end(key)
+            while len(_suggest_prefetch_cache) > SUGGEST_PREFETCH_MAX_ENTRIES:
+                _suggest_prefetch_cache.popitem(last=False)
+                _suggest_prefetch_metrics["wasted"] += 1
+        else:
+            _suggest_prefetch_metrics["wasted"] += 1
+    return result
+
+def take_prefetched_suggestion(phrases, api_key):
+    """
+    先読み済みの提案を取り出す（文節リストが一致する場合のみ）
+
+    Returns:
+        list: 穴埋めにすべき文節のインデックスリスト（先読みがなければNone）
+    """
+    key = (api_key, tuple(PhraseDoc.of(phrases).phrases))
+    with _suggest_prefetch_lock:
+        result = _suggest_prefetch_cache.pop(key, None)
+        _suggest_prefetch_metrics["hits" if result is not None else "misses"] += 1
+    return result
+
+def discard_prefetched_suggestion(phrases, api_key):
+    """使われなかった先読みを破棄（分割し直した・カードを保存した場合など）"""
+    key = (api_key, tuple(PhraseDoc.of(phrases).phrases))
+    with _suggest_prefetch_lock:
+        if _suggest_prefetch_cache.pop(key, None) is not None:
+            _suggest_prefetch_metrics["wasted"] += 1
+
+def get_suggest_prefetch_metrics():
+    """先読みの集計（hit_rate: 先読みのうち提案に使われた割合）"""
+    with _suggest_prefetch_lock:
+        metrics = dict(_suggest_prefetch_metrics)
+    metrics["hit_rate"] = metrics["hits"] / metrics["prefetched"] if metrics["prefetched"] else 0.0
+    return metrics
+
 # ============ カード生成 ============
 
+# 句読点・丸数字・空白のみの文節（穴埋め対象外）
+PUNCTUATION_PATTERN = re.compile(r'^[。、，．,.！？!?：:；;\s①②③④⑤⑥⑦⑧⑨⑩⑪⑫⑬⑭⑮⑯⑰⑱⑲⑳]+$')
+
+# 選択の間にあっても隣接とみなす区切りの文節
+_GAP_PHRASES = {'。', '、', '，', '．', ',', '.', ''}
+
+class PhraseDoc:
+    """
+    文節分割の結果を前処理した構造（分割ごとに1回作成し、カード生成と選択UIで共有）
+    
+    Attributes:
+        phrases (list): 文節のリスト
+        text (str): 文節を連結したテキスト
+        offsets (list): 各文節のtext内の開始位置（末尾にlen(text)）
+        punct_mask (list): 句読点のみの文節ならTrue
+        next_content (list): 各位置より後で最初の区切り以外の文節の位置
+    """
+    
+    def __init__(self, phrases):
+        self.phrases = list(phrases)
+        self.text = ''.join(self.phrases)
+        
+        self.offsets = [0]
+        for phrase in self.phrases:
+            self.offsets.append(self.offsets[-1] + len(phrase))
+        
+        self.punct_mask = [bool(PUNCTUATION_PATTERN.match(p)) for p in self.phrases]
+        
+        n = len(self.phrases)
+        self.next_content = [n] * n
+        next_index = n
+        for i in range(n - 1, -1, -1):
+            self.next_content[i] = next_index
+            if self.phrases[i].strip() not in _GAP_PHRASES:
+                next_index = i
+    
+    @classmethod
+    def of(cls, phrases):
+        """文節のリストならPhraseDocに変換（PhraseDocはそのまま返す）"""
+        return phrases if isinstance(phrases, cls) else cls(phrases)
+    
+    def merge(self, selected_indices):
+        """
+        隣接する選択インデックスをグループ化（間に区切りの文節しかなければ隣接とみなす）
+        
+        Returns:
+            list of lists: 隣接するインデックスのグループ [[0,1,2], [5,6], ...]
+        """
+        n = len(self.phrases)
+        sorted_indices = sorted(i for i in set(selected_indices) if 0 <= i < n)
+        if not sorted_indices:
+            return []
+        
+        groups = [[sorted_indices[0]]]
+        for prev_idx, curr_idx in zip(sorted_indices, sorted_indices[1:]):
+            if self.next_content[prev_idx] >= curr_idx:
+                groups[-1].append(curr_idx)
+            else:
+                groups.append([curr_idx])
+        return groups
+    
+    def render(self, target_groups):
+        """
+        指定されたグループを穴埋めにした問題文と答えのリストを作成
+        
+        連続したインデックスごとに1つの穴埋めとし、textのスライスで組み立てる
+        （文節の前後の空白は穴埋めに含めず、問題文に残す）
+        
+        Returns:
+            tuple: (問題文, [答え, ...])
+        """
+        runs = []
+        for group in target_groups:
+            for i in group:
+                if runs and runs[-1][1] == i - 1:
+                    runs[-1][1] = i
+                else:
+                    runs.append([i, i])
+        runs.sort()
+        
+        question_parts = []
+        answers = []
+        pos = 0
+        for start, end in runs:
+            question_parts.append(self.text[pos:self.offsets[start]])
+            blank = self.text[self.offsets[start]:self.offsets[end + 1]]
+            answer = blank.strip()
+            leading = blank[:len(blank) - len(blank.lstrip())]
+            trailing = blank[len(blank.rstrip()):]
+            question_parts.append(leading + '______' + trailing)
+            answers.append(answer)
+            pos = self.offsets[end + 1]
+        question_parts.append(self.text[pos:])
+        
+        return ''.join(question_parts), answers
+
 def merge_adjacent_selections(phrases, selected_indices):
     """
     隣接する選択インデックスをグループ化
@@ -171,47 +819,51 @@ def merge_adjacent_selections(phrases, selected_indices):
     Returns:
         list of lists: 隣接するインデックスのグループ [[0,1,2], [5,6], ...]
     """
-    if not selected_indices:
-        return []
+    return PhraseDoc.of(phrases).merge(selected_indices)
+
+def _select_covering_triples(num_groups, max_cards, rng):
+    """
+    全グループをできるだけカバーする3つ組を最大max_cards個つくる
     
-    sorted_indices = sorted(selected_indices)
-    groups = []
-    current_group = [sorted_indices[0]]
-    
-    for i in range(1, len(sorted_indices)):
-        # 隣接しているか、間に句読点のみがあるかチェック
-        prev_idx = sorted_indices[i-1]
-        curr_idx = sorted_indices[i]
-        
-        # 間にあるフレーズをチェック
-        is_adjacent = True
-        for j in range(prev_idx + 1, curr_idx):
-            # 句読点以外があれば隣接とみなさない
-            if not phrases[j].strip() in ['。', '、', '，', '．', ',', '.', '']:
-                is_adjacent = False
-                break
-        
-        if is_adjacent and curr_idx == prev_idx + 1:
-            # 完全に隣接
-            current_group.append(curr_idx)
-        elif is_adjacent:
-            # 間に句読点のみ
-            current_group.append(curr_idx)
-        else:
-            # 隣接していない
-            groups.append(current_group)
-            current_group = [curr_idx]
+    シャッフルしたグループを先頭から3つずつ取り（端数はカバー済みのグループで補う）、
+    残りの枠は重複しないランダムな3つ組で埋める。全組み合わせは列挙しない。
+    
+    Returns:
+        list: グループ番号の3つ組（昇順タプル）のリスト
+    """
+    order = list(range(num_groups))
+    rng.shuffle(order)
     
-    groups.append(current_group)
-    return groups
+    triples = []
+    # 未カバーのグループを3つずつ割り当て
+    for start in range(0, num_groups, 3):
+        if len(triples) >= max_cards:
+            break
+        triple = order[start:start + 3]
+        while len(triple) < 3:
+            candidate = rng.randrange(num_groups)
+            if candidate not in triple:
+                triple.append(candidate)
+        triples.append(tuple(sorted(triple)))
+    
+    # 上限まで重複しない3つ組を追加
+    selected = set(triples)
+    while len(triples) < max_cards:
+        triple = tuple(sorted(rng.sample(range(num_groups), 3)))
+        if triple not in selected:
+            selected.add(triple)
+            triples.append(triple)
+    
+    return triples
 
-def generate_cards_from_selection(phrases, selected_indices):
+def generate_cards_from_selection(phrases, selected_indices, seed=None):
     """
     選択された文節を穴埋めにしてカードを生成（隣接ブロックは結合）
     
     Args:
-        phrases (list): 文節のリスト
+        phrases (list or PhraseDoc): 文節のリスト
         selected_indices (list): 穴埋めにする文節のインデックス
+        seed (int): 穴埋めの組み合わせを決める乱数シード（Noneなら毎回ランダム）
         
     Returns:
         list: カードのリスト
@@ -220,40 +872,19 @@ def generate_cards_from_selection(phrases, selected_indices):
         return []
     
     # 隣接する選択をグループ化
-    groups = merge_adjacent_selections(phrases, selected_indices)
+    doc = PhraseDoc.of(phrases)
+    groups = doc.merge(selected_indices)
+    if not groups:
+        return []
     num_blanks = len(groups)  # 結合後の穴埋め箇所数
     
     cards = []
     
     def build_card_from_groups(target_groups):
         """指定されたグループを穴埋めにしてカードを作成"""
-        question_parts = []
-        answers = []
-        all_target_indices = set()
-        for g in target_groups:
-            all_target_indices.update(g)
-        
-        current_answer = []
-        in_blank = False
-        
-        for i, phrase in enumerate(phrases):
-            if i in all_target_indices:
-                if not in_blank:
-                    question_parts.append('______')
-                    in_blank = True
-                current_answer.append(phrase)
-            else:
-                if in_blank and current_answer:
-                    answers.append(''.join(current_answer))
-                    current_answer = []
-                    in_blank = False
-                question_parts.append(phrase)
-        
-        if current_answer:
-            answers.append(''.join(current_answer))
-        
+        question, answers = doc.render(target_groups)
         return {
-            "question": ''.join(question_parts),
+            "question": question,
             "answer": " / ".join(answers)
         }
     
@@ -265,41 +896,7 @@ def generate_cards_from_selection(phrases, selected_indices):
         # 上限 = 穴埋め箇所数 - 2、ただし最大5枚
         max_cards = min(num_blanks - 2, 5)
         
-        all_combos = list(combinations(range(len(groups)), min(3, num_blanks)))
-        
-        selected_combos = []
-        covered = set()
-        
-        shuffled_combos = all_combos.copy()
-        random.shuffle(shuffled_combos)
-        
-        # 全ての穴埋め箇所をカバー
-        for combo in shuffled_combos:
-            if covered == set(range(num_blanks)):
-                break
-            new_coverage = set(combo) - covered
-            if new_coverage:
-                selected_combos.append(combo)
-                covered.update(combo)
-            if len(selected_combos) >= max_cards:
-                break
-        
-        # 未カバーがあれば追加
-        while covered != set(range(num_blanks)) and len(selected_combos) < max_cards:
-            uncovered = set(range(num_blanks)) - covered
-            for combo in shuffled_combos:
-                if any(i in uncovered for i in combo):
-                    if combo not in selected_combos:
-                        selected_combos.append(combo)
-                        covered.update(combo)
-                        break
-            else:
-                break
-        
-        # 上限まで追加
-        remaining = [c for c in shuffled_combos if c not in selected_combos]
-        while len(selected_combos) < max_cards and remaining:
-            selected_combos.append(remaining.pop(0))
+        selected_combos = _select_covering_triples(num_blanks, max_cards, random.Random(seed))
         
         # カード生成
         for combo in selected_combos:
@@ -308,61 +905,152 @@ def generate_cards_from_selection(phrases, selected_indices):
     
     return cards
 
+# ============ 【】マーカー ============
+
+class MarkerScanner:
+    """
+    【】付きテキストを1行ずつ読み、文節リストと穴埋めインデックスを組み立てる
+
+    マーカーの検証も同じ走査で行う（行をまたぐ【】・空の【】・入れ子・対応しない】はエラー扱いで、
+    その部分は通常のテキストとして残す）。
+    """
+
+    def __init__(self, first_line=1):
+        self.first_line = first_line
+        self.phrases = []
+        self.selected_indices = []
+        self.errors = []
+        self._lines = []  # 元の行（段落の本文として返す）
+
+    def _append_text(self, text):
+        """通常テキストを追加（直前も通常テキストなら連結）"""
+        if not text:
+            return
+        if self.phrases and (not self.selected_indices or self.selected_indices[-1] != len(self.phrases) - 1):
+            self.phrases[-1] += text
+        else:
+            self.phrases.append(text)
+
+    def feed(self, line):
+        """1行分（改行を除く）を走査"""
+        line_no = self.first_line + len(self._lines)
+        if self._lines:
+            self._append_text("\n")
+        self._lines.append(line)
+
+        pos = 0
+        while pos < len(line):
+            open_pos = line.find("【", pos)
+            close_pos = line.find("】", pos)
+            if close_pos != -1 and (open_pos == -1 or close_pos < open_pos):
+                self.errors.append(f"{line_no}行目: 対応する【がない】があります")
+                self._append_text(line[pos:close_pos + 1])
+                pos = close_pos + 1
+                continue
+            if open_pos == -1:
+                self._append_text(line[pos:])
+                break
+
+            self._append_text(line[pos:open_pos])
+            if close_pos == -1:
+                self.errors.append(f"{line_no}行目: 【が閉じられていません")
+                self._append_text(line[open_pos:])
+                break
+            nested_pos = line.find("【", open_pos + 1, close_pos)
+            if nested_pos != -1:
+                self.errors.append(f"{line_no}行目: 【】が入れ子になっています")
+                self._append_text(line[open_pos:nested_pos])
+                pos = nested_pos
+                continue
+            if close_pos == open_pos + 1:
+                self.errors.append(f"{line_no}行目: 空の【】があります")
+                self._append_text("【】")
+            else:
+                self.selected_indices.append(len(self.phrases))
+                self.phrases.append(line[open_pos + 1:close_pos])
+            pos = close_pos + 1
+
+    def result(self):
+        """
+        Returns:
+            dict: {"phrases": list, "selected_indices": list, "blank_count": int,
+                   "errors": list, "line": int（開始行）, "text": str（元の本文）}
+        """
+        return {
+            "text": "\n".join(self._lines),
+            "phrases": self.phrases,
+            "selected_indices": self.selected_indices,
+            "blank_count": len(self.selected_indices),
+            "errors": self.errors,
+            "line": self.first_line
+        }
+
+def scan_marked_text(text):
+    """【】付きテキスト全体を1つの段落として走査（MarkerScanner.resultと同じ形式）"""
+    scanner = MarkerScanner()
+    for line in text.split("\n"):
+        scanner.feed(line)
+    return scanner.result()
+
+def iter_marked_passages(lines):
+    """
+    【】付きの文書を1行ずつ読み、空行区切りの段落ごとに走査結果を返す
+
+    保持するのは読み途中の1段落分だけなので、数MBの文書でもメモリ使用量は段落の大きさで決まる。
+
+    Args:
+        lines (iterable): 行のイテレータ（開いたファイルオブジェクトなど）
+
+    Yields:
+        dict: MarkerScanner.resultの形式
+    """
+    scanner = None
+    for line_no, line in enumerate(lines, 1):
+        line = line.rstrip("\r\n")
+        if not line.strip():
+            if scanner:
+                yield scanner.result()
+                scanner = None
+            continue
+        if scanner is None:
+            scanner = MarkerScanner(first_line=line_no)
+        scanner.feed(line)
+    if scanner:
+        yield scanner.result()
+
 # ============ 旧API互換 ============
 
 def parse_blanks_from_text(text):
     """【】マーカーからカードを生成（旧方式との互換性のため残す）"""
-    pattern = r'【(.+?)】'
-    matches = list(re.finditer(pattern, text))
-    
-    if not matches:
+    passage = scan_marked_text(text)
+    if not passage["selected_indices"]:
         return []
-    
-    # 文節リストと選択インデックスに変換
-    phrases = []
-    selected_indices = []
-    last_end = 0
-    
-    for i, m in enumerate(matches):
-        # マッチ前のテキスト
-        if m.start() > last_end:
-            before = text[last_end:m.start()]
-            if before:
-                phrases.append(before)
-        
-        # マッチしたテキスト（穴埋め対象）
-        selected_indices.append(len(phrases))
-        phrases.append(m.group(1))
-        last_end = m.end()
-    
-    # 最後のテキスト
-    if last_end < len(text):
-        after = text[last_end:]
-        if after:
-            phrases.append(after)
-    
-    return generate_cards_from_selection(phrases, selected_indices)
+    return generate_cards_from_selection(passage["phrases"], passage["selected_indices"])
+
+def _validation_message(passage):
+    """穴埋め指定の検証結果 (有効か, メッセージ, 穴埋め数)"""
+    count = passage["blank_count"]
+    if not count:
+        return False, "穴埋め箇所が指定されていません。", 0
+    return True, f"{count}箇所の穴埋めが指定されています。", count
 
 def validate_blank_markers(text):
     """穴埋め指定の検証（旧方式との互換性）"""
-    pattern = r'【(.+?)】'
-    matches = re.findall(pattern, text)
-    
-    if not matches:
-        return False, "穴埋め箇所が指定されていません。", 0
-    
-    return True, f"{len(matches)}箇所の穴埋めが指定されています。", len(matches)
+    return _validation_message(scan_marked_text(text))
 
 def generate_flashcards(text, api_key=None, keywords=None):
-    """旧API互換のエントリーポイント"""
-    is_valid, message, count = validate_blank_markers(text)
+    """旧API互換のエントリーポイント（検証とカード生成を1回の走査で行う）"""
+    passage = scan_marked_text(text)
+    is_valid, message, count = _validation_message(passage)
     if not is_valid:
         return None
-    return parse_blanks_from_text(text)
+    return generate_cards_from_selection(passage["phrases"], passage["selected_indices"])
 
 # ============ ヘルプAIチャット ============
 
-import os
+HELP_CHAT_HISTORY_TOKEN_BUDGET = 2000  # 会話履歴に使うトークン数の上限（古い会話から落とす）
+HELP_RETRIEVAL_TOP_K = 3  # 質問ごとに添付するヘルプ文書のセクション数（0で全文をシステムプロンプトに含める）
+HELP_ANSWER_CACHE_TTL = 24 * 3600  # 回答キャッシュの有効期間（秒）
 
 def _load_help_context():
     """HELP_AI_CONTEXT.mdを読み込む"""
@@ -377,6 +1065,145 @@ def _load_help_context():
         print(f"ヘルプコンテキスト読み込みエラー: {e}")
         return ""
 
+def _build_help_system_prompt(help_context):
+    """ヘルプAIのシステムプロンプトを組み立てる（help_contextが空なら質問ごとの参考情報を使う）"""
+    if not help_context:
+        return """あなたは「AI暗記カード」アプリのヘルプアシスタントです。
+ユーザーからの質問に、質問と一緒に渡される【参考情報】（アプリのヘルプ文書の抜粋）を元に回答してください。
+
+【重要なルール】
+1. このアプリに関係する質問にのみ回答してください
+2. アプリに関係ない質問（天気、雑談、他のアプリについてなど）には丁寧にお断りしてください
+3. 回答は簡潔にしてください（2-3文程度が理想）
+4. 専門用語は分かりやすく説明してください
+5. 手順を説明する際は箇条書きを使ってください
+6. 【参考情報】に書かれていないことは推測せず、分からない旨を伝えてください
+"""
+    
+    return f"""あなたは「AI暗記カード」アプリのヘルプアシスタントです。
+ユーザーからの質問に、以下のアプリ情報を元に回答してください。
+
+【重要なルール】
+1. このアプリに関係する質問にのみ回答してください
+2. アプリに関係ない質問（天気、雑談、他のアプリについてなど）には丁寧にお断りしてください
+3. 回答は簡潔にしてください（2-3文程度が理想）
+4. 専門用語は分かりやすく説明してください
+5. 手順を説明する際は箇条書きを使ってください
+
+【アプリ情報】
+{help_context}
+"""
+
+# システムプロンプトとヘルプ文書の索引は起動時に1回だけ作成する（文書の更新時のみ作り直す）
+_HELP_SYSTEM_PROMPT = _build_help_system_prompt("" if HELP_RETRIEVAL_TOP_K else _load_help_context())
+_HELP_INDEX = build_help_index()
+_help_documents_version = help_documents_version()
+_help_documents_lock = threading.Lock()
+
+# 会話の最初の質問への回答キャッシュ（全ユーザー共有）
+_help_answer_cache = HelpAnswerCache(ttl=HELP_ANSWER_CACHE_TTL)
+
+def _refresh_help_documents():
+    """ヘルプ文書が更新されていれば索引・システムプロンプトを作り直し、回答キャッシュを破棄"""
+    global _HELP_SYSTEM_PROMPT, _HELP_INDEX, _help_documents_version
+    version = help_documents_version()
+    if version == _help_documents_version:
+        return
+    
+    with _help_documents_lock:
+        if version == _help_documents_version:
+            return
+        _HELP_SYSTEM_PROMPT = _build_help_system_prompt("" if HELP_RETRIEVAL_TOP_K else _load_help_context())
+        _HELP_INDEX = build_help_index()
+        _help_answer_cache.clear()
+        _help_documents_version = version
+
+def _build_help_chat_history(chat_history, token_budget=HELP_CHAT_HISTORY_TOKEN_BUDGET):
+    """
+    過去の会話からGeminiのチャット履歴を組み立てる
+    
+    新しい会話から順にtoken_budgetまで残し、それより古い会話は
+    質問だけを1行にまとめた要約に置き換える
+    """
+    chat_history = chat_history or []
+    kept = []
+    used = 0
+    for msg in reversed(chat_history):
+        cost = _estimate_tokens(msg.get("content", ""))
+        if used + cost > token_budget:
+            break
+        kept.append(msg)
+        used += cost
+    kept.reverse()
+    
+    # 履歴はユーザーの発言から始める
+    while kept and kept[0].get("role") != "user":
+        kept.pop(0)
+    dropped = chat_history[:len(chat_history) - len(kept)]
+    
+    messages = []
+    earlier_questions = [msg.get("content", "")[:40] for msg in dropped if msg.get("role") == "user"]
+    if earlier_questions:
+        summary = "（これまでの質問: " + " / ".join(earlier_questions[-5:]) + "）"
+        messages.append({"role": "user", "parts": [summary]})
+        messages.append({"role": "model", "parts": ["承知しました。"]})
+    
+    for msg in kept:
+        role = "user" if msg.get("role") == "user" else "model"
+        messages.append({"role": role, "parts": [msg.get("content", "")]})
+    
+    return messages
+
+def _log_token_usage(response):
+    """リクエストごとのトークン数をログ出力"""
+    usage = getattr(response, "usage_metadata", None)
+    if usage is None:
+        return
+    print(
+        f"ヘルプAIトークン数: 入力 {getattr(usage, 'prompt_token_count', 0)}"
+        f"（キャッシュ {getattr(usage, 'cached_content_token_count', 0)}）"
+        f" / 出力 {getattr(usage, 'candidates_token_count', 0)}"
+    )
+
+def _build_help_message(user_question, chat_history):
+    """
+    送信するメッセージを組み立てる（質問に関連するヘルプ文書のセクションを添付）
+    
+    直前のユーザーの質問も検索語に含め、「それは？」のような続きの質問にも対応する
+    """
+    if not HELP_RETRIEVAL_TOP_K:
+        return user_question
+    
+    query = user_question
+    previous_questions = [msg.get("content", "") for msg in (chat_history or []) if msg.get("role") == "user"]
+    if previous_questions:
+        query = previous_questions[-1] + "\n" + user_question
+    
+    sections = [format_section(section) for _, section in _HELP_INDEX.search(query, HELP_RETRIEVAL_TOP_K)]
+    if not sections:
+        return user_question
+    return "【参考情報】\n" + "\n\n".join(sections) + "\n\n【質問】\n" + user_question
+
+def _build_help_request(user_question, chat_history):
+    """
+    ヘルプAIに送信する関数を組み立てる（会話履歴の後に今回のメッセージを続けて送る）
+    
+    Returns:
+        tuple: (send(APIキー, stream=False) → 応答, 推定トークン数)
+    """
+    import google.generativeai as genai
+    
+    messages = _build_help_chat_history(chat_history)
+    message = _build_help_message(user_question, chat_history)
+    contents = messages + [{"role": "user", "parts": [message]}]
+    
+    def send(api_key, stream=False):
+        return _generate_content(genai, api_key, contents, system_instruction=_HELP_SYSTEM_PROMPT, stream=stream)
+    
+    estimated_tokens = (_estimate_tokens(_HELP_SYSTEM_PROMPT) + _estimate_tokens(message)
+                        + sum(_estimate_tokens(m["parts"][0]) for m in messages) + 500)
+    return send, estimated_tokens
+
 def help_chat(user_question: str, api_key: str, chat_history: list = None) -> dict:
     """
     アプリのヘルプAIチャットボット
@@ -389,58 +1216,94 @@ def help_chat(user_question: str, api_key: str, chat_history: list = None) -> di
     Returns:
         dict: {"success": bool, "response": str, "error": str (optional)}
     """
-    if not api_key:
-        return {"success": False, "error": "APIキーが設定されていません。左側のメニューからAPIキーを設定してください。"}
-    
     if not user_question or not user_question.strip():
         return {"success": False, "error": "質問を入力してください。"}
     
+    _refresh_help_documents()
+    
+    # FAQと完全一致する質問・最初の質問のキャッシュはAPIを呼ばずに回答
+    faq_answer = _HELP_INDEX.answer_faq(user_question)
+    if faq_answer:
+        return {"success": True, "response": faq_answer}
+    if not chat_history:
+        cached_answer = _help_answer_cache.get(user_question)
+        if cached_answer:
+            return {"success": True, "response": cached_answer}
+    
+    if not api_key:
+        return {"success": False, "error": "APIキーが設定されていません。左側のメニューからAPIキーを設定してください。"}
+    
     try:
-        import google.generativeai as genai
-        genai.configure(api_key=api_key)
-        
-        model = genai.GenerativeModel("gemini-2.5-flash")
-        
-        # ヘルプコンテキストを読み込み
-        help_context = _load_help_context()
-        
-        # システムプロンプト
-        system_prompt = f"""あなたは「AI暗記カード」アプリのヘルプアシスタントです。
-ユーザーからの質問に、以下のアプリ情報を元に回答してください。
-
-【重要なルール】
-1. このアプリに関係する質問にのみ回答してください
-2. アプリに関係ない質問（天気、雑談、他のアプリについてなど）には丁寧にお断りしてください
-3. 回答は簡潔にしてください（2-3文程度が理想）
-4. 専門用語は分かりやすく説明してください
-5. 手順を説明する際は箇条書きを使ってください
-
-【アプリ情報】
-{help_context}
-"""
-        
-        # チャット履歴を組み立て
-        messages = [{"role": "user", "parts": [system_prompt + "\n\n（以下がユーザーとの会話です）"]}]
-        messages.append({"role": "model", "parts": ["了解しました。AI暗記カードアプリのヘルプアシスタントとして、ご質問にお答えします。"]})
-        
-        if chat_history:
-            for msg in chat_history:
-                role = "user" if msg.get("role") == "user" else "model"
-                messages.append({"role": role, "parts": [msg.get("content", "")]})
-        
-        # 現在の質問を追加
-        messages.append({"role": "user", "parts": [user_question]})
-        
         # チャットでレスポンスを生成
-        chat = model.start_chat(history=messages[:-1])
-        response = chat.send_message(user_question)
+        send, estimated_tokens = _build_help_request(user_question, chat_history)
+        response = _call_with_rate_limit(api_key, lambda key: send(key), estimated_tokens)
+        _log_token_usage(response)
         
+        if not chat_history:
+            _help_answer_cache.put(user_question, response.text)
         return {"success": True, "response": response.text}
         
     except Exception as e:
-        error_str = str(e).lower()
-        if "quota" in error_str or "rate" in error_str or "limit" in error_str or "429" in error_str:
+        if _is_quota_error(e):
             return {"success": False, "error": "APIの無料枠利用制限に達しました。しばらく待ってから再試行してください。"}
         print(f"ヘルプAIエラー: {e}")
         return {"success": False, "error": f"エラーが発生しました: {str(e)}"}
 
+def help_chat_stream(user_question: str, api_key: str, chat_history: list = None):
+    """
+    ヘルプAIチャットのストリーミング版（生成された分から順に返す）
+    
+    Args:
+        user_question (str): ユーザーの質問
+        api_key (str): Gemini APIキー
+        chat_history (list): 過去のチャット履歴 [{"role": "user/assistant", "content": "..."}, ...]
+        
+    Yields:
+        str: 回答テキストの断片（エラー時は「⚠️ 」で始まるメッセージ）
+    """
+    if not user_question or not user_question.strip():
+        yield "⚠️ 質問を入力してください。"
+        return
+    
+    _refresh_help_documents()
+    
+    # FAQと完全一致する質問・最初の質問のキャッシュはAPIを呼ばずに回答
+    faq_answer = _HELP_INDEX.answer_faq(user_question)
+    if faq_answer:
+        yield faq_answer
+        return
+    if not chat_history:
+        cached_answer = _help_answer_cache.get(user_question)
+        if cached_answer:
+            yield cached_answer
+            return
+    
+    if not api_key:
+        yield "⚠️ APIキーが設定されていません。左側のメニューからAPIキーを設定してください。"
+        return
+    
+    try:
+        send, estimated_tokens = _build_help_request(user_question, chat_history)
+        response = _call_with_rate_limit(api_key, lambda key: send(key, stream=True), estimated_tokens)
+        
+        answer = ""
+        for chunk in response:
+            try:
+                text = chunk.text
+            except ValueError:
+                # テキストを含まないチャンク（終了理由のみ等）
+                continue
+            if text:
+                answer += text
+                yield text
+        _log_token_usage(response)
+        
+        if answer and not chat_history:
+            _help_answer_cache.put(user_question, answer)
+        
+    except Exception as e:
+        if _is_quota_error(e):
+            yield "⚠️ APIの無料枠利用制限に達しました。しばらく待ってから再試行してください。"
+            return
+        print(f"ヘルプAIエラー: {e}")
+        yield f"⚠️ エラーが発生しました: {str(e)}"
@@ -0,0 +1,195 @@
+"""
+ヘルプ文書検索モジュール
+HELP_AI_CONTEXT.md / USER_GUIDE.md を見出し単位で索引し、文字bigramのBM25で検索
+"""
+import math
+import os
+import re
+import threading
+import time
+import unicodedata
+from collections import Counter, OrderedDict
+
+HELP_DOCUMENTS = ["HELP_AI_CONTEXT.md", "USER_GUIDE.md"]
+
+# BM25パラメータ
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+_HEADING_PATTERN = re.compile(r'^(#{1,6})\s+(.+?)\s*$')
+_SKIPPED_HEADINGS = {"目次"}
+_SYMBOL_PATTERN = re.compile(r'[\W_]+')
+
+def normalize_text(text):
+    """全角/半角をそろえ（NFKC）、小文字化し、空白と記号を除去"""
+    text = unicodedata.normalize("NFKC", text).lower()
+    return _SYMBOL_PATTERN.sub("", text)
+
+def normalize_question(text):
+    """質問の比較用に正規化（normalize_textに加えてカタカナをひらがなにそろえる）"""
+    return "".join(chr(ord(c) - 0x60) if "ァ" <= c <= "ヶ" else c for c in normalize_text(text))
+
+def char_ngrams(text, n=2):
+    """正規化したテキストの文字n-gram（n文字未満の場合はテキスト全体）"""
+    text = normalize_text(text)
+    if len(text) < n:
+        return [text] if text else []
+    return [text[i:i + n] for i in range(len(text) - n + 1)]
+
+def _split_sections(markdown, source):
+    """
+    Markdownを見出しごとのセクションに分割
+
+    Returns:
+        list: [{"source": str, "path": [見出し, ...], "body": str}, ...]
+    """
+    sections = []
+    headings = []  # [(レベル, 見出し), ...]
+    body = []
+
+    def flush():
+        text = "\n".join(body).strip()
+        if headings and text and headings[-1][1] not in _SKIPPED_HEADINGS:
+            sections.append({"source": source, "path": [h for _, h in headings], "body": text})
+
+    for line in markdown.splitlines():
+        match = _HEADING_PATTERN.match(line)
+        if not match:
+            body.append(line)
+            continue
+        flush()
+        body = []
+        level = len(match.group(1))
+        while headings and headings[-1][0] >= level:
+            headings.pop()
+        headings.append((level, match.group(2)))
+
+    flush()
+    return sections
+
+def _faq_entry(section):
+    """FAQセクションなら (質問, 回答) を返す"""
+    if len(section["path"]) < 2 or "よくある質問" not in section["path"][-2]:
+        return None
+    question = re.sub(r'^Q[:：]\s*', "", section["path"][-1])
+    answer = re.sub(r'^A[:：]\s*', "", section["body"])
+    return question, answer
+
+class HelpIndex:
+    """ヘルプ文書のセクション検索（文字bigramのBM25）とFAQの完全一致回答"""
+
+    def __init__(self, sections):
+        self.sections = sections
+        self._postings = {}  # bigram → [(セクション番号, 出現回数), ...]
+        self._lengths = []
+        self._faq = {}  # 正規化した質問 → 回答
+
+        for i, section in enumerate(sections):
+            terms = char_ngrams(" ".join(section["path"]) + "\n" + section["body"])
+            self._lengths.append(len(terms))
+            for term, count in Counter(terms).items():
+                self._postings.setdefault(term, []).append((i, count))
+
+            faq = _faq_entry(section)
+            if faq:
+                self._faq.setdefault(normalize_question(faq[0]), faq[1])
+
+        self._avg_length = sum(self._lengths) / len(self._lengths) if self._lengths else 0
+
+    def search(self, query, top_k=3):
+        """
+        クエリに近いセクションを検索
+
+        Returns:
+            list: [(スコア, セクション), ...]（スコアの高い順、最大top_k件）
+        """
+        n = len(self.sections)
+        scores = Counter()
+        for term in set(char_ngrams(query)):
+            postings = self._postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (n - len(postings) + 0.5) / (len(postings) + 0.5))
+            for i, tf in postings:
+                norm = BM25_K1 * (1 - BM25_B + BM25_B * self._lengths[i] / self._avg_length)
+                scores[i] += idf * tf * (BM25_K1 + 1) / (tf + norm)
+        return [(score, self.sections[i]) for i, score in scores.most_common(top_k)]
+
+    def answer_faq(self, question):
+        """FAQの質問と（正規化後に）完全一致すれば回答を返す"""
+        return self._faq.get(normalize_question(question))
+
+def format_section(section):
+    """プロンプトに埋め込む形式に整形"""
+    return f"## {' > '.join(section['path'])}\n{section['body']}"
+
+def _document_path(filename):
+    """スクリプトと同じディレクトリのファイルパス"""
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), filename)
+
+def help_documents_version(filenames=HELP_DOCUMENTS):
+    """ヘルプ文書の更新検知用のバージョン（各ファイルの更新時刻とサイズ）"""
+    version = []
+    for filename in filenames:
+        try:
+            stat = os.stat(_document_path(filename))
+            version.append((stat.st_mtime_ns, stat.st_size))
+        except OSError:
+            version.append(None)
+    return tuple(version)
+
+def build_help_index(filenames=HELP_DOCUMENTS):
+    """スクリプトと同じディレクトリのヘルプ文書から索引を作成"""
+    sections = []
+    for filename in filenames:
+        try:
+            with open(_document_path(filename), "r", encoding="utf-8") as f:
+                sections.extend(_split_sections(f.read(), filename))
+        except Exception as e:
+            print(f"ヘルプ文書読み込みエラー（{filename}）: {e}")
+    return HelpIndex(sections)
+
+# ============ 回答キャッシュ ============
+
+class HelpAnswerCache:
+    """
+    よくある質問への回答キャッシュ（プロセス内で全ユーザー共有）
+
+    正規化した質問が完全一致した場合だけ回答を返す
+    （「削除する」と「追加する」のように文字の重なりが大きくても意味が違う質問があるため、類似度では照合しない）。
+    """
+
+    def __init__(self, ttl=24 * 3600, max_entries=500):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.stats = {"hits": 0, "misses": 0}
+        self._entries = OrderedDict()  # 正規化した質問 → (回答, 保存時刻)
+        self._lock = threading.Lock()
+
+    def get(self, question):
+        """キャッシュされた回答を返す（なければNone）"""
+        key = normalize_question(question)
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and now - entry[1] < self.ttl:
+                self._entries.move_to_end(key)
+                self.stats["hits"] += 1
+                return entry[0]
+            self.stats["misses"] += 1
+            return None
+
+    def put(self, question, answer):
+        """回答を保存（上限を超えたら古いものから削除）"""
+        key = normalize_question(question)
+        if not key:
+            return
+        with self._lock:
+            self._entries[key] = (answer, time.time())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
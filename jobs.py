@@ -0,0 +1,169 @@
+"""
+バックグラウンドジョブモジュール
+AI呼び出しをスレッドプールで実行し、画面の再実行（スクリプトスレッド）をブロックしない
+
+ジョブはプロセス内のレジストリで管理し、画面側はジョブIDで進捗・結果を確認する。
+同じユーザーのジョブは同時実行数を制限し、超えた分はユーザーごとの待ち行列で順番に実行する。
+"""
+import threading
+import time
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+JOB_MAX_WORKERS = 8  # プロセス全体の同時実行数
+JOB_MAX_RUNNING_PER_USER = 2  # ユーザーごとの同時実行数
+JOB_MAX_QUEUED_PER_USER = 5  # ユーザーごとの待ち行列の上限（超えると受け付けない）
+JOB_RESULT_TTL = 600  # 完了したジョブを保持する時間（秒）
+
+class JobLimitExceeded(Exception):
+    """ユーザーの待ち行列が上限に達している"""
+    pass
+
+class Job:
+    """
+    1件のバックグラウンドジョブ
+
+    status: "queued" → "running" → "done" / "error"（待ち行列中に取り消すと "cancelled"）
+    """
+
+    def __init__(self, user_id, kind, func):
+        self.id = uuid.uuid4().hex
+        self.user_id = user_id
+        self.kind = kind
+        self.status = "queued"
+        self.progress = None  # 0.0〜1.0（不明な場合はNone）
+        self.message = ""
+        self.partial = ""  # ストリーミング中の途中結果
+        self.result = None
+        self.error = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self._func = func
+
+    @property
+    def done(self):
+        return self.status in ("done", "error", "cancelled")
+
+    def elapsed(self):
+        """開始からの経過秒数（未開始なら0）"""
+        if self.started_at is None:
+            return 0.0
+        return (self.finished_at or time.time()) - self.started_at
+
+    def set_progress(self, completed, total, message=""):
+        """進捗を更新（ジョブ関数から呼ぶ）"""
+        self.progress = completed / total if total else None
+        self.message = message
+
+class JobRegistry:
+    """スレッドプールとジョブの登録簿（プロセス内で全ユーザー共有）"""
+
+    def __init__(self, max_workers=JOB_MAX_WORKERS, max_running_per_user=JOB_MAX_RUNNING_PER_USER,
+                 max_queued_per_user=JOB_MAX_QUEUED_PER_USER, result_ttl=JOB_RESULT_TTL):
+        self.max_running_per_user = max_running_per_user
+        self.max_queued_per_user = max_queued_per_user
+        self.result_ttl = result_ttl
+        self.metrics = {"submitted": 0, "completed": 0, "failed": 0, "rejected": 0, "total_queue_wait": 0.0}
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="job")
+        self._jobs = {}  # ジョブID → Job
+        self._running = {}  # ユーザーID → 実行中のジョブ数
+        self._queues = {}  # ユーザーID → 待ち行列（deque）
+        self._lock = threading.Lock()
+
+    def submit(self, user_id, kind, func):
+        """
+        ジョブを登録
+
+        Args:
+            user_id (str): ユーザーID（同時実行数の制限単位）
+            kind (str): ジョブの種類（"split" など、画面側の識別用）
+            func (callable): func(job) を実行し、戻り値が結果になる
+
+        Returns:
+            Job: 登録したジョブ
+
+        Raises:
+            JobLimitExceeded: ユーザーの待ち行列が上限に達している場合
+        """
+        job = Job(user_id, kind, func)
+        with self._lock:
+            self._remove_expired()
+            queue = self._queues.setdefault(user_id, deque())
+            if len(queue) >= self.max_queued_per_user:
+                self.metrics["rejected"] += 1
+                raise JobLimitExceeded("処理中のリクエストが多すぎます。完了してから再度お試しください。")
+            self._jobs[job.id] = job
+            queue.append(job)
+            self.metrics["submitted"] += 1
+            self._dispatch(user_id)
+        return job
+
+    def get(self, job_id, user_id=None):
+        """ジョブを取得（user_idを指定した場合は本人のジョブのみ）"""
+        job = self._jobs.get(job_id)
+        if job is None or (user_id is not None and job.user_id != user_id):
+            return None
+        return job
+
+    def cancel(self, job_id):
+        """待ち行列中のジョブを取り消す（実行中のジョブは取り消せない）"""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or job.status != "queued":
+                return False
+            self._queues[job.user_id].remove(job)
+            job.status = "cancelled"
+            job.finished_at = time.time()
+            return True
+
+    def user_jobs(self, user_id):
+        """ユーザーの未完了のジョブ"""
+        return [job for job in list(self._jobs.values()) if job.user_id == user_id and not job.done]
+
+    def _dispatch(self, user_id):
+        """同時実行数の枠が空いていれば待ち行列の先頭を実行（ロック内で呼ぶ）"""
+        queue = self._queues.get(user_id)
+        while queue and self._running.get(user_id, 0) < self.max_running_per_user:
+            job = queue.popleft()
+            self._running[user_id] = self._running.get(user_id, 0) + 1
+            job.status = "running"
+            job.started_at = time.time()
+            self.metrics["total_queue_wait"] += job.started_at - job.created_at
+            self._executor.submit(self._run, job)
+
+    def _run(self, job):
+        try:
+            job.result = job._func(job)
+            job.status = "done"
+        except Exception as e:
+            print(f"ジョブエラー（{job.kind}）: {e}")
+            job.error = str(e)
+            job.status = "error"
+        finally:
+            job.finished_at = time.time()
+            job._func = None
+            with self._lock:
+                self.metrics["completed" if job.status == "done" else "failed"] += 1
+                self._running[job.user_id] -= 1
+                self._dispatch(job.user_id)
+
+    def _remove_expired(self):
+        """完了から一定時間たったジョブを削除（ロック内で呼ぶ）"""
+        now = time.time()
+        expired = [job_id for job_id, job in self._jobs.items()
+                   if job.done and now - job.finished_at > self.result_ttl]
+        for job_id in expired:
+            del self._jobs[job_id]
+
+_registry = None
+_registry_lock = threading.Lock()
+
+def get_job_registry():
+    """プロセス共通のジョブレジストリ"""
+    global _registry
+    with _registry_lock:
+        if _registry is None:
+            _registry = JobRegistry()
+        return _registry
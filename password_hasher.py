@@ -0,0 +1,178 @@
+"""
+パスワードハッシュモジュール
+標準ライブラリのscrypt / PBKDF2でソルト付きハッシュを作成し、旧形式（SHA-256）も検証する
+
+ハッシュ計算は意図的に重いため、上限付きのワーカースレッドで実行する
+（hashlibの計算中はGILが解放されるため、ログインが集中しても同時計算数とメモリ使用量が上限で抑えられる）。
+
+形式:
+    scrypt$<n>$<r>$<p>$<ソルト>$<ハッシュ>
+    pbkdf2_sha256$<反復回数>$<ソルト>$<ハッシュ>
+    （旧形式）SHA-256の16進文字列64文字
+
+ベンチマーク:
+    python password_hasher.py --benchmark
+"""
+import argparse
+import base64
+import binascii
+import hashlib
+import hmac
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+
+# ハッシュ方式とコスト（変更すると次回ログイン時に自動で再ハッシュされる）
+PASSWORD_HASH_ALGORITHM = "scrypt"  # "scrypt" または "pbkdf2_sha256"
+SCRYPT_N = 2 ** 14  # CPU/メモリコスト（メモリ使用量は 128 * n * r バイト = 16MB）
+SCRYPT_R = 8
+SCRYPT_P = 1
+PBKDF2_ITERATIONS = 600000
+PASSWORD_SALT_BYTES = 16
+PASSWORD_HASH_MAX_WORKERS = os.cpu_count() or 2  # 同時に計算するハッシュ数の上限
+PASSWORD_HASH_TIMEOUT = 30  # 待ち行列を含めた最大待ち時間（秒）
+
+_executor = ThreadPoolExecutor(max_workers=PASSWORD_HASH_MAX_WORKERS, thread_name_prefix="password-hash")
+
+class PasswordHasherBusy(Exception):
+    """ハッシュ計算の待ち行列がPASSWORD_HASH_TIMEOUT以内に空かなかった"""
+    pass
+
+def _b64encode(data):
+    return base64.b64encode(data).decode("ascii")
+
+def _b64decode(text):
+    return base64.b64decode(text.encode("ascii"))
+
+def _scrypt(password, salt, n, r, p):
+    return hashlib.scrypt(password.encode(), salt=salt, n=n, r=r, p=p, maxmem=256 * n * r, dklen=32)
+
+def _pbkdf2(password, salt, iterations):
+    return hashlib.pbkdf2_hmac("sha256", password.encode(), salt, iterations)
+
+def _hash(password):
+    """現在の設定でハッシュを作成（ワーカースレッドで実行）"""
+    salt = os.urandom(PASSWORD_SALT_BYTES)
+    if PASSWORD_HASH_ALGORITHM == "pbkdf2_sha256":
+        digest = _pbkdf2(password, salt, PBKDF2_ITERATIONS)
+        return f"pbkdf2_sha256${PBKDF2_ITERATIONS}${_b64encode(salt)}${_b64encode(digest)}"
+    digest = _scrypt(password, salt, SCRYPT_N, SCRYPT_R, SCRYPT_P)
+    return f"scrypt${SCRYPT_N}${SCRYPT_R}${SCRYPT_P}${_b64encode(salt)}${_b64encode(digest)}"
+
+def _verify(password, stored_hash):
+    """
+    保存されたハッシュと照合（ワーカースレッドで実行）
+
+    Returns:
+        tuple: (一致したか, 現在の設定で再ハッシュすべきか)
+    """
+    parts = stored_hash.split("$")
+    try:
+        if parts[0] == "scrypt" and len(parts) == 6:
+            n, r, p = int(parts[1]), int(parts[2]), int(parts[3])
+            digest = _scrypt(password, _b64decode(parts[4]), n, r, p)
+            ok = hmac.compare_digest(digest, _b64decode(parts[5]))
+            return ok, PASSWORD_HASH_ALGORITHM != "scrypt" or (n, r, p) != (SCRYPT_N, SCRYPT_R, SCRYPT_P)
+        if parts[0] == "pbkdf2_sha256" and len(parts) == 4:
+            iterations = int(parts[1])
+            digest = _pbkdf2(password, _b64decode(parts[2]), iterations)
+            ok = hmac.compare_digest(digest, _b64decode(parts[3]))
+            return ok, PASSWORD_HASH_ALGORITHM != "pbkdf2_sha256" or iterations != PBKDF2_ITERATIONS
+        # 旧形式: ソルトなしSHA-256
+        legacy = hashlib.sha256(password.encode()).hexdigest()
+        return hmac.compare_digest(legacy, stored_hash), True
+    except (binascii.Error, ValueError, TypeError):
+        # 壊れた・非ASCIIの保存値（数値・Base64として読めない、scryptのパラメータが不正など）は不一致として扱う
+        return False, False
+
+def _run(func, *args):
+    """
+    ワーカースレッドで実行して結果を待つ
+
+    Raises:
+        PasswordHasherBusy: PASSWORD_HASH_TIMEOUT以内に終わらなかった場合（待ち行列の分は取り消す）
+    """
+    future = _executor.submit(func, *args)
+    try:
+        return future.result(timeout=PASSWORD_HASH_TIMEOUT)
+    except FutureTimeoutError:
+        future.cancel()
+        raise PasswordHasherBusy(f"password hash: not finished within {PASSWORD_HASH_TIMEOUT}s")
+
+def hash_password(password):
+    """
+    パスワードをソルト付きでハッシュ化
+
+    Raises:
+        PasswordHasherBusy: ログインの集中で計算が間に合わなかった場合
+    """
+    return _run(_hash, password)
+
+def verify_password(password, stored_hash):
+    """
+    パスワードを検証
+
+    Returns:
+        tuple: (一致したか, 再ハッシュすべきか（旧形式・コスト変更時）)
+
+    Raises:
+        PasswordHasherBusy: ログインの集中で計算が間に合わなかった場合
+    """
+    if not stored_hash:
+        return False, False
+    return _run(_verify, password, stored_hash)
+
+# ============ ベンチマーク ============
+
+def benchmark(seconds=3.0):
+    """
+    現在の設定での1秒あたりのハッシュ計算数（= ログイン数）を計測
+
+    Returns:
+        dict: {"algorithm", "per_hash_ms", "per_core_per_second", "pool_per_second", "workers"}
+    """
+    stored = _hash("benchmark-password")
+
+    # 1スレッド
+    count = 0
+    started = time.perf_counter()
+    while time.perf_counter() - started < seconds:
+        _verify("benchmark-password", stored)
+        count += 1
+    single = count / (time.perf_counter() - started)
+
+    # ワーカープール（ログインが集中した場合）
+    count = 0
+    started = time.perf_counter()
+    while time.perf_counter() - started < seconds:
+        futures = [_executor.submit(_verify, "benchmark-password", stored) for _ in range(PASSWORD_HASH_MAX_WORKERS)]
+        for future in futures:
+            future.result()
+        count += len(futures)
+    pooled = count / (time.perf_counter() - started)
+
+    return {
+        "algorithm": PASSWORD_HASH_ALGORITHM,
+        "per_hash_ms": 1000 / single,
+        "per_core_per_second": single,
+        "pool_per_second": pooled,
+        "workers": PASSWORD_HASH_MAX_WORKERS
+    }
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="パスワードハッシュのベンチマーク")
+    parser.add_argument("--benchmark", action="store_true", help="1秒あたりのログイン数を計測")
+    parser.add_argument("--seconds", type=float, default=3.0, help="計測時間（秒）")
+    args = parser.parse_args(argv)
+
+    if args.benchmark:
+        result = benchmark(args.seconds)
+        print(f"方式: {result['algorithm']}")
+        print(f"1回あたり: {result['per_hash_ms']:.1f} ms")
+        print(f"1コアあたり: {result['per_core_per_second']:.1f} ログイン/秒")
+        print(f"ワーカー{result['workers']}本: {result['pool_per_second']:.1f} ログイン/秒")
+    else:
+        parser.print_help()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,190 @@
+"""
+ルールベース文節分割モジュール
+APIキーがない場合・利用制限時に使う、辞書と文字種だけによるオフライン分割
+"""
+import re
+
+# ============ 文字種 ============
+
+# 名詞・語幹になる文字（漢字・カタカナ・英数字）
+_CONTENT_CHARS = "一-鿿㐀-䶿々〆〇ヶヵァ-ヺー・ｦ-ﾟ0-9A-Za-z０-９Ａ-Ｚａ-ｚ"
+_HIRAGANA_CHARS = "ぁ-ゖゝゞ"
+_CIRCLED_CHARS = "①-⒇㉑-㉟㊱-㊿"
+
+_RUN_PATTERN = re.compile(
+    f"(?P<content>[{_CONTENT_CHARS}]+)"
+    f"|(?P<hiragana>[{_HIRAGANA_CHARS}]+)"
+    f"|(?P<circled>[{_CIRCLED_CHARS}])"
+    r"|(?P<space>\s+)"
+    r"|(?P<punct>.)",
+    re.S
+)
+
+# 助詞の直前に来うる活用語尾（ここでのみ助詞の切れ目を探す）
+_WORD_FINAL = set("いきしちにひみりぎじびうくすつぬふむるぐずぶえけせてねへめれげぜでべただばん")
+
+# ============ 辞書 ============
+
+# 独立したブロックにする助詞・格助詞相当表現・助動詞
+_PARTICLES = [
+    "によって", "により", "による", "によると", "によれば",
+    "として", "としては", "としての", "という",
+    "に対して", "に対する", "において", "における", "について", "についての",
+    "に関して", "に関する", "にとって", "に基づき", "に基づく", "に従い", "に限り",
+    "をもって", "とともに", "にもかかわらず",
+    "にも", "には", "では", "とは", "とも", "との", "での", "への", "からは", "からの",
+    "までに", "までの", "から", "まで", "より", "ので", "のに", "けれども", "けれど",
+    "ものの", "ながら", "など", "だけ", "しか", "ばかり", "こそ", "さえ", "でも", "ずつ",
+    "は", "が", "を", "に", "で", "の", "と", "も", "へ", "や",
+    "である", "であり", "であって", "であった", "であれば", "であろう",
+    "ではない", "ではなく", "でない", "です", "でした", "だった",
+]
+
+# 独立したブロックにする接続詞・指示語・副詞・形式名詞
+_WORDS = [
+    "そこで", "すなわち", "しかし", "しかも", "また", "または", "もしくは", "かつ",
+    "ただし", "なお", "さらに", "もっとも", "つまり", "したがって", "よって", "ゆえに",
+    "そして", "あるいは", "および", "ならびに",
+    "これ", "それ", "あれ", "ここ", "そこ",
+    "すでに", "ともに", "とくに", "つねに", "まさに", "ただちに", "すべて", "いずれ",
+    "こと", "もの", "とき", "ところ", "ため", "おそれ",
+]
+
+# 直後の名詞と1ブロックにまとめる連体詞
+_PREFIXES = ["この", "その", "あの", "どの", "かかる", "いわゆる", "あらゆる", "いかなる"]
+
+# 助詞で始まるが分割しない動詞（前の語幹に続ける）
+_VERBS = ["できる", "できない", "できず", "できた", "でき"]
+
+def _build_lexicon():
+    """先頭文字 → [(語, 種別), ...]（長い語から順）の辞書を作成"""
+    lexicon = {}
+    for words, kind in ((_PARTICLES, "particle"), (_WORDS, "word"), (_PREFIXES, "prefix"), (_VERBS, "verb")):
+        for word in words:
+            lexicon.setdefault(word[0], []).append((word, kind))
+    for entries in lexicon.values():
+        entries.sort(key=lambda entry: len(entry[0]), reverse=True)
+    return lexicon
+
+_LEXICON = _build_lexicon()
+
+def _match_lexicon(run, pos):
+    """run[pos:] の先頭に一致する最長の辞書語を返す"""
+    for word, kind in _LEXICON.get(run[pos], ()):
+        if run.startswith(word, pos):
+            return word, kind
+    return None
+
+# ============ 分割 ============
+
+def _scan_hiragana(run):
+    """
+    ひらがな列を送り仮名と後続ブロックに分ける
+
+    Returns:
+        tuple: (直前の語幹に続ける送り仮名, [(ブロック, 種別), ...])
+    """
+    okurigana = None
+    tokens = []
+    pending = ""
+    pos = 0
+
+    while pos < len(run):
+        match = None
+        if not pending or pending[-1] in _WORD_FINAL:
+            match = _match_lexicon(run, pos)
+
+        if match and match[1] == "verb":
+            pending += match[0]
+            pos += len(match[0])
+        elif match:
+            if okurigana is None:
+                okurigana = pending
+            elif pending:
+                tokens.append((pending, "word"))
+            pending = ""
+            tokens.append(match)
+            pos += len(match[0])
+        else:
+            pending += run[pos]
+            pos += 1
+
+    if okurigana is None:
+        okurigana = pending
+    elif pending:
+        tokens.append((pending, "word"))
+    return okurigana, tokens
+
+def rule_based_split(text):
+    """
+    辞書と文字種によるオフライン文節分割
+
+    split_into_phrasesのプロンプトと同じ規則を近似する:
+    助詞・句読点・丸数字は独立、漢字/カタカナ/英数字の連続は複合語として1ブロック、
+    活用語尾は語幹に含め、連体詞・形容詞 + 名詞は1ブロックにまとめる。
+    空白は直前の文節の末尾に含める（文節を連結すると元のテキストに戻る）。
+
+    Args:
+        text (str): 分割するテキスト
+
+    Returns:
+        list: 文節のリスト
+    """
+    runs = [(m.lastgroup, m.group()) for m in _RUN_PATTERN.finditer(text)]
+    blocks = []
+    prefix = ""  # 次の名詞にまとめる連体詞・形容詞
+    leading = ""  # 先頭の空白（最初の文節に含める）
+    i = 0
+
+    while i < len(runs):
+        kind, value = runs[i]
+        next_kind = runs[i + 1][0] if i + 1 < len(runs) else None
+
+        if kind == "content":
+            word = prefix + value
+            prefix = ""
+            tokens = []
+            if next_kind == "hiragana":
+                okurigana, tokens = _scan_hiragana(runs[i + 1][1])
+                word += okurigana
+                i += 1
+                after_kind = runs[i + 1][0] if i + 1 < len(runs) else None
+                # 1文字の送り仮名（取り消し）や形容詞・形容動詞（重要な事項）は後ろの名詞と結合
+                if not tokens and after_kind == "content" and (
+                        len(okurigana) == 1 or (len(okurigana) == 2 and okurigana[-1] in "いな")):
+                    prefix = word
+                    i += 1
+                    continue
+            blocks.append(word)
+        elif kind == "hiragana":
+            okurigana, tokens = _scan_hiragana(value)
+            if okurigana:
+                tokens.insert(0, (prefix + okurigana, "word"))
+                prefix = ""
+        else:
+            tokens = []
+            if prefix:
+                blocks.append(prefix)
+                prefix = ""
+            if kind != "space":
+                blocks.append(value)
+            elif blocks:
+                blocks[-1] += value
+            else:
+                leading += value
+
+        for token, token_kind in tokens:
+            if prefix:
+                blocks.append(prefix)
+                prefix = ""
+            if token_kind == "prefix":
+                prefix = token
+            else:
+                blocks.append(token)
+        i += 1
+
+    if prefix:
+        blocks.append(prefix)
+    if leading and blocks:
+        blocks[0] = leading + blocks[0]
+    return blocks
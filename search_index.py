@@ -0,0 +1,245 @@
+"""
+検索インデックスモジュール
+原文カード・暗記カードの文字バイグラム（2文字の組）の転置インデックスをユーザーごとにプロセス内で保持する
+
+日本語は単語の区切りがないため、2文字ずつの組で候補を絞り込み、候補だけ部分一致を確認する。
+カードの追加・編集・削除はstorageから差分で反映し、他のプロセス（一括インポートなど）の更新は
+一定時間ごとの作り直しで取り込む。作成は数万枚で数秒かかるため、カード管理画面を開いた時点で
+バックグラウンドで始めておく（warm_search_index）。
+"""
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from singleflight import coalesce
+
+SEARCH_INDEX_TTL = 1800  # インデックスを作り直すまでの時間（秒）
+SEARCH_INDEX_MAX_USERS = 100  # 保持するユーザー数の上限（超えたら古いものから破棄）
+
+def normalize_text(text):
+    """検索用に正規化（全角・半角の統一と小文字化）"""
+    return unicodedata.normalize("NFKC", text or "").lower()
+
+def _bigrams(text):
+    """正規化済みテキストの文字バイグラム（重複なし）"""
+    return {text[i:i + 2] for i in range(len(text) - 1)}
+
+class SearchIndex:
+    """
+    1ユーザー分の転置インデックス
+
+    文書のキーは ("source", 原文カードID) または ("card", 暗記カードID)。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._texts = {}  # キー → 正規化済みテキスト
+        self._postings = {}  # バイグラム → キーの集合
+        self.built_at = time.time()
+
+    def __len__(self):
+        return len(self._texts)
+
+    def add(self, key, *fields):
+        """文書を追加（同じキーがあれば置き換える）"""
+        text = "\n".join(normalize_text(field) for field in fields)
+        with self._lock:
+            self._remove(key)
+            self._texts[key] = text
+            for gram in _bigrams(text):
+                self._postings.setdefault(gram, set()).add(key)
+
+    def remove(self, key):
+        """文書を削除"""
+        with self._lock:
+            self._remove(key)
+
+    def _remove(self, key):
+        """ロック内で呼ぶ"""
+        text = self._texts.pop(key, None)
+        if text is None:
+            return
+        for gram in _bigrams(text):
+            keys = self._postings.get(gram)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._postings[gram]
+
+    def search(self, query):
+        """
+        検索（空白区切りの語をすべて含む文書）
+
+        Returns:
+            list: [(キー, 一致回数), ...]（一致回数の多い順）
+        """
+        terms = [normalize_text(term) for term in query.split()]
+        terms = [term for term in terms if term]
+        if not terms:
+            return []
+
+        with self._lock:
+            # 各語のバイグラムの出現文書を小さい順に積集合をとって候補を絞る
+            postings = []
+            for term in terms:
+                for gram in _bigrams(term):
+                    keys = self._postings.get(gram)
+                    if not keys:
+                        return []
+                    postings.append(keys)
+            if postings:
+                postings.sort(key=len)
+                candidates = set(postings[0])
+                for keys in postings[1:]:
+                    candidates &= keys
+                    if not candidates:
+                        return []
+            else:
+                # 1文字の語だけの場合は全文書を確認
+                candidates = self._texts.keys()
+
+            # バイグラムが揃っていても連続しているとは限らないため、部分一致を確認して数える
+            results = []
+            for key in candidates:
+                text = self._texts[key]
+                score = 0
+                for term in terms:
+                    count = text.count(term)
+                    if not count:
+                        break
+                    score += count
+                else:
+                    results.append((key, score))
+
+        results.sort(key=lambda item: item[1], reverse=True)
+        return results
+
+def build_search_index(deck):
+    """カード管理用インデックス（storage.load_deck）から検索インデックスを作成"""
+    documents = [(("source", source["id"]), source.get("title", ""), source.get("source_text", ""))
+                 for source in deck["sources"]]
+    documents += [(("card", card["id"]), card.get("question", ""), card.get("answer", ""))
+                  for card in deck["cards"]]
+
+    # 作成中のインデックスは他から参照されないため、ロックと置き換え確認を省いてまとめて登録する
+    index = SearchIndex()
+    texts = index._texts
+    postings = index._postings
+    for key, *fields in documents:
+        text = "\n".join(normalize_text(field) for field in fields)
+        texts[key] = text
+        for gram in _bigrams(text):
+            keys = postings.get(gram)
+            if keys is None:
+                postings[gram] = {key}
+            else:
+                keys.add(key)
+    return index
+
+# ============ ユーザーごとのインデックス ============
+
+_indexes = OrderedDict()  # ユーザーID → SearchIndex
+_indexes_lock = threading.Lock()
+_write_counts = {}  # ユーザーID → 差分反映の回数（作成中の更新の検出用）
+_warming = set()  # バックグラウンドで作成中のユーザーID
+
+def _get_index(user_id, count_write=False):
+    """作成済みのインデックス（なければNone）"""
+    with _indexes_lock:
+        if count_write:
+            _write_counts[user_id] = _write_counts.get(user_id, 0) + 1
+        return _indexes.get(user_id)
+
+def _fresh_index(user_id):
+    """期限内のインデックス（なければNone）"""
+    with _indexes_lock:
+        index = _indexes.get(user_id)
+        if index is not None and time.time() - index.built_at < SEARCH_INDEX_TTL:
+            _indexes.move_to_end(user_id)
+            return index
+        return None
+
+def _build_and_register(user_id, deck):
+    """deckから作成して登録"""
+    with _indexes_lock:
+        writes_before = _write_counts.get(user_id, 0)
+
+    index = build_search_index(deck)
+    with _indexes_lock:
+        # 作成中のカード更新はdeckに含まれていない可能性があるため、次回の取得時に作り直す
+        if _write_counts.get(user_id, 0) != writes_before:
+            index.built_at = 0
+        _indexes[user_id] = index
+        _indexes.move_to_end(user_id)
+        while len(_indexes) > SEARCH_INDEX_MAX_USERS:
+            _indexes.popitem(last=False)
+    return index
+
+def get_search_index(user_id, deck):
+    """
+    ユーザーの検索インデックスを取得（未作成・期限切れならdeckから作成、作成中なら完了を待つ）
+
+    Args:
+        deck (dict): storage.load_deck の戻り値
+    """
+    index = _fresh_index(user_id)
+    if index is not None:
+        return index
+    return coalesce(("build_search_index", user_id), lambda: _build_and_register(user_id, deck))
+
+def warm_search_index(user_id, deck):
+    """未作成・期限切れならバックグラウンドで作成を始める（検索される前に呼んでおく）"""
+    if _fresh_index(user_id) is not None:
+        return
+    with _indexes_lock:
+        if user_id in _warming:
+            return
+        _warming.add(user_id)
+
+    def run():
+        try:
+            get_search_index(user_id, deck)
+        except Exception as e:
+            print(f"検索インデックス作成エラー: {e}")
+        finally:
+            with _indexes_lock:
+                _warming.discard(user_id)
+
+    threading.Thread(target=run, name="search-index", daemon=True).start()
+
+def search_deck(user_id, deck, query):
+    """
+    原文カード・暗記カードを検索
+
+    Returns:
+        dict: {"sources": [原文カードID], "cards": [暗記カードID]}（それぞれ一致回数の多い順）
+    """
+    results = {"sources": [], "cards": []}
+    for (kind, doc_id), _ in get_search_index(user_id, deck).search(query):
+        results["sources" if kind == "source" else "cards"].append(doc_id)
+    return results
+
+def index_source(user_id, source_id, title, source_text):
+    """原文カードの追加を反映（インデックス未作成なら何もしない）"""
+    index = _get_index(user_id, count_write=True)
+    if index is not None:
+        index.add(("source", source_id), title, source_text)
+
+def index_card(user_id, card_id, question, answer):
+    """暗記カードの追加・編集を反映（インデックス未作成なら何もしない）"""
+    index = _get_index(user_id, count_write=True)
+    if index is not None:
+        index.add(("card", card_id), question, answer)
+
+def unindex_source(user_id, source_id):
+    """原文カードの削除を反映"""
+    index = _get_index(user_id, count_write=True)
+    if index is not None:
+        index.remove(("source", source_id))
+
+def unindex_cards(user_id, card_ids):
+    """暗記カードの削除を反映"""
+    index = _get_index(user_id, count_write=True)
+    if index is not None:
+        for card_id in card_ids:
+            index.remove(("card", card_id))
@@ -0,0 +1,107 @@
+"""
+シングルフライトモジュール
+同じキーの処理が同時に要求された場合は1回だけ実行し、待っていた呼び出し元にも同じ結果を返す（プロセス内）
+
+例: 同じユーザーが2つのタブで同時に開いた場合のカード読み込み、
+    同じ文章が同時に貼り付けられた場合のAI文節分割
+"""
+import threading
+
+class _Call:
+    """実行中の1回分の処理"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.ok = False
+
+class SingleFlight:
+    """
+    キーごとに実行中の処理を1つに束ねる
+
+    結果は同時に待っていた全員で共有するため、呼び出し側で変更する場合はコピーして使うこと。
+    完了後の結果は保持しない（キャッシュではない）。
+    共有するのは成功した結果だけで、先に実行した処理が失敗した場合、待っていた呼び出し元は
+    それぞれ改めて実行する（他の呼び出し元の一時的なエラーや利用制限を引き継がない）。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}  # キー → _Call
+        self._metrics = {}  # 種類（キーの先頭要素）→ {"executed", "deduplicated", "retried"}
+
+    def _count(self, key, name):
+        """メトリクスを加算（ロック内で呼ぶ）"""
+        kind = key[0] if isinstance(key, tuple) else key
+        metrics = self._metrics.setdefault(kind, {"executed": 0, "deduplicated": 0, "retried": 0})
+        metrics[name] += 1
+
+    def do(self, key, func):
+        """
+        funcを実行して結果を返す（同じキーの処理が実行中なら、その完了を待って結果を共有）
+
+        Args:
+            key (hashable): 処理の識別キー（タプルの場合は先頭要素がメトリクスの種類になる）
+            func (callable): 引数なしで呼び出す処理
+
+        Raises:
+            funcが送出した例外（自分で実行した場合のみ）
+        """
+        while True:
+            with self._lock:
+                call = self._calls.get(key)
+                leader = call is None
+                if leader:
+                    call = _Call()
+                    self._calls[key] = call
+                    self._count(key, "executed")
+                else:
+                    self._count(key, "deduplicated")
+
+            if leader:
+                break
+            call.done.wait()
+            if call.ok:
+                return call.result
+            # 先に実行した処理が失敗した場合は、自分で実行し直す
+            with self._lock:
+                self._count(key, "retried")
+
+        try:
+            call.result = func()
+            call.ok = True
+            return call.result
+        finally:
+            with self._lock:
+                if self._calls.get(key) is call:
+                    del self._calls[key]
+            call.done.set()
+
+    def forget(self, key):
+        """実行中の処理を切り離し、以降の呼び出しは新しく実行する（データ更新後など）"""
+        with self._lock:
+            self._calls.pop(key, None)
+
+    def metrics(self):
+        """
+        Returns:
+            dict: {種類: {"executed": 実行回数, "deduplicated": 相乗りした回数,
+                         "retried": 相乗りした処理が失敗して実行し直した回数}}
+        """
+        with self._lock:
+            return {kind: dict(m) for kind, m in self._metrics.items()}
+
+# プロセス共通のインスタンス
+_singleflight = SingleFlight()
+
+def coalesce(key, func):
+    """プロセス共通のSingleFlightでfuncを実行（SingleFlight.doを参照）"""
+    return _singleflight.do(key, func)
+
+def forget(key):
+    """プロセス共通のSingleFlightから実行中の処理を切り離す"""
+    _singleflight.forget(key)
+
+def get_singleflight_metrics():
+    """プロセス共通のSingleFlightのメトリクス"""
+    return _singleflight.metrics()
@@ -5,14 +5,15 @@
 from datetime import date
 import streamlit as st
 from database import get_supabase
+from search_index import index_card, index_source, unindex_cards, unindex_source
+from singleflight import coalesce, forget
 from utils import get_initial_card_state
 
 # キャッシュのTTL（秒）
 CACHE_TTL = 60
 
-@st.cache_data(ttl=CACHE_TTL, show_spinner=False)
-def _load_cards_cached(user_id):
-    """キャッシュ付きでカードを読み込む（内部用）"""
+def _query_cards(user_id):
+    """データベースからカードを読み込み、アプリの形式に変換（内部用）"""
     supabase = get_supabase()
     
     result = supabase.table("cards").select("*").eq("user_id", user_id).execute()
@@ -39,13 +40,22 @@ def _load_cards_cached(user_id):
     
     return cards
 
+@st.cache_data(ttl=CACHE_TTL, show_spinner=False)
+def _load_cards_cached(user_id):
+    """キャッシュ付きでカードを読み込む（内部用、同時に起きた読み込みは1回のクエリにまとめる）"""
+    return coalesce(("load_cards", user_id), lambda: _query_cards(user_id))
+
 def load_cards(user_id):
     """指定ユーザーのカードを読み込む"""
     return _load_cards_cached(user_id)
 
 def clear_cards_cache(user_id=None):
-    """カードのキャッシュをクリア"""
+    """カードのキャッシュをクリア（カード管理用インデックスも作り直す）"""
     _load_cards_cached.clear()
+    _load_deck_cached.clear()
+    if user_id is not None:
+        # 更新前に始まった読み込みに以降の呼び出しが相乗りしないようにする
+        forget(("load_cards", user_id))
 
 def save_cards(user_id, cards):
     """指定ユーザーのカードを保存（一括更新用、通常は個別操作を使用）"""
@@ -76,11 +86,61 @@ def add_card(user_id, question, answer, title="", category="その他", source_i
     
     # キャッシュをクリア
     clear_cards_cache(user_id)
+    if result.data:
+        index_card(user_id, result.data[0]["id"], question, answer)
     
     return result.data[0]["id"] if result.data else None
 
+def add_cards_batch(user_id, cards):
+    """
+    カードを一括追加（1回のinsert）
+    
+    Args:
+        cards (list): [{"question", "answer", "title", "category", "source_id", "blank_count"}, ...]
+        
+    Returns:
+        int: 追加したカード数
+    """
+    if not cards:
+        return 0
+    
+    supabase = get_supabase()
+    initial_state = get_initial_card_state()
+    
+    rows = []
+    for card in cards:
+        row = {
+            "user_id": user_id,
+            "question": card["question"],
+            "answer": card["answer"],
+            "title": card.get("title", ""),
+            "category": card.get("category", "その他"),
+            "ease_factor": initial_state["ease_factor"],
+            "interval": initial_state["interval"],
+            "repetitions": initial_state["repetitions"],
+            "next_review": initial_state["next_review"],
+            "blank_count": card.get("blank_count", 1)
+        }
+        if card.get("source_id"):
+            row["source_id"] = card["source_id"]
+        rows.append(row)
+    
+    result = supabase.table("cards").insert(rows).execute()
+    
+    # キャッシュをクリア
+    clear_cards_cache(user_id)
+    for row in result.data or []:
+        index_card(user_id, row["id"], row["question"], row["answer"])
+    
+    return len(result.data) if result.data else 0
+
 # ============ 原文カード管理 ============
 
+def clear_source_cards_cache(user_id):
+    """原文カードの更新後に呼ぶ（実行中の読み込みを切り離し、カード管理用インデックスを作り直す）"""
+    forget(("load_source_cards", user_id))
+    _load_deck_cached.clear()
+
 def add_source_card(user_id, source_text, title="", category="その他"):
     """原文カードを追加"""
     supabase = get_supabase()
@@ -91,21 +151,54 @@ def add_source_card(user_id, source_text, title="", category="その他"):
         "title": title,
         "category": category
     }).execute()
+    clear_source_cards_cache(user_id)
     
     if result.data:
+        index_source(user_id, result.data[0]["id"], title, source_text)
         return result.data[0]["id"]
     return None
 
+def add_source_cards_batch(user_id, sources):
+    """
+    原文カードを一括追加（1回のinsert）
+    
+    Args:
+        sources (list): [{"source_text", "title", "category"}, ...]
+        
+    Returns:
+        list: 追加した原文カードのID（sourcesと同じ順序）
+    """
+    if not sources:
+        return []
+    
+    supabase = get_supabase()
+    
+    result = supabase.table("source_cards").insert([{
+        "user_id": user_id,
+        "source_text": source["source_text"],
+        "title": source.get("title", ""),
+        "category": source.get("category", "その他")
+    } for source in sources]).execute()
+    clear_source_cards_cache(user_id)
+    for row in result.data or []:
+        index_source(user_id, row["id"], row.get("title", ""), row.get("source_text", ""))
+    
+    return [row["id"] for row in result.data] if result.data else []
+
 def load_source_cards(user_id):
-    """原文カードを読み込む"""
+    """原文カードを読み込む（同時に起きた読み込みは1回のクエリにまとめる）"""
     supabase = get_supabase()
     
-    result = supabase.table("source_cards").select("*").eq("user_id", user_id).execute()
+    result = coalesce(
+        ("load_source_cards", user_id),
+        lambda: supabase.table("source_cards").select("*").eq("user_id", user_id).execute()
+    )
     
     if not result.data:
         return []
     
-    return result.data
+    # 同時に読み込んだ呼び出し元と結果を共有しているためコピーを返す
+    return [dict(row) for row in result.data]
 
 def get_source_card(source_id):
     """特定の原文カードを取得"""
@@ -124,15 +217,21 @@ def get_source_cards_by_ids(source_ids):
     
     supabase = get_supabase()
     
-    result = supabase.table("source_cards").select("*").in_("id", source_ids).execute()
+    ids = sorted(set(source_ids))
+    result = coalesce(
+        ("get_source_cards_by_ids", tuple(ids)),
+        lambda: supabase.table("source_cards").select("*").in_("id", ids).execute()
+    )
     
-    return result.data if result.data else []
+    return [dict(row) for row in result.data] if result.data else []
 
 def delete_source_card(user_id, source_id):
     """原文カードを削除"""
     supabase = get_supabase()
     
     supabase.table("source_cards").delete().eq("id", source_id).eq("user_id", user_id).execute()
+    clear_source_cards_cache(user_id)
+    unindex_source(user_id, source_id)
 
 def update_card_progress(user_id, card_id, stats):
     """カードの学習進捗を更新"""
@@ -161,6 +260,7 @@ def update_card_content(user_id, card_id, question, answer, title="", category="
     
     # キャッシュをクリア
     clear_cards_cache(user_id)
+    index_card(user_id, card_id, question, answer)
 
 def delete_card(user_id, card_id):
     """カードを削除"""
@@ -170,6 +270,7 @@ def delete_card(user_id, card_id):
     
     # キャッシュをクリア
     clear_cards_cache(user_id)
+    unindex_cards(user_id, [card_id])
 
 def delete_cards_batch(user_id, card_ids):
     """複数のカードを一括削除"""
@@ -180,3 +281,57 @@ def delete_cards_batch(user_id, card_ids):
     
     # キャッシュをクリア
     clear_cards_cache(user_id)
+    unindex_cards(user_id, card_ids)
+
+# ============ カード管理用インデックス ============
+
+def build_deck_index(cards, source_cards):
+    """
+    カード管理画面用のインデックスを作成（全カードを1回ずつ走査）
+    
+    Returns:
+        dict: {
+            "cards": 暗記カード一覧,
+            "sources": 原文カード一覧,
+            "cards_by_id": {暗記カードID: 暗記カード},
+            "sources_by_id": {原文カードID: 原文カード},
+            "cards_by_source": {原文カードID: [紐づく暗記カード]},
+            "sources_by_category": {カテゴリ: [原文カード]},
+            "orphans_by_category": {カテゴリ: [原文を持たない暗記カード]}
+        }
+    """
+    cards_by_source = {}
+    orphans_by_category = {}
+    for card in cards:
+        source_id = card.get("source_id")
+        if source_id:
+            cards_by_source.setdefault(source_id, []).append(card)
+        else:
+            orphans_by_category.setdefault(card.get("category", "その他"), []).append(card)
+    
+    sources_by_category = {}
+    for source in source_cards:
+        sources_by_category.setdefault(source.get("category", "その他"), []).append(source)
+    
+    return {
+        "cards": cards,
+        "sources": source_cards,
+        "cards_by_id": {card["id"]: card for card in cards},
+        "sources_by_id": {source["id"]: source for source in source_cards},
+        "cards_by_source": cards_by_source,
+        "sources_by_category": sources_by_category,
+        "orphans_by_category": orphans_by_category
+    }
+
+@st.cache_data(ttl=CACHE_TTL, show_spinner=False)
+def _load_deck_cached(user_id):
+    """キャッシュ付きでカード管理用インデックスを作成（内部用、カード・原文カードの更新時に作り直す）"""
+    return build_deck_index(_load_cards_cached(user_id), load_source_cards(user_id))
+
+def load_deck(user_id):
+    """
+    暗記カード・原文カードとカード管理用インデックスを読み込む（build_deck_indexを参照）
+    
+    インデックスはキャッシュと一緒に保持するため、画面の再実行ごとの集計は不要。
+    """
+    return _load_deck_cached(user_id)